@@ -1,20 +1,33 @@
 #!/usr/bin/env python3
 
 import argparse
+import gc
 import logging
+import os
 import time
-from typing import Union
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, Optional, Callable, Any
 
+import pytz
 from onthisday.calendar import make_calendar
-from onthisday.common_data import MONTH_DAYS, date_from_yyyymmdd
-from onthisday.db import DAO, InMemory
-from onthisday.get_data import parse_all_to_db
+from onthisday.common_data import MONTH_DAYS, EMPTY_EVENT_DICT, date_from_yyyymmdd
+from onthisday.db import DAO, InMemory, SnapshotError, DEFAULT_SEARCH_LIMIT
+from onthisday.get_data import parse_all_to_db, reparse_all_to_db
+from onthisday.wikitext_store import WikitextStore
 
 logger = logging.getLogger(__name__)
 
 def update(db: DAO, ns: argparse.Namespace):
     logger.info('Updating database.')
-    parse_all_to_db(db)
+    store = None if ns.no_store else WikitextStore(ns.wikitext_dir)
+    parse_all_to_db(db, ns.workers, store=store, parse_workers=ns.parse_workers)
+
+
+def reparse(db: DAO, ns: argparse.Namespace):
+    logger.info('Rebuilding database from stored wikitext.')
+    reparse_all_to_db(db, WikitextStore(ns.wikitext_dir), ns.workers)
 
 
 CATEGORIES = {
@@ -35,6 +48,15 @@ def random(db: DAO, ns: argparse.Namespace):
         print(f'({d} {m}) {y} - {desc}')
 
 
+def search(db: DAO, ns: argparse.Namespace):
+    logger.info('Searching events.')
+    if not db.has_fts:
+        search_parser.error('Search requires SQLite with the FTS5 extension.')
+    cat = CATEGORIES.get(ns.category)
+    for m, d, c, y, desc in db.search_events(' '.join(ns.query), ns.month, ns.date, cat, ns.count):
+        print(f'({d} {m}) {y} - {desc}')
+
+
 def calendar(db: DAO, ns: argparse.Namespace):
     logger.info('Generating calendar.')
     category_counts = {
@@ -44,15 +66,100 @@ def calendar(db: DAO, ns: argparse.Namespace):
     }
     start = date_from_yyyymmdd(ns.start)
     end = date_from_yyyymmdd(ns.end)
+    window = None
+    if ns.window is not None:
+        past_str, future_str = ns.window.split(',')
+        window = (int(past_str), int(future_str))
     h_str, m_str = ns.time.split(':')
-    cal = make_calendar(db, start, end, int(h_str), int(m_str), ns.timezone, categories=category_counts)
+    if ns.topic is not None:
+        # Events can only be filtered by topic once loaded into memory.
+        db = load_in_memory(db, write_snapshot=bool(ns.workers))
+    cal = make_calendar(db, start, end, int(h_str), int(m_str), pytz.timezone(ns.timezone), categories=category_counts,
+                        seed=ns.seed, window=window, topic=ns.topic, workers=ns.workers)
     print(cal.to_ical().decode())
 
 
+def snapshot(db: DAO, ns: argparse.Namespace):
+    fpath = ns.output or db.get_default_snapshot_fpath()
+    logger.info(f'Writing snapshot to {fpath}.')
+    InMemory(db).write_snapshot(fpath)
+
+
+def load_in_memory(db: DAO, snapshot_fpath: Optional[str] = None, write_snapshot: bool = False) -> InMemory:
+    """
+    Load events into memory, from a snapshot file if an up-to-date one exists, or from the database otherwise.
+
+    :param db: The :class:`DAO` object for the database.
+    :param snapshot_fpath: The path to the snapshot file. If None, the default path for the database is used.
+    :param write_snapshot: If True and there is no up-to-date snapshot, write one and load the events from it. Use this
+        when calendars will be generated by worker processes, as an object loaded from a snapshot is sent to them as a
+        reference to the file rather than a copy of the data.
+    :return: The :class:`InMemory` object.
+    """
+    snapshot_fpath = snapshot_fpath or db.get_default_snapshot_fpath()
+    if os.path.exists(snapshot_fpath):
+        try:
+            return InMemory.from_snapshot(snapshot_fpath, db)
+        except SnapshotError as e:
+            logger.warning(f'Not using snapshot: {e.args[0]}')
+    in_memory = InMemory(db)
+    if write_snapshot:
+        logger.info(f'Writing snapshot to {snapshot_fpath}.')
+        try:
+            in_memory.write_snapshot(snapshot_fpath)
+            return InMemory.from_snapshot(snapshot_fpath, db)
+        except (OSError, SnapshotError) as e:
+            logger.warning(f'Could not write snapshot: {e}')
+    return in_memory
+
+
 def server(db: DAO, ns: argparse.Namespace):
     logger.info('Launching server.')
-    from onthisday.app.download_calendar import run
-    run(InMemory(db), ns.host, ns.port)
+    if ns.asgi:
+        if ns.workers:
+            serv_parser.error('--workers cannot be used with --asgi.')
+        from onthisday.app.async_calendar import run
+        run(load_in_memory(db, ns.snapshot, bool(ns.calendar_workers)), ns.host, ns.port, ns.cache_size * 1024 * 1024,
+            ns.calendar_workers, ns.fragment_cache_size * 1024 * 1024)
+    elif ns.workers:
+        from onthisday.app.cache import CalendarCache
+        from onthisday.app.download_calendar import app
+        from onthisday.app.prefork import PreforkServer
+        app.config['cache'] = CalendarCache(ns.cache_size * 1024 * 1024) if ns.cache_size else None
+        app.config['fragment_cache'] = \
+            CalendarCache(ns.fragment_cache_size * 1024 * 1024) if ns.fragment_cache_size else None
+        app.config['calendar_workers'] = ns.calendar_workers
+        PreforkServer(app, lambda: load_in_memory(db, ns.snapshot, bool(ns.calendar_workers)), ns.host, ns.port,
+                      ns.workers).serve_forever()
+    else:
+        from onthisday.app.download_calendar import run
+        run(load_in_memory(db, ns.snapshot, bool(ns.calendar_workers)), ns.host, ns.port, ns.cache_size * 1024 * 1024,
+            ns.calendar_workers, ns.fragment_cache_size * 1024 * 1024)
+
+
+def export(db: DAO, ns: argparse.Namespace):
+    from onthisday.export import read_manifest, export_calendars
+    entries = read_manifest(ns.manifest)
+    logger.info(f'Exporting {len(entries)} calendars to {ns.output_dir}.')
+    start = time.perf_counter()
+    n = export_calendars(load_in_memory(db, ns.snapshot, write_snapshot=True), entries, ns.output_dir, ns.workers)
+    print(f'Exported {n} calendars in {time.perf_counter() - start:.3f} seconds.')
+
+
+def bench(db: DAO, ns: argparse.Namespace):
+    logger.info(f'Benchmarking {ns.url}.')
+
+    def fetch(_) -> int:
+        with urllib.request.urlopen(ns.url) as r:
+            return len(r.read())
+
+    print(f'Sending {ns.requests} requests ({ns.concurrency} at a time)...')
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=ns.concurrency) as executor:
+        total_bytes = sum(executor.map(fetch, range(ns.requests)))
+    end = time.time()
+    print(f'Took {end - start} seconds.')
+    print(f'{ns.requests / (end - start)} requests per second ({total_bytes} bytes received).')
 
 
 def test_calendar(db: Union[DAO, InMemory]) -> str:
@@ -88,6 +195,7 @@ def timetest():
     db = InMemory(DAO())
     end = time.time()
     print(f'Took {end - start} seconds.')
+    print(f'Read {db.row_count} events from the database in {db.load_time} seconds.')
     print()
     print('Generating calendar...')
     start = time.time()
@@ -96,17 +204,80 @@ def timetest():
     print(f'Took {end - start} seconds.')
 
 
+def load_legacy(db: DAO) -> dict[str, dict[int, dict[str, list[tuple[str, str]]]]]:
+    """
+    Load every event into the structure :class:`InMemory` used to keep events in before it stored them in flat arrays
+    (a dict of dicts of dicts of lists of year and description tuples), for comparison.
+    """
+    events = {m: {d: {c: [] for c in EMPTY_EVENT_DICT} for d in range(1, MONTH_DAYS[m] + 1)} for m in MONTH_DAYS}
+    for m, d, c, y, desc in db.iter_all_events():
+        events[m][d][c].append((y, desc))
+    return events
+
+
+def measure_memory(load: Callable[[], Any]) -> tuple[Any, int, int, int]:
+    """
+    Measure the memory used by the object returned by a function.
+
+    :return: A tuple of the object, the number of bytes it uses, the peak number of bytes used while loading it and the
+        number of objects tracked by the garbage collector that it adds.
+    """
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    tracemalloc.start()
+    obj = load()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.collect()
+    return obj, current, peak, len(gc.get_objects()) - objects_before
+
+
+def memtest(db_fpath: Optional[str] = None):
+    db = DAO(db_fpath)
+    results = {}
+    for name, load in (('Legacy (dict of tuples)', lambda: load_legacy(db)), ('InMemory', lambda: InMemory(db))):
+        print(name)
+        print()
+        print('Creating object...')
+        obj, current, peak, objects = measure_memory(load)
+        results[name] = current
+        print(f'Uses {current} bytes ({peak} bytes at peak, while loading).')
+        print(f'Added {objects} objects tracked by the garbage collector.')
+        print()
+        del obj
+    legacy, in_memory = results.values()
+    print(f'InMemory uses {legacy / in_memory:.1f} times less memory than the legacy structure.')
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--debug', action='store_true', default=False)
 parser.add_argument('--timetest', action='store_true', help='Test how long it takes to generate calendars using DAO vs '
                                                             'InMemory.')
+parser.add_argument('--memtest', action='store_true', help='Test how much memory is used by InMemory, compared to the '
+                                                          'structure it used to use.')
 parser.add_argument('--dbfile', help='Path to database file.', metavar='FILE', default=None)
 
 subparsers = parser.add_subparsers()
 
 update_parser = subparsers.add_parser('update', help='Fetch events from Wikipedia and update the database.')
+update_parser.add_argument('--workers', '-w', type=int, default=1, metavar='N',
+                           help='Number of pages to fetch from Wikipedia concurrently.')
+update_parser.add_argument('--wikitext-dir', help='Directory in which to store fetched wikitext.', metavar='DIR',
+                           default=None)
+update_parser.add_argument('--no-store', action='store_true', default=False,
+                           help='Do not store fetched wikitext (which means it cannot be used to reparse later).')
+update_parser.add_argument('--parse-workers', type=int, default=1, metavar='N',
+                           help='Number of processes with which to parse fetched pages.')
 update_parser.set_defaults(func=update)
 
+reparse_parser = subparsers.add_parser('reparse', help='Rebuild the database from stored wikitext, without fetching '
+                                                       'anything from Wikipedia.')
+reparse_parser.add_argument('--wikitext-dir', help='Directory in which fetched wikitext is stored.', metavar='DIR',
+                            default=None)
+reparse_parser.add_argument('--workers', '-w', type=int, default=1, metavar='N',
+                            help='Number of processes with which to parse pages.')
+reparse_parser.set_defaults(func=reparse)
+
 random_parser = subparsers.add_parser('random', help='Print random events.')
 random_parser.add_argument('--count', '-n', help='Number of results to return', type=int, default=1)
 random_parser.add_argument('--category', '-c', help='Category of event', choices=CATEGORIES)
@@ -114,6 +285,15 @@ random_parser.add_argument('--month', '-m', help='Month to query', choices=MONTH
 random_parser.add_argument('--date', '-d', help='Date to query', type=int)
 random_parser.set_defaults(func=random)
 
+search_parser = subparsers.add_parser('search', help='Print events whose descriptions contain all of the given words.')
+search_parser.add_argument('query', nargs='+', help='Words to search for', metavar='WORD')
+search_parser.add_argument('--count', '-n', help='Maximum number of results to return', type=int,
+                           default=DEFAULT_SEARCH_LIMIT)
+search_parser.add_argument('--category', '-c', help='Category of event', choices=CATEGORIES)
+search_parser.add_argument('--month', '-m', help='Month to query', choices=MONTH_DAYS)
+search_parser.add_argument('--date', '-d', help='Date to query', type=int)
+search_parser.set_defaults(func=search)
+
 cal_parser = subparsers.add_parser('calendar', help='Generate a vCalendar with random events.')
 cal_parser.add_argument('--time', help='Time of daily event.', metavar='MM:SS', default='10:00')
 cal_parser.add_argument('--start', help='Start date.', metavar='YYYYMMDD', default=None)
@@ -124,13 +304,67 @@ cal_parser.add_argument('--holiday', type=int, help='Number of holidays/observan
                         metavar='N')
 cal_parser.add_argument('--timezone', default='UTC', metavar='TZ',
                         help='Timezone for event time, eg, "UTC", "Europe/London", "America/New_York", etc.')
+cal_parser.add_argument('--seed', default=None,
+                        help='Seed for selecting events, so that the same arguments always produce the same calendar.')
+cal_parser.add_argument('--window', default=None, metavar='PAST,FUTURE',
+                        help='Generate a rolling window of days, from PAST days before today to FUTURE days after '
+                             'today, instead of using --start and --end. Each day keeps the same events as the window '
+                             'moves.')
+cal_parser.add_argument('--topic', default=None,
+                        help='Only include events whose descriptions contain all of the words of this topic, eg, '
+                             '"science" or "jazz music".')
+cal_parser.add_argument('--workers', '-w', type=int, default=None, metavar='N',
+                        help='Generate the calendar in parallel using N worker processes (useful for long calendars).')
 cal_parser.set_defaults(func=calendar)
 
 serv_parser = subparsers.add_parser('server', help='Spin up a web app to serve calendars.')
 serv_parser.add_argument('--host', help='Host to serve on.', default='localhost')
 serv_parser.add_argument('--port', help='Port to listen on.', type=int, default=8080)
+serv_parser.add_argument('--workers', '-w', type=int, default=None, metavar='N',
+                         help='Serve using N pre-forked worker processes, sharing events loaded once by the parent '
+                              'process. Send SIGHUP to the parent to reload events (eg, after an update). If not '
+                              'specified, the single-process development server is used.')
+serv_parser.add_argument('--asgi', action='store_true', default=False,
+                         help='Serve the asynchronous (ASGI) version of the app using uvicorn, which must be '
+                              'installed. Cannot be used with --workers.')
+serv_parser.add_argument('--snapshot', help='Path to snapshot file to load events from, if it is up to date.',
+                         metavar='FILE', default=None)
+serv_parser.add_argument('--cache-size', type=int, default=64, metavar='MB',
+                         help='Maximum size of the cache of calendars requested with a seed or window, in megabytes '
+                              '(per worker). Set to 0 to disable caching.')
+serv_parser.add_argument('--fragment-cache-size', type=int, default=16, metavar='MB',
+                         help='Maximum size of the cache of the days of windowed calendars (kept separately from the '
+                              'cache of whole calendars), in megabytes (per worker). Set to 0 to disable caching.')
+serv_parser.add_argument('--calendar-workers', type=int, default=None, metavar='N',
+                         help='Generate long calendars (two years or more) in parallel using N worker processes (per '
+                              'server worker). A snapshot is written if there is no up-to-date one.')
 serv_parser.set_defaults(func=server)
 
+snapshot_parser = subparsers.add_parser('snapshot', help='Write a snapshot of the database which the server can load '
+                                                         'quickly.')
+snapshot_parser.add_argument('--output', '-o', help='Path to snapshot file.', metavar='FILE', default=None)
+snapshot_parser.set_defaults(func=snapshot)
+
+export_parser = subparsers.add_parser('export', help='Generate many calendars at once, as described in a manifest.')
+export_parser.add_argument('manifest', metavar='MANIFEST',
+                           help='Path to a JSON (list of objects) or CSV (with a header row) file, each entry of which '
+                                'gives the parameters of a calendar, named as for the web app (eg, "timezone", '
+                                '"births", "start", "seed"), plus an optional "filename".')
+export_parser.add_argument('--output-dir', '-o', help='Directory to write calendars to.', metavar='DIR',
+                           default='.')
+export_parser.add_argument('--workers', '-w', type=int, default=None, metavar='N',
+                           help='Number of worker processes with which to generate calendars (default: number of '
+                                'CPUs). A snapshot is written if there is no up-to-date one.')
+export_parser.add_argument('--snapshot', help='Path to snapshot file to load events from, if it is up to date.',
+                           metavar='FILE', default=None)
+export_parser.set_defaults(func=export)
+
+bench_parser = subparsers.add_parser('bench', help='Measure the throughput of a running server.')
+bench_parser.add_argument('--url', help='URL to request.', default='http://localhost:8080/calendar')
+bench_parser.add_argument('--requests', '-n', type=int, help='Total number of requests to send.', default=100)
+bench_parser.add_argument('--concurrency', '-c', type=int, help='Number of requests to send at a time.', default=8)
+bench_parser.set_defaults(func=bench)
+
 
 if __name__ == '__main__':
     ns = parser.parse_args()
@@ -140,6 +374,9 @@ if __name__ == '__main__':
     if ns.timetest:
         timetest()
         exit()
+    if ns.memtest:
+        memtest(ns.dbfile)
+        exit()
 
     if hasattr(ns, 'func'):
         db = DAO(ns.dbfile)
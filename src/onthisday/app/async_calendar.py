@@ -0,0 +1,201 @@
+"""
+An ASGI version of the calendar download app (see :mod:`onthisday.app.download_calendar`), which serves the same
+`/calendar` endpoint. It uses the same helpers as the Flask app to validate arguments, answer conditional requests,
+cache reproducible calendars and generate long calendars in parallel, so the two apps respond in the same way.
+
+Calendar generation is CPU-bound, so it is run in an executor, a batch of days at a time. The response is streamed to
+the client between batches, so a slow client does not tie up a thread (or hold a whole calendar in memory) while it
+downloads.
+"""
+
+import asyncio
+import gzip
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Union, Iterator, Optional, Callable, Awaitable, Any
+from urllib.parse import parse_qsl
+
+from onthisday.app.cache import CalendarCache, DEFAULT_CACHE_SIZE, DEFAULT_FRAGMENT_CACHE_SIZE, is_reproducible
+from onthisday.app.download_calendar import convert_args, BadArgumentError, gzip_chunks, calendar_validators, \
+    is_calendar_modified, is_long_calendar, cached_calendar, calendar_headers, GENERATION_ERROR
+from onthisday.calendar import iter_calendar_ical
+from onthisday.db import DAO, InMemory
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.http import parse_accept_header
+
+logger = logging.getLogger(__name__)
+
+Scope = dict[str, Any]
+Receive = Callable[[], Awaitable[dict[str, Any]]]
+Send = Callable[[dict[str, Any]], Awaitable[None]]
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """
+    Determine whether a client accepts gzip-encoded responses.
+
+    :param accept_encoding: The value of the Accept-Encoding header sent by the client.
+    :return: Whether the client accepts gzip encoding.
+    """
+    return parse_accept_header(accept_encoding).quality('gzip') > 0
+
+
+def next_batch(chunks: Iterator[bytes], min_size: int) -> bytes:
+    """
+    Get chunks from an iterator until at least `min_size` bytes have been received or the iterator is exhausted.
+
+    :param chunks: The iterator.
+    :param min_size: The minimum number of bytes to get (unless the iterator is exhausted).
+    :return: The chunks, joined together. Empty if the iterator is exhausted.
+    """
+    batch = []
+    size = 0
+    for chunk in chunks:
+        batch.append(chunk)
+        size += len(chunk)
+        if size >= min_size:
+            break
+    return b''.join(batch)
+
+
+class CalendarApp:
+    """
+    An ASGI app which serves calendars.
+
+    :param db: A :class:`DAO` or :class:`InMemory` object to retrieve historical events from the database. Only
+        :class:`InMemory` objects are safe to use from multiple threads, so use one of those unless `executor` has a
+        single worker.
+    :param executor: The executor in which to generate calendars. If None, the event loop's default executor is used.
+    :param batch_size: The (minimum) number of bytes of calendar data (after compression, if the response is
+        gzip-encoded) to generate in the executor at a time.
+    :param cache: The cache in which to store reproducible calendars, if any (see :func:`cached_calendar`).
+    :param fragment_cache: The cache in which to store the vEvents of windowed calendars, if any.
+    :param calendar_executor: If given, long calendars are generated in parallel using this executor (see
+        :func:`make_vevents_in_parallel`), as with the `calendar_workers` setting of the Flask app.
+    """
+
+    def __init__(self, db: Union[DAO, InMemory], executor: Optional[Executor] = None, batch_size: int = 64 * 1024,
+                 cache: Optional[CalendarCache] = None, fragment_cache: Optional[CalendarCache] = None,
+                 calendar_executor: Optional[Executor] = None):
+        self.db = db
+        self.executor = executor
+        self.batch_size = batch_size
+        self.cache = cache
+        self.fragment_cache = fragment_cache
+        self.calendar_executor = calendar_executor
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if scope['path'] == '/calendar':
+                await self.calendar(scope, send)
+            else:
+                await self.send_text(send, 'Not found.', 404)
+
+    async def lifespan(self, receive: Receive, send: Send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def send_text(self, send: Send, text: str, status: int = 200):
+        body = text.encode()
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'text/plain; charset=utf-8'), (b'content-length', str(len(body)).encode())]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def send_calendar_start(self, send: Send, headers: list[tuple[str, str]], status: int = 200):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+        })
+
+    async def calendar(self, scope: Scope, send: Send):
+        # Repeated arguments and blank values are treated as in the Flask app's `request.args`.
+        query = MultiDict(parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+        try:
+            args = convert_args(query)
+        except BadArgumentError as e:
+            await self.send_text(send, f'Error parsing input: {e.args[0]}')
+            return
+
+        request_headers = Headers([(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope['headers']])
+        use_gzip = accepts_gzip(request_headers.get('Accept-Encoding', ''))
+        try:
+            etag, last_modified = calendar_validators(self.db, args, use_gzip)
+            long_calendar = is_long_calendar(args)
+        except ValueError as e:
+            logger.exception(e)
+            await self.send_text(send, GENERATION_ERROR)
+            return
+        headers = calendar_headers(use_gzip, etag, last_modified)
+        if not is_calendar_modified(request_headers, etag, last_modified):
+            # The client already has this calendar, so there is no need to generate it.
+            await self.send_calendar_start(send, headers, 304)
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        if long_calendar and (self.calendar_executor is not None):
+            args['executor'] = self.calendar_executor
+
+        loop = asyncio.get_running_loop()
+        if (self.cache is not None) and is_reproducible(args):
+            try:
+                data = await loop.run_in_executor(self.executor, cached_calendar, self.db, args, self.cache,
+                                                  self.fragment_cache)
+            except Exception as e:
+                logger.exception(e)
+                await self.send_text(send, GENERATION_ERROR)
+                return
+            body = data if use_gzip else gzip.decompress(data)
+            await self.send_calendar_start(send, headers + [('Content-Length', str(len(body)))])
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        chunks = iter_calendar_ical(self.db, **args)
+        if use_gzip:
+            chunks = gzip_chunks(chunks)
+        try:
+            # Generate the first batch before starting the response, so that any errors caused by the input can be
+            # reported properly.
+            batch = await loop.run_in_executor(self.executor, next_batch, chunks, self.batch_size)
+        except Exception as e:
+            logger.exception(e)
+            await self.send_text(send, GENERATION_ERROR)
+            return
+
+        await self.send_calendar_start(send, headers)
+        while batch:
+            await send({'type': 'http.response.body', 'body': batch, 'more_body': True})
+            batch = await loop.run_in_executor(self.executor, next_batch, chunks, self.batch_size)
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+def run(db: Union[DAO, InMemory], host: str, port: int, cache_size: int = DEFAULT_CACHE_SIZE,
+        calendar_workers: Optional[int] = None, fragment_cache_size: int = DEFAULT_FRAGMENT_CACHE_SIZE):
+    """
+    Serve the ASGI app using uvicorn. uvicorn is an optional dependency (it is not needed to serve the Flask app), so
+    is only imported here. Arguments are as for :func:`onthisday.app.download_calendar.run`.
+
+    :raises RuntimeError: If uvicorn is not installed.
+    """
+    try:
+        import uvicorn
+    except ImportError:
+        raise RuntimeError('Serving the ASGI app requires uvicorn, which is not installed (run "pip install uvicorn").')
+    calendar_executor = ProcessPoolExecutor(calendar_workers) if calendar_workers else None
+    app = CalendarApp(db, cache=CalendarCache(cache_size) if cache_size else None,
+                      fragment_cache=CalendarCache(fragment_cache_size) if fragment_cache_size else None,
+                      calendar_executor=calendar_executor)
+    try:
+        uvicorn.run(app, host=host, port=port)
+    finally:
+        if calendar_executor is not None:
+            calendar_executor.shutdown()
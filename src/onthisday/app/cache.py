@@ -0,0 +1,134 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, date, time
+from typing import Any, Hashable, Optional
+
+from onthisday.calendar import get_categories, get_date_range
+from onthisday.db import topic_tokens
+
+# Default maximum total size of the calendars held in a cache, in bytes.
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+# Default maximum total size of the vEvents of windowed calendars held in a cache (see :func:`iter_calendar_ical`), in
+# bytes.
+DEFAULT_FRAGMENT_CACHE_SIZE = 16 * 1024 * 1024
+
+
+def normalise_args(args: dict[str, Any]) -> tuple:
+    """
+    Convert the arguments for a calendar (as returned by :func:`convert_args`) to a normalised, hashable form, applying
+    the same defaults as :func:`make_calendar`. Two sets of arguments which would produce the same calendar (given the
+    same seed and data) have the same normalised form.
+
+    :param args: The calendar arguments.
+    :return: A tuple representing the arguments.
+    """
+    start, end = get_date_range(args.get('start'), args.get('end'), args.get('window'))
+    categories = get_categories(dict(args['categories']) if args.get('categories') is not None else None)
+    return (
+        start.isoformat(),
+        end.isoformat(),
+        args.get('hour', 9),
+        args.get('minute', 0),
+        args['tz'].zone if args.get('tz') is not None else 'UTC',
+        tuple(categories.items()),
+        args.get('seed'),
+        args.get('window'),
+        topic_tokens(args['topic']) if args.get('topic') is not None else None
+    )
+
+
+def is_reproducible(args: dict[str, Any]) -> bool:
+    """
+    Determine whether a calendar is reproducible, ie, whether the same arguments (and data) always produce the same
+    calendar. This is the case if a seed is given or the calendar is windowed (see :func:`make_calendar`).
+
+    :param args: The calendar arguments (as returned by :func:`convert_args`).
+    :return: Whether the calendar is reproducible.
+    """
+    return (args.get('seed') is not None) or (args.get('window') is not None)
+
+
+def calendar_etag(args: dict[str, Any], version: str, encoding: Optional[str] = None) -> str:
+    """
+    Get an entity tag for a calendar, which changes whenever the calendar would change (unless the calendar is not
+    reproducible, in which case it is only "weakly" the same calendar, ie, its events are randomly selected in the same
+    way).
+
+    :param args: The calendar arguments (as returned by :func:`convert_args`).
+    :param version: The version of the data the calendar is generated from (see :meth:`DAO.get_version`).
+    :param encoding: The content encoding of the response (eg, "gzip"), if any.
+    :return: The entity tag (unquoted).
+    """
+    h = hashlib.sha256(repr((normalise_args(args), version, encoding)).encode())
+    return h.hexdigest()[:32]
+
+
+def calendar_last_modified(args: dict[str, Any], data_last_modified: Optional[datetime]) -> Optional[datetime]:
+    """
+    Get the time at which a calendar was last modified, ie, when the data it is generated from was last modified (or,
+    if the dates of the calendar are relative to the current date, the start of the current date, if later).
+
+    :param args: The calendar arguments (as returned by :func:`convert_args`).
+    :param data_last_modified: The time at which the data was last modified (see :meth:`DAO.get_last_modified`).
+    :return: The time, or None if not known.
+    """
+    if (data_last_modified is None) or ((args.get('start') is not None) and (args.get('window') is None)):
+        return data_last_modified
+    return max(data_last_modified, datetime.combine(date.today(), time()).astimezone())
+
+
+class CalendarCache:
+    """
+    A thread-safe, least-recently-used cache of generated calendars (or parts of calendars, see
+    :func:`iter_calendar_ical`). Only reproducible calendars (see :func:`is_reproducible`) should be cached.
+
+    :param max_size: The maximum total size of the cached data, in bytes. When adding an entry would exceed this, the
+        least recently used entries are evicted.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        """
+        Get a cached calendar.
+
+        :param key: The cache key.
+        :return: The cached data, or None if there is no entry for `key`.
+        """
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return data
+
+    def put(self, key: Hashable, data: bytes):
+        """
+        Add a calendar to the cache. Data larger than the maximum size of the cache is not cached.
+
+        :param key: The cache key.
+        :param data: The data to cache.
+        """
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            while self._entries and (self.size + len(data) > self.max_size):
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+            self._entries[key] = data
+            self.size += len(data)
@@ -1,12 +1,53 @@
-from typing import Union, Any
+import gzip
+import os
+import threading
+import zlib
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import datetime
+from itertools import chain
+from typing import Union, Any, Iterable, Generator, Optional, Mapping
 
 import pytz
-from flask import Flask, make_response, request
-from onthisday.calendar import make_calendar
+from flask import Flask, Response, request, stream_with_context, jsonify
+from onthisday.app.cache import CalendarCache, DEFAULT_CACHE_SIZE, DEFAULT_FRAGMENT_CACHE_SIZE, normalise_args, \
+    calendar_etag, calendar_last_modified, is_reproducible
+from onthisday.calendar import iter_calendar_ical, get_date_range
 from onthisday.common_data import date_from_yyyymmdd, int_or_none
-from onthisday.db import InMemory, DAO
+from onthisday.db import InMemory, DAO, DEFAULT_SEARCH_LIMIT, topic_tokens
+from werkzeug.http import quote_etag, http_date
+from werkzeug.sansio.http import is_resource_modified
 
 app = Flask(__name__)
+# Calendars generated with a seed are cached here (set to None to disable caching).
+app.config['cache'] = CalendarCache()
+# The vEvents of windowed calendars are cached here, separately, so that they don't evict whole calendars (set to None
+# to disable caching).
+app.config['fragment_cache'] = CalendarCache(DEFAULT_FRAGMENT_CACHE_SIZE)
+# Number of worker processes to use to generate long calendars in parallel (None to never generate them in parallel).
+app.config['calendar_workers'] = None
+
+# Maximum length of the "seed" argument.
+MAX_SEED_LENGTH = 256
+# Maximum number of days either side of today in a windowed calendar.
+MAX_WINDOW_DAYS = 3660
+# Maximum length of the "topic" argument.
+MAX_TOPIC_LENGTH = 256
+
+# Calendars of at least this many days are generated in parallel, if enabled.
+PARALLEL_MIN_DAYS = 2 * 366
+
+# Maximum number of results returned by the search endpoint.
+MAX_SEARCH_LIMIT = 100
+
+SEARCH_CATEGORIES = {
+    'births': 'Births',
+    'deaths': 'Deaths',
+    'events': 'Events',
+    'holidays': 'Holidays and observances'
+}
+
+GENERATION_ERROR = ('Error generating calendar. Please check your input. If your input is correct, there may be an '
+                    'issue on the server side.')
 
 
 class BadArgumentError(Exception): pass
@@ -72,9 +113,214 @@ def convert_args(args: dict[str, str]) -> dict[str, Any]:
     converted['hour'] = hour
     converted['minute'] = minute
 
+    seed = args.get('seed')
+    if (seed is not None) and (len(seed) > MAX_SEED_LENGTH):
+        raise BadArgumentError(f'The seed must be no more than {MAX_SEED_LENGTH} characters long.')
+    converted['seed'] = seed
+
+    window = args.get('window')
+    if window is None:
+        converted['window'] = None
+    else:
+        if (converted['start'] is not None) or (converted['end'] is not None):
+            raise BadArgumentError('A window cannot be combined with start or end dates.')
+        try:
+            past_str, future_str = window.split(',')
+            past = int(past_str)
+            future = int(future_str)
+        except ValueError as e:
+            app.logger.exception(e)
+            raise BadArgumentError('The window must be in the format "PAST,FUTURE", where PAST and FUTURE are the '
+                                   'number of days before and after today to include.')
+        if not ((0 <= past <= MAX_WINDOW_DAYS) and (0 <= future <= MAX_WINDOW_DAYS)):
+            raise BadArgumentError(f'The number of days before and after today to include in the window must be '
+                                   f'between 0 and {MAX_WINDOW_DAYS} (inclusive).')
+        converted['window'] = (past, future)
+
+    topic = args.get('topic')
+    if topic is not None:
+        if len(topic) > MAX_TOPIC_LENGTH:
+            raise BadArgumentError(f'The topic must be no more than {MAX_TOPIC_LENGTH} characters long.')
+        if not topic_tokens(topic):
+            raise BadArgumentError('The topic must contain at least one word.')
+    converted['topic'] = topic
+
     return converted
 
 
+def gzip_chunks(chunks: Iterable[bytes], level: int = 6) -> Generator[bytes, None, None]:
+    """
+    Incrementally gzip-compress a stream of bytes.
+
+    :param chunks: The chunks of data to compress.
+    :param level: The compression level (0-9).
+    :return: A generator of chunks of compressed data (in gzip format).
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+_executor: Optional[tuple[int, Executor]] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> Optional[Executor]:
+    """
+    Get the executor with which to generate long calendars in parallel, creating it when first needed. Each process (eg,
+    each worker of a :class:`PreforkServer`) creates its own executor.
+
+    :return: The executor, or None if calendars should not be generated in parallel.
+    """
+    global _executor
+    workers = app.config.get('calendar_workers')
+    if not workers:
+        return None
+    with _executor_lock:
+        if (_executor is None) or (_executor[0] != os.getpid()):
+            db = app.config.get('db')
+            if isinstance(db, InMemory) and (db.snapshot_fpath is None):
+                app.logger.warning('Events were not loaded from a snapshot, so a copy of them will be sent to the '
+                                   'calendar workers with each calendar.')
+            _executor = (os.getpid(), ProcessPoolExecutor(workers))
+        return _executor[1]
+
+
+_search_db = threading.local()
+
+
+def get_search_db() -> Optional[DAO]:
+    """
+    Get a connection to the database with which to search events. SQLite connections can't be shared between threads
+    (or processes), so each thread opens its own connection to the database from which the app's events were loaded.
+
+    :return: The :class:`DAO`, or None if the app's events were not loaded from a database file (eg, if they were
+        loaded from a snapshot alone).
+    """
+    db = app.config['db']
+    dao = db if isinstance(db, DAO) else getattr(db, 'db', None)
+    if dao is None:
+        return None
+    key = (os.getpid(), dao.db_fpath)
+    if getattr(_search_db, 'key', None) != key:
+        _search_db.dao = DAO(dao.db_fpath)
+        _search_db.key = key
+    return _search_db.dao
+
+
+def calendar_validators(db: Union[DAO, InMemory], args: dict[str, Any],
+                        use_gzip: bool) -> tuple[str, Optional[datetime]]:
+    """
+    Get the validators of a calendar, with which clients can make conditional requests for it.
+
+    :param db: The :class:`DAO` or :class:`InMemory` object the calendar is generated from.
+    :param args: The calendar arguments (as returned by :func:`convert_args`).
+    :param use_gzip: Whether the calendar is sent gzip-compressed.
+    :return: A tuple of the (quoted) entity tag of the calendar and the time it was last modified, if known.
+    :raises ValueError: If the arguments do not describe a valid calendar.
+    """
+    # Calendars which are not reproducible are different every time, so their entity tags are weak.
+    etag = quote_etag(calendar_etag(args, db.get_version(), 'gzip' if use_gzip else None),
+                      weak=not is_reproducible(args))
+    return etag, calendar_last_modified(args, db.get_last_modified())
+
+
+def is_calendar_modified(headers: Mapping[str, str], etag: str, last_modified: Optional[datetime]) -> bool:
+    """
+    Determine whether a client needs a calendar, ie, whether it has been modified since the version the client has (if
+    any), according to the conditional headers of the request.
+
+    :param headers: The request headers (with case-insensitive names, eg, a :class:`werkzeug.datastructures.Headers`).
+    :param etag: The (quoted) entity tag of the calendar.
+    :param last_modified: The time the calendar was last modified, if known.
+    :return: Whether the calendar has been modified.
+    """
+    return is_resource_modified(
+        http_range=headers.get('Range'),
+        http_if_range=headers.get('If-Range'),
+        http_if_modified_since=headers.get('If-Modified-Since'),
+        http_if_none_match=headers.get('If-None-Match'),
+        http_if_match=headers.get('If-Match'),
+        etag=etag,
+        last_modified=last_modified
+    )
+
+
+def is_long_calendar(args: dict[str, Any]) -> bool:
+    """
+    Determine whether a calendar is long enough to be generated in parallel (if enabled).
+
+    :param args: The calendar arguments (as returned by :func:`convert_args`).
+    :return: Whether the calendar has at least :data:`PARALLEL_MIN_DAYS` days.
+    :raises ValueError: If the arguments do not describe a valid range of dates.
+    """
+    start, end = get_date_range(args['start'], args['end'], args['window'])
+    return (end - start).days + 1 >= PARALLEL_MIN_DAYS
+
+
+def cached_calendar(db: Union[DAO, InMemory], args: dict[str, Any], cache: CalendarCache,
+                    fragment_cache: Optional[CalendarCache] = None) -> bytes:
+    """
+    Get a reproducible calendar (see :func:`is_reproducible`) from a cache, generating it in full and adding it to the
+    cache if it is not there. Repeated requests (eg, subscription polls) are then served from the cache until the data
+    changes.
+
+    :param db: The :class:`DAO` or :class:`InMemory` object to generate the calendar from.
+    :param args: The calendar arguments (as returned by :func:`convert_args`, plus optionally an executor, see
+        :func:`iter_calendar_ical`).
+    :param cache: The cache of calendars.
+    :param fragment_cache: A separate cache of the vEvents of windowed calendars, so that when the window moves only the
+        new days are generated (see :func:`iter_calendar_ical`).
+    :return: The calendar, gzip-compressed.
+    """
+    key = (normalise_args(args), db.get_version())
+    data = cache.get(key)
+    if data is None:
+        data = gzip.compress(b''.join(iter_calendar_ical(db, **args, fragment_cache=fragment_cache)), mtime=0)
+        cache.put(key, data)
+    return data
+
+
+def calendar_headers(use_gzip: bool, etag: str, last_modified: Optional[datetime]) -> list[tuple[str, str]]:
+    """
+    Get the headers of the response for a calendar.
+
+    :param use_gzip: Whether the calendar is gzip-compressed.
+    :param etag: The (quoted) entity tag of the calendar.
+    :param last_modified: The time the calendar was last modified, if known.
+    :return: A list of tuples of header names and values.
+    """
+    headers = [('Content-Type', 'text/calendar')]
+    if use_gzip:
+        headers.append(('Content-Encoding', 'gzip'))
+    headers.extend([
+        ('Vary', 'Accept-Encoding'),
+        ('Content-Disposition', 'attachment; filename="onthisday.ics"'),
+        ('ETag', etag)
+    ])
+    if last_modified is not None:
+        headers.append(('Last-Modified', http_date(last_modified)))
+    return headers
+
+
+def calendar_response(body: Union[bytes, Iterable[bytes]], use_gzip: bool, etag: str,
+                      last_modified: Optional[datetime], status: int = 200) -> Response:
+    """
+    Create the response for a calendar.
+
+    :param body: The iCalendar data, either as a bytes object or an iterable of chunks of bytes (to be streamed).
+    :param use_gzip: Whether `body` is gzip-compressed.
+    :param etag: The (quoted) entity tag of the calendar.
+    :param last_modified: The time the calendar was last modified, if known.
+    :param status: The status code.
+    :return: The response.
+    """
+    return Response(body, status, headers=calendar_headers(use_gzip, etag, last_modified))
+
+
 @app.route('/calendar')
 def calendar():
     try:
@@ -82,21 +328,74 @@ def calendar():
     except BadArgumentError as e:
         return f'Error parsing input: {e.args[0]}'
 
+    db = app.config['db']
+    use_gzip = request.accept_encodings.quality('gzip') > 0
+    try:
+        etag, last_modified = calendar_validators(db, args, use_gzip)
+        long_calendar = is_long_calendar(args)
+    except ValueError as e:
+        app.logger.exception(e)
+        return GENERATION_ERROR
+    if not is_calendar_modified(request.headers, etag, last_modified):
+        # The client already has this calendar, so there is no need to generate it.
+        return calendar_response(b'', use_gzip, etag, last_modified, 304)
+    if long_calendar:
+        args['executor'] = get_executor()
+
+    cache = app.config.get('cache')
+    if (cache is not None) and is_reproducible(args):
+        try:
+            data = cached_calendar(db, args, cache, app.config.get('fragment_cache'))
+        except Exception as e:
+            app.logger.exception(e)
+            return GENERATION_ERROR
+        return calendar_response(data if use_gzip else gzip.decompress(data), use_gzip, etag, last_modified)
+
     try:
-        cal_str = make_calendar(app.config['db'], **args).to_ical().decode()
+        chunks = iter_calendar_ical(db, **args)
+        # Generate the calendar header and the first day up front, so that any errors caused by the input are caught
+        # here rather than in the middle of the response.
+        head = [next(chunks, b''), next(chunks, b'')]
     except Exception as e:
         app.logger.exception(e)
-        return ('Error generating calendar. Please check your input. If your input is correct, there may be an issue '
-                'on the server side.')
+        return GENERATION_ERROR
 
-    resp = make_response(cal_str)
-    resp.headers['Content-Type'] = 'text/calendar'
-    resp.headers['Content-Disposition'] = 'attachment; filename="onthisday.ics"'
-    return resp
+    # The rest of the calendar is generated (and sent) as the response is streamed to the client.
+    body = chain(head, chunks)
+    if use_gzip:
+        body = gzip_chunks(body)
+    return calendar_response(stream_with_context(body), use_gzip, etag, last_modified)
+
+
+@app.route('/search')
+def search():
+    try:
+        limit = int(request.args.get('limit', DEFAULT_SEARCH_LIMIT))
+        if not 0 < limit <= MAX_SEARCH_LIMIT:
+            raise BadArgumentError(f'The limit must be between 1 and {MAX_SEARCH_LIMIT} (inclusive).')
+        category = request.args.get('category')
+        if (category is not None) and (category not in SEARCH_CATEGORIES):
+            raise BadArgumentError(f'Bad category: {category}')
+        db = get_search_db()
+        if (db is None) or not db.has_fts:
+            return jsonify(error='Search is not available.'), 503
+        results = db.search_events(request.args.get('q', ''), request.args.get('month'),
+                                   int_or_none(request.args.get('date')), SEARCH_CATEGORIES.get(category), limit)
+    except (BadArgumentError, ValueError) as e:
+        app.logger.exception(e)
+        return jsonify(error=f'Error parsing input: {e.args[0]}'), 400
+    return jsonify([
+        {'month': m, 'date': d, 'category': c, 'year': y, 'description': desc}
+        for m, d, c, y, desc in results
+    ])
 
 
-def run(db: Union[DAO, InMemory], host: str, port: int):
+def run(db: Union[DAO, InMemory], host: str, port: int, cache_size: int = DEFAULT_CACHE_SIZE,
+        calendar_workers: Optional[int] = None, fragment_cache_size: int = DEFAULT_FRAGMENT_CACHE_SIZE):
     app.config['db'] = db
+    app.config['cache'] = CalendarCache(cache_size) if cache_size else None
+    app.config['fragment_cache'] = CalendarCache(fragment_cache_size) if fragment_cache_size else None
+    app.config['calendar_workers'] = calendar_workers
     app.run(host, port)
 
 
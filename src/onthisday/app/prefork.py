@@ -0,0 +1,234 @@
+"""
+A simple pre-forking server for the calendar app, for POSIX systems.
+
+The parent process loads the event data once and then forks a number of worker processes, each of which serves
+requests on a shared listening socket. Because the workers are forked after the data is loaded, they share the memory
+holding the data with the parent (copy-on-write). As :class:`InMemory` stores events in a handful of flat arrays rather
+than many small Python objects, those pages are rarely touched by reference counting, so stay shared.
+
+The parent handles the following signals:
+
+- SIGHUP: Reload the event data (eg, after running `otd.py update`), start a new set of workers using the new data and
+  gracefully stop the old workers (each finishes the request it is currently handling, if any). If the data can't be
+  loaded, the error is logged and the old workers carry on serving the old data.
+- SIGTERM, SIGINT: Gracefully stop all workers and exit.
+
+Workers which exit unexpectedly are replaced. If workers keep exiting soon after they start (eg, because of a bad
+configuration), they are replaced after an increasing delay, rather than in a tight loop.
+"""
+
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from typing import Callable, Union, Optional
+
+from flask import Flask
+from onthisday.db import DAO, InMemory
+from werkzeug.serving import make_server
+
+logger = logging.getLogger(__name__)
+
+HANDLED_SIGNALS = {signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD}
+
+# Workers which exit within this many seconds of starting are considered to have crashed on startup.
+MIN_WORKER_LIFETIME = 1.0
+# Delay before replacing the first worker to crash on startup, in seconds. The delay doubles for each further such
+# crash (up to the maximum), and is reset when a worker survives for at least MIN_WORKER_LIFETIME.
+INITIAL_RESPAWN_DELAY = 0.1
+MAX_RESPAWN_DELAY = 30.0
+
+
+class PreforkServer:
+    """
+    Serve a Flask app using multiple pre-forked worker processes.
+
+    :param app: The Flask app to serve.
+    :param load_db: A function which loads the event data (eg, returns an :class:`InMemory` object). Called once at
+        startup and again on each reload.
+    :param host: Host to serve on.
+    :param port: Port to listen on.
+    :param workers: Number of worker processes.
+    """
+
+    def __init__(self, app: Flask, load_db: Callable[[], Union[DAO, InMemory]], host: str, port: int, workers: int):
+        if workers < 1:
+            raise ValueError(f'Number of workers must be an integer greater than 0 (not {workers}).')
+        self.app = app
+        self.load_db = load_db
+        self.host = host
+        self.n_workers = workers
+        self.socket = socket.create_server((host, port))
+        self.socket.set_inheritable(True)
+        self.port = self.socket.getsockname()[1]
+        self.workers: set[int] = set()
+        # Time (from time.monotonic) at which each worker was started
+        self.start_times: dict[int, float] = {}
+        # Number of workers waiting to be replaced, and when to replace them
+        self.pending_workers = 0
+        self.respawn_at = 0.0
+        self.respawn_delay = 0.0
+
+    def _run_worker(self):
+        """
+        Serve requests until told to stop (by SIGTERM). Runs in the worker process.
+        """
+        for sig in (signal.SIGHUP, signal.SIGINT):
+            # The parent handles these (and tells the worker what to do).
+            signal.signal(sig, signal.SIG_IGN)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, HANDLED_SIGNALS)
+        server = make_server(self.host, self.port, self.app, fd=self.socket.fileno())
+
+        def stop(signum, frame):
+            # shutdown() blocks until serve_forever() returns, so must be called from another thread.
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        server.serve_forever()
+        server.server_close()
+
+    def spawn_worker(self) -> int:
+        """
+        Fork a new worker process.
+
+        :return: The PID of the worker.
+        """
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                self._run_worker()
+            except BaseException as e:
+                logger.exception(e)
+                status = 1
+            finally:
+                os._exit(status)
+        self.start_times[pid] = time.monotonic()
+        return pid
+
+    def start_workers(self, db: Optional[Union[DAO, InMemory]] = None):
+        """
+        Start a new set of workers to serve the event data.
+
+        :param db: The event data. If None, it is loaded using `load_db`.
+        """
+        self.app.config['db'] = self.load_db() if db is None else db
+        self.workers = {self.spawn_worker() for _ in range(self.n_workers)}
+        self.pending_workers = 0
+        logger.info(f'Started workers {sorted(self.workers)} on {self.host}:{self.port}.')
+
+    def next_respawn_delay(self, lifetime: float) -> float:
+        """
+        Get the delay before replacing a worker which has exited unexpectedly, and update the delay for next time.
+
+        :param lifetime: How long the worker ran for, in seconds.
+        :return: The delay, in seconds.
+        """
+        if lifetime >= MIN_WORKER_LIFETIME:
+            self.respawn_delay = 0.0
+        else:
+            self.respawn_delay = min(max(2 * self.respawn_delay, INITIAL_RESPAWN_DELAY), MAX_RESPAWN_DELAY)
+        return self.respawn_delay
+
+    def replace_workers(self, pids: set[int]):
+        """
+        Schedule the replacement of workers which have exited unexpectedly.
+
+        :param pids: The PIDs of the workers.
+        """
+        now = time.monotonic()
+        for pid in pids:
+            self.workers.remove(pid)
+            delay = self.next_respawn_delay(now - self.start_times.pop(pid, now))
+            logger.warning(f'Worker {pid} exited unexpectedly; starting a new one in {delay:.1f} seconds.')
+            self.pending_workers += 1
+            self.respawn_at = max(self.respawn_at, now + delay)
+
+    def stop_workers(self, pids: set[int]):
+        """
+        Gracefully stop the given workers.
+
+        :param pids: The PIDs of the workers to stop.
+        """
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reap_workers(self) -> set[int]:
+        """
+        Clean up any worker processes that have exited.
+
+        :return: The PIDs of the workers that have exited.
+        """
+        exited = set()
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            exited.add(pid)
+            if pid not in self.workers:
+                # Old workers (eg, stopped on reload) are not replaced, so their start times are no longer needed.
+                self.start_times.pop(pid, None)
+        return exited
+
+    def wait_for_signal(self) -> Optional[int]:
+        """
+        Wait for one of the handled signals, or until it is time to replace any workers which have exited.
+
+        :return: The signal, or None if it is time to replace workers.
+        """
+        if not self.pending_workers:
+            return signal.sigwait(HANDLED_SIGNALS)
+        timeout = self.respawn_at - time.monotonic()
+        if timeout <= 0:
+            return None
+        info = signal.sigtimedwait(HANDLED_SIGNALS, timeout)
+        return None if info is None else info.si_signo
+
+    def serve_forever(self):
+        """
+        Start the workers and then wait for and handle signals, until told to stop.
+        """
+        # Block the signals we handle so that we can wait for them synchronously (using sigwait) rather than having to
+        # handle them asynchronously. Workers unblock them after forking.
+        signal.pthread_sigmask(signal.SIG_BLOCK, HANDLED_SIGNALS)
+        self.start_workers()
+        try:
+            while True:
+                sig = self.wait_for_signal()
+                if sig is None:
+                    while self.pending_workers:
+                        self.workers.add(self.spawn_worker())
+                        self.pending_workers -= 1
+                elif sig == signal.SIGCHLD:
+                    self.replace_workers(self.reap_workers() & self.workers)
+                elif sig == signal.SIGHUP:
+                    logger.info('Reloading.')
+                    try:
+                        db = self.load_db()
+                    except Exception as e:
+                        logger.exception(e)
+                        logger.error('Failed to reload event data; the old data will continue to be served.')
+                        continue
+                    old_workers = self.workers
+                    self.start_workers(db)
+                    self.stop_workers(old_workers)
+                else:
+                    logger.info('Shutting down.')
+                    break
+        finally:
+            self.stop_workers(self.workers)
+            for pid in self.workers:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+            self.socket.close()
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, HANDLED_SIGNALS)
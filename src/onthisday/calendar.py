@@ -1,9 +1,33 @@
+from concurrent.futures import Executor, ProcessPoolExecutor
 from datetime import date, timedelta, datetime
-from typing import Optional, Generator, Union
+from random import Random
+from typing import Optional, Generator, Union, Callable, TYPE_CHECKING
 
 import pytz
 from icalendar import Calendar, Event
-from onthisday.db import DAO, InMemory
+from icalendar.prop import vDDDTypes, vText
+from onthisday.common_data import escape_text, format_event
+from onthisday.db import DAO, InMemory, EventSampler, topic_tokens
+
+if TYPE_CHECKING:
+    from onthisday.app.cache import CalendarCache
+
+PRODID = '-//OnThisDay//bunburya.eu'
+VERSION = '0.1'
+SUMMARY = 'On This Day'
+
+# Maximum length of a line of iCalendar data, in octets (excluding the line break), per RFC 5545 section 3.1. We fold
+# lines before they reach this length, as the icalendar library does.
+ICAL_LINE_LIMIT = 75
+
+
+class vEscapedText(vText):
+    """
+    An iCalendar TEXT property value which has already been escaped, so is output as-is.
+    """
+
+    def to_ical(self) -> bytes:
+        return self.encode()
 
 
 def date_range(start: date, end: date, step: timedelta = timedelta(days=1)) -> Generator[date, None, None]:
@@ -22,19 +46,138 @@ def date_range(start: date, end: date, step: timedelta = timedelta(days=1)) -> G
         _d += step
 
 
-def make_vevent(db: Union[DAO, InMemory], time: datetime,
-                categories: Optional[dict[str, int]] = None) -> Event:
+def get_categories(categories: Optional[dict[str, int]] = None) -> dict[str, int]:
     """
-    Create a single vEvent with one or more historical events.
+    Get the number of events from each category to include for each day, applying the defaults.
+
+    :param categories: An optional dict mapping each event category name to the number of historical events from
+        that category that should be included. If None, or if the number is None for all categories, a single event
+        from each category will be used for each day.
+    :return: A dict mapping each category name to the number of events from that category to include.
+    """
+    if categories is None:
+        categories = {
+            'Births': 1,
+            'Deaths': 1,
+            'Events': 1,
+            'Holidays and observances': 1
+        }
+
+    if set(categories.values()) == {None}:
+        for c in categories:
+            categories[c] = 1
+
+    return categories
+
+
+def get_date_range(start: Optional[date] = None, end: Optional[date] = None,
+                   window: Optional[tuple[int, int]] = None) -> tuple[date, date]:
+    """
+    Get the first and last dates of a calendar, applying the defaults.
+
+    :param start: The first date to include in the calendar. If None, use today's date.
+    :param end: The last date to include in the calendar. If None, use one year from `start`.
+    :param window: If given, a tuple of the number of days before today and the number of days after today to include
+        in the calendar (a rolling window). `start` and `end` are ignored.
+    :return: A tuple of the start and end dates.
+    """
+    if window is not None:
+        past, future = window
+        today = date.today()
+        return today - timedelta(days=past), today + timedelta(days=future)
+
+    if start is None:
+        start = date.today()
+
+    if end is None:
+        end = date(start.year+1, start.month, start.day) - timedelta(days=1)
+
+    return start, end
+
+
+def check_topic(db: Union[DAO, InMemory], topic: Optional[str]):
+    """
+    Check that events can be filtered by the given topic, which is only possible once they are loaded into memory.
+
+    :param db: The :class:`DAO` or :class:`InMemory` object the events will be retrieved from.
+    :param topic: The topic, if any.
+    :raises ValueError: If a topic is given and `db` is a :class:`DAO`.
+    """
+    if (topic is not None) and isinstance(db, DAO):
+        raise ValueError('Events can only be filtered by topic once they are loaded into memory (see InMemory).')
+
+
+def day_seed(seed: Optional[str], d: date) -> str:
+    """
+    Get the seed for selecting the events for a single day of a windowed calendar, so that the events for each day are
+    the same whichever window the day appears in.
+
+    Without a seed, the seed for a day depends only on the date, so every windowed calendar without a seed (and with the
+    same categories and topic) has the same events on the same day, whoever requests it. This is intended: the server
+    has no way to tell subscribers apart, and it keeps each day's events stable as the window moves and lets the
+    calendar be cached. Subscribers who want different events can give a seed.
+
+    :param seed: The seed for the calendar, if any.
+    :param d: The date.
+    :return: The seed for that date.
+    """
+    if seed is None:
+        return d.isoformat()
+    return f'{seed}:{d.isoformat()}'
+
+
+def day_sources(db: Union[DAO, InMemory], seed: Optional[str], window: Optional[tuple[int, int]]) \
+        -> Callable[[date], tuple[Union[DAO, InMemory, EventSampler], Optional[Random]]]:
+    """
+    Get a function which, given a day of a calendar, returns the object from which to select that day's events and the
+    random number generator with which to select them.
+
+    If `db` is an :class:`InMemory` object (and `window` is not given), events are selected using an
+    :class:`EventSampler`. If `seed` is given, each month of the calendar has its own sampler and random number
+    generator (seeded with `seed` and the month), so that the events selected for a month do not depend on whether the
+    other months are generated along with it (see :func:`make_vevents_in_parallel`). Months do not share any dates, so
+    this does not cause events to be repeated.
 
     :param db: A :class:`DAO` or :class:`InMemory` object to retrieve historical events from the database.
-    :param time: The date and time of the vEvent.
+    :param seed: The seed for the calendar, if any.
+    :param window: The window of the calendar, if any (see :func:`make_calendar`).
+    :return: The function.
+    """
+    if window is not None:
+        return lambda d: (db, Random(day_seed(seed, d)))
+    if seed is None:
+        source = db.sampler() if isinstance(db, InMemory) else db
+        return lambda d: (source, None)
+    sources = {}
+
+    def get_source(d: date) -> tuple[Union[DAO, InMemory, EventSampler], Optional[Random]]:
+        if d.month not in sources:
+            rng = Random(f'{seed}:{d.month}')
+            sources[d.month] = (db.sampler(rng) if isinstance(db, InMemory) else db, rng)
+        return sources[d.month]
+
+    return get_source
+
+
+def sample_events(db: Union[DAO, InMemory, EventSampler], time: date, categories: Optional[dict[str, int]] = None,
+                  rendered: bool = False, rng: Optional[Random] = None, topic: Optional[str] = None) -> dict[str, list]:
+    """
+    Randomly select the historical events to include for a single day.
+
+    :param db: A :class:`DAO`, :class:`InMemory` or :class:`EventSampler` object to retrieve historical events from the
+        database.
+    :param time: The date (or date and time) of the vEvent.
     :param categories: An optional dict mapping each event category name to the number of historical events from
-        that category that should be included. Can be an OrderedDict if you want to enforce the order in which
-        historical events should appear. If None, a single event from each category will be used for each day.
-    :return: The :class:`Event` object.
+        that category that should be included. If None, a single event from each category will be used for each day.
+    :param rendered: If True, return pre-rendered events (see :meth:`InMemory.get_random_events`) rather than tuples.
+        Only supported if `db` is an :class:`InMemory` or :class:`EventSampler` object.
+    :param rng: The random number generator to use. If None, the module-level generator is used.
+    :param topic: If given, only select events matching this topic (see :meth:`InMemory.get_topic_positions`). Only
+        supported if `db` is an :class:`InMemory` or :class:`EventSampler` object.
+    :return: A dict mapping each category name to a list of events from that category.
     """
     events = {}
+    kwargs = {} if topic is None else {'topic': topic}
     month = time.strftime('%B')
     categories = categories or {
         'Births': 1,
@@ -45,31 +188,105 @@ def make_vevent(db: Union[DAO, InMemory], time: datetime,
     for cat in categories:
         count = categories[cat]
         if count:
-            events[cat] = db.get_random_events(month, time.day, cat, count)
+            if rendered:
+                events[cat] = db.get_random_events(month, time.day, cat, count, rendered=True, rng=rng, **kwargs)
+            else:
+                events[cat] = db.get_random_events(month, time.day, cat, count, rng=rng, **kwargs)
+    return events
+
+
+def describe_events(events: dict[str, list[tuple[str, int, str, str, str]]]) -> str:
+    """
+    Create the description of a vEvent from the historical events it contains.
 
+    :param events: A dict mapping each category name to a list of events from that category.
+    :return: The description (as plain text).
+    """
     lines = []
     for cat in events:
         if not events[cat]:
             continue
         lines.append(cat)
         for m, d, c, y, desc in events[cat]:
-            if y:
-                lines.append(f'{y}: {desc}')
-            else:
-                lines.append(desc)
+            lines.append(format_event(y, desc))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def describe_rendered_events(events: dict[str, list[str]]) -> str:
+    """
+    Create the description of a vEvent from pre-rendered historical events (see :meth:`InMemory.get_random_events`).
+
+    :param events: A dict mapping each category name to a list of pre-rendered events from that category.
+    :return: The description, already escaped for use as an iCalendar TEXT value.
+    """
+    lines = []
+    for cat in events:
+        if not events[cat]:
+            continue
+        lines.append(escape_text(cat))
+        lines.extend(events[cat])
         lines.append('')
+    return '\\n'.join(lines)
+
+
+def make_description(db: Union[DAO, InMemory, EventSampler], time: date,
+                     categories: Optional[dict[str, int]] = None, rng: Optional[Random] = None,
+                     topic: Optional[str] = None) -> str:
+    """
+    Randomly select the historical events to include for a single day and create the description of the vEvent. If
+    `db` is an :class:`InMemory` (or :class:`EventSampler`) object, its pre-rendered events are used.
+
+    Arguments are as for :func:`sample_events`.
+
+    :return: The description, already escaped for use as an iCalendar TEXT value.
+    """
+    if isinstance(db, (InMemory, EventSampler)):
+        return describe_rendered_events(sample_events(db, time, categories, rendered=True, rng=rng, topic=topic))
+    else:
+        return escape_text(describe_events(sample_events(db, time, categories, rng=rng, topic=topic)))
+
 
+def make_vevent(db: Union[DAO, InMemory, EventSampler], time: datetime,
+                categories: Optional[dict[str, int]] = None, rng: Optional[Random] = None) -> Event:
+    """
+    Create a single vEvent with one or more historical events.
+
+    :param db: A :class:`DAO`, :class:`InMemory` or :class:`EventSampler` object to retrieve historical events from the
+        database.
+    :param time: The date and time of the vEvent.
+    :param categories: An optional dict mapping each event category name to the number of historical events from
+        that category that should be included. Can be an OrderedDict if you want to enforce the order in which
+        historical events should appear. If None, a single event from each category will be used for each day.
+    :param rng: The random number generator to use. If None, the module-level generator is used.
+    :return: The :class:`Event` object.
+    """
+    return vevent_from_description(time, make_description(db, time, categories, rng))
+
+
+def vevent_from_description(time: datetime, description: str) -> Event:
+    """
+    Create a single vEvent with the given description.
+
+    :param time: The date and time of the vEvent.
+    :param description: The description (already escaped, see :func:`make_description`).
+    :return: The :class:`Event` object.
+    """
     event = Event()
     event.add('dtstart', time)
-    event.add('summary', 'On This Day')
-    event.add('description', '\n'.join(lines))
+    event.add('summary', SUMMARY)
+    event.add('description', vEscapedText(description))
     return event
 
 
 def make_calendar(db: Union[DAO, InMemory], start: date = None, end: date = None, hour: int = 9, minute: int = 0,
-                  tz: pytz.tzinfo.BaseTzInfo = pytz.UTC, categories: Optional[dict[str, int]] = None) -> Calendar:
+                  tz: pytz.tzinfo.BaseTzInfo = pytz.UTC, categories: Optional[dict[str, int]] = None,
+                  seed: Optional[str] = None, window: Optional[tuple[int, int]] = None, topic: Optional[str] = None,
+                  workers: Optional[int] = None, executor: Optional[Executor] = None) -> Calendar:
     """
-    Create a calendar populated with random historical events, daily.
+    Create a calendar populated with random historical events, daily. If `db` is an :class:`InMemory` object (and
+    `window` is not given), the events are selected using an :class:`EventSampler`, so that (eg, in a calendar spanning
+    several years) no event for a date is repeated until all the other events for that date have been used.
 
     :param db: A :class:`DAO` or :class:`InMemory` object to retrieve historical events from the database.
     :param start: The first date to include in the calendar. If None, use today's date.
@@ -80,32 +297,253 @@ def make_calendar(db: Union[DAO, InMemory], start: date = None, end: date = None
     :param categories: An optional dict mapping each event category name to the number of historical events from
         that category that should be included. Can be an OrderedDict if you want to enforce the order in which
         historical events should appear. If None, a single event from each category will be used for each day.
+    :param seed: If given, the events are selected using random number generators seeded with this value (one for each
+        month, see :func:`day_sources`), so that the same arguments (and the same data) always produce the same
+        calendar, whether or not it is generated in parallel.
+    :param window: If given, a tuple of the number of days before today and the number of days after today to include
+        in the calendar (instead of `start` and `end`). The events for each day are selected using a seed derived from
+        `seed` and the date (see :func:`day_seed`), so that each day keeps the same events as the window moves.
+    :param topic: If given, only include events matching this topic (see :meth:`InMemory.get_topic_positions`), eg,
+        "science". Only supported if `db` is an :class:`InMemory` object.
+    :param workers: If given, generate the calendar in parallel using this many worker processes (see
+        :func:`make_vevents_in_parallel`).
+    :param executor: If given, generate the calendar in parallel using this executor (see
+        :func:`make_vevents_in_parallel`). Takes precedence over `workers`.
     :return: The :class:`Calendar` object.
+    :raises ValueError: If `topic` is given and `db` is a :class:`DAO`.
     """
+    check_topic(db, topic)
+    start, end = get_date_range(start, end, window)
+    categories = get_categories(categories)
 
-    if start is None:
-        start = date.today()
+    cal = Calendar()
+    cal.add('prodid', PRODID)
+    cal.add('version', VERSION)
 
-    if end is None:
-        end = date(start.year+1, start.month, start.day) - timedelta(days=1)
+    if (workers is None) and (executor is None):
+        vevents = make_vevents(db, list(date_range(start, end)), hour, minute, tz, categories, seed, window,
+                               topic=topic)
+    else:
+        vevents = make_vevents_in_parallel(db, start, end, hour, minute, tz, categories, seed, window, topic=topic,
+                                           workers=workers, executor=executor)
+    for vevent in vevents:
+        cal.add_component(vevent)
+    return cal
 
-    if categories is None:
-        categories = {
-            'Births': 1,
-            'Deaths': 1,
-            'Events': 1,
-            'Holidays and observances': 1
+
+def make_descriptions(db: Union[DAO, InMemory], dates: list[date], categories: dict[str, int], seed: Optional[str],
+                      window: Optional[tuple[int, int]], topic: Optional[str] = None) -> list[str]:
+    """
+    Randomly select the historical events for the given days of a calendar and create the description of each day's
+    vEvent. The descriptions do not depend on the time or timezone of the vEvents, so can be shared between calendars
+    which differ only in those. Arguments are as for :func:`make_calendar`, plus:
+
+    :param dates: The days for which to create descriptions.
+    :return: A list of descriptions (already escaped, see :func:`make_description`), one for each day.
+    """
+    check_topic(db, topic)
+    get_source = day_sources(db, seed, window)
+    descriptions = []
+    for d in dates:
+        source, rng = get_source(d)
+        descriptions.append(make_description(source, d, categories, rng, topic))
+    return descriptions
+
+
+def make_vevents(db: Union[DAO, InMemory], dates: list[date], hour: int, minute: int, tz: pytz.tzinfo.BaseTzInfo,
+                 categories: dict[str, int], seed: Optional[str], window: Optional[tuple[int, int]],
+                 ical: bool = False, topic: Optional[str] = None) -> list[Union[Event, bytes]]:
+    """
+    Create the vEvents for the given days of a calendar, in order. Arguments are as for :func:`make_calendar`, plus:
+
+    :param dates: The days for which to create vEvents.
+    :param ical: If True, return each vEvent as iCalendar data rather than as an :class:`Event` object (see
+        :func:`iter_calendar_ical`).
+    :return: A list of vEvents, one for each day.
+    """
+    descriptions = make_descriptions(db, dates, categories, seed, window, topic)
+    if ical:
+        dtstart_fmt = dtstart_format(tz)
+    vevents = []
+    for d, description in zip(dates, descriptions):
+        time = datetime(d.year, d.month, d.day, hour, minute, tzinfo=tz)
+        if ical:
+            vevents.append(vevent_ical(time, dtstart_fmt, description))
+        else:
+            vevents.append(vevent_from_description(time, description))
+    return vevents
+
+
+def make_vevents_in_parallel(db: Union[DAO, InMemory], start: date, end: date, hour: int, minute: int,
+                             tz: pytz.tzinfo.BaseTzInfo, categories: dict[str, int], seed: Optional[str],
+                             window: Optional[tuple[int, int]], ical: bool = False, topic: Optional[str] = None,
+                             workers: Optional[int] = None,
+                             executor: Optional[Executor] = None) -> list[Union[Event, bytes]]:
+    """
+    Create the vEvents for each day of a calendar, in parallel.
+
+    The days are split into chunks, one for each month of the year, which are generated in parallel (and then put back
+    in order). So each chunk contains the same dates in each year of the calendar, and events are still not repeated
+    across years (see :class:`EventSampler`). Each month is always generated using its own random number generator
+    (see :func:`day_sources`), so given a seed the calendar is the same however many workers are used, or if it is
+    generated without any workers.
+
+    `db` is pickled and sent to the workers. An :class:`InMemory` object opened from a snapshot is sent as a reference
+    to the snapshot file, which is much quicker than sending a copy of the data.
+
+    Arguments are as for :func:`make_vevents` (with `start` and `end` giving the days of the calendar), plus:
+
+    :param workers: The number of worker processes to use, if `executor` is not given.
+    :param executor: The executor to use. If None, a :class:`ProcessPoolExecutor` is created (and shut down
+        afterwards).
+    :return: A list of vEvents, one for each day.
+    """
+    chunks: dict[int, list[date]] = {}
+    for d in date_range(start, end):
+        chunks.setdefault(d.month, []).append(d)
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(workers)
+    try:
+        futures = {
+            month: executor.submit(make_vevents, db, dates, hour, minute, tz, categories, seed, window, ical, topic)
+            for month, dates in chunks.items()
         }
+        by_date = {}
+        for month, dates in chunks.items():
+            by_date.update(zip(dates, futures[month].result()))
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return [by_date[d] for d in date_range(start, end)]
 
-    if set(categories.values()) == {None}:
-        for c in categories:
-            categories[c] = 1
 
-    cal = Calendar()
-    cal.add('prodid', '-//OnThisDay//bunburya.eu')
-    cal.add('version', '0.1')
+def fold_line(line: str, limit: int = ICAL_LINE_LIMIT) -> bytes:
+    """
+    Encode a single iCalendar content line, folding it as described in RFC 5545 section 3.1 so that no line is
+    `limit` octets or longer. Lines are only ever folded between characters, and (for compatibility with the icalendar
+    library and existing clients) never in the middle of a backslash escape.
+
+    :param line: The content line (without any line break).
+    :param limit: The length (in octets) which lines must be kept below.
+    :return: The folded line, encoded as UTF-8 and terminated with CRLF.
+    """
+    data = line.encode()
+    max_len = limit - 1
+    if len(data) <= max_len:
+        return data + b'\r\n'
+    parts = []
+    start = 0
+    while len(data) - start > max_len:
+        end = start + max_len
+        while (data[end] & 0xC0) == 0x80:
+            # Don't split a multi-byte character.
+            end -= 1
+        if data[end - 1] in b'\\^':
+            end -= 1
+        parts.append(data[start:end])
+        start = end
+    parts.append(data[start:])
+    return b'\r\n '.join(parts) + b'\r\n'
+
+
+SUMMARY_LINE = fold_line(f'SUMMARY:{escape_text(SUMMARY)}')
 
+
+def dtstart_format(tz: pytz.tzinfo.BaseTzInfo) -> str:
+    """
+    Get a :meth:`datetime.strftime` format string that produces a DTSTART content line for a time in the given
+    timezone, using the same representation as the icalendar library (ie, a UTC time if the timezone is equivalent to
+    UTC, or a local time with a TZID parameter otherwise).
+
+    :param tz: The timezone.
+    :return: The format string.
+    """
+    probe = vDDDTypes(datetime(2000, 1, 1, tzinfo=tz))
+    if probe.to_ical().endswith(b'Z'):
+        return 'DTSTART:%Y%m%dT%H%M%SZ'
+    tzid = probe.params['TZID'].replace('%', '%%')
+    return f'DTSTART;TZID={tzid}:%Y%m%dT%H%M%S'
+
+
+def vevent_ical(time: datetime, dtstart_fmt: str, description: str) -> bytes:
+    """
+    Create a single vEvent with the given description, as iCalendar data. This is equivalent to calling
+    `vevent_from_description(...).to_ical()`.
+
+    :param time: The date and time of the vEvent.
+    :param dtstart_fmt: The format of the DTSTART line (see :func:`dtstart_format`).
+    :param description: The description (already escaped, see :func:`make_description`).
+    :return: The vEvent, as bytes.
+    """
+    return b''.join((
+        b'BEGIN:VEVENT\r\n',
+        SUMMARY_LINE,
+        fold_line(time.strftime(dtstart_fmt)),
+        fold_line(f'DESCRIPTION:{description}'),
+        b'END:VEVENT\r\n'
+    ))
+
+
+def iter_calendar_ical(db: Union[DAO, InMemory], start: date = None, end: date = None, hour: int = 9,
+                       minute: int = 0, tz: pytz.tzinfo.BaseTzInfo = pytz.UTC,
+                       categories: Optional[dict[str, int]] = None, seed: Optional[str] = None,
+                       window: Optional[tuple[int, int]] = None, topic: Optional[str] = None,
+                       workers: Optional[int] = None, executor: Optional[Executor] = None,
+                       fragment_cache: Optional['CalendarCache'] = None) -> Generator[bytes, None, None]:
+    """
+    Generate a calendar populated with random historical events, daily, as iCalendar data.
+
+    This is equivalent to calling `make_calendar(...).to_ical()` (and produces data in the same form), but writes the
+    iCalendar data directly rather than building :class:`Event` objects, and yields it in chunks (one per day) as it is
+    generated rather than building the whole calendar in memory (except when generating it in parallel). Arguments are
+    as for :func:`make_calendar`, plus:
+
+    :param fragment_cache: A cache in which to store the vEvent for each day of a windowed calendar, so that when the
+        window moves, only the newly included days need to be generated. Only used if `window` is given and the
+        calendar is not generated in parallel. A long window adds many small entries, so this should not be the cache
+        used for whole calendars, which they would otherwise evict.
+    :return: A generator of chunks of iCalendar data, as bytes.
+    """
+    check_topic(db, topic)
+    start, end = get_date_range(start, end, window)
+    categories = get_categories(categories)
+    header = b''.join((
+        b'BEGIN:VCALENDAR\r\n',
+        fold_line(f'VERSION:{VERSION}'),
+        fold_line(f'PRODID:{PRODID}')
+    ))
+
+    if (workers is not None) or (executor is not None):
+        vevents = make_vevents_in_parallel(db, start, end, hour, minute, tz, categories, seed, window, ical=True,
+                                           topic=topic, workers=workers, executor=executor)
+        yield header
+        yield from vevents
+        yield b'END:VCALENDAR\r\n'
+        return
+
+    get_source = day_sources(db, seed, window)
+    dtstart_fmt = dtstart_format(tz)
+    if window is None:
+        fragment_cache = None
+    else:
+        # Everything (other than the date) that the vEvent for a day depends on.
+        fragment_key = (dtstart_fmt, hour, minute, tuple(categories.items()), seed,
+                        None if topic is None else topic_tokens(topic), db.get_version())
+
+    yield header
     for d in date_range(start, end):
+        if fragment_cache is not None:
+            key = (d, fragment_key)
+            vevent = fragment_cache.get(key)
+            if vevent is not None:
+                yield vevent
+                continue
         time = datetime(d.year, d.month, d.day, hour, minute, tzinfo=tz)
-        cal.add_component(make_vevent(db, time, categories))
-    return cal
+        source, rng = get_source(d)
+        vevent = vevent_ical(time, dtstart_fmt, make_description(source, time, categories, rng, topic))
+        if fragment_cache is not None:
+            fragment_cache.put(key, vevent)
+        yield vevent
+    yield b'END:VCALENDAR\r\n'
@@ -1,3 +1,4 @@
+import re
 from datetime import date, datetime
 from typing import Generator, Optional, Any
 
@@ -25,6 +26,12 @@ def iter_dates() -> Generator[tuple[str, int], None, None]:
         for d in range(MONTH_DAYS[m]):
             yield m, d + 1
 
+# Matches a backslash escape in iCalendar TEXT values.
+ICAL_ESCAPE_RE = re.compile(r'\\(.)')
+
+# Matches the year of an event as displayed on Wikipedia, eg, "1066", "AD 79", "44 BC" or "c. 1500".
+YEAR_RE = re.compile(r'(?:c\.\s*)?(?:AD\s*)?(\d+)(\s*BCE?)?')
+
 EMPTY_EVENT_DICT = {
     'Events': [],
     'Births': [],
@@ -56,4 +63,58 @@ def int_or_none(a: Optional[Any]) -> Optional[int]:
     if a is None:
         return None
     else:
-        return int(a)
\ No newline at end of file
+        return int(a)
+
+def parse_year(year: str) -> Optional[int]:
+    """
+    Convert the year of an event (as displayed, see :data:`YEAR_RE`) to a signed integer, with years BC being negative
+    (so "44 BC" is -44).
+
+    :param year: The year, as displayed.
+    :return: The year as an integer, or None if the year is empty or not in a recognised form.
+    """
+    match = YEAR_RE.fullmatch(year)
+    if match is None:
+        return None
+    n = int(match.group(1))
+    return -n if match.group(2) else n
+
+def format_event(year: str, desc: str) -> str:
+    """
+    Format a historical event for display.
+
+    :param year: The year of the event (may be empty, eg, for holidays).
+    :param desc: The description of the event.
+    :return: The formatted event.
+    """
+    if year:
+        return f'{year}: {desc}'
+    else:
+        return desc
+
+def escape_text(text: str) -> str:
+    """
+    Escape a string for use as an iCalendar TEXT value, per RFC 5545 section 3.3.11.
+
+    :param text: The text to escape.
+    :return: The escaped text.
+    """
+    # NB: Order matters here.
+    return (text.replace('\\N', '\n')
+            .replace('\\', '\\\\')
+            .replace(';', '\\;')
+            .replace(',', '\\,')
+            .replace('\r\n', '\n')
+            .replace('\n', '\\n')
+            .replace('\r', '\\n'))
+
+def unescape_text(text: str) -> str:
+    """
+    Reverse the escaping performed by :func:`escape_text`. (Line breaks are always unescaped to "\\n", so line breaks in
+    any other form, or a literal "\\N", in the original text are not restored exactly. :class:`InMemory` keeps such
+    text as it is.)
+
+    :param text: The escaped text.
+    :return: The unescaped text.
+    """
+    return ICAL_ESCAPE_RE.sub(lambda m: '\n' if m.group(1) in 'nN' else m.group(1), text)
@@ -1,32 +1,101 @@
+import hashlib
+import json
+import logging
+import mmap
 import os
+import random
+import re
 import sqlite3
-from random import sample
-from typing import Optional, Any
+import struct
+import sys
+import threading
+import time
+from array import array
+from functools import lru_cache
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime, timezone
+from itertools import accumulate
+from typing import Optional, Any, Generator, Sequence
 
 import appdirs
-from onthisday.common_data import MONTH_DAYS, EMPTY_EVENT_DICT
+from onthisday.common_data import MONTH_DAYS, EMPTY_EVENT_DICT, escape_text, format_event, iter_dates, \
+    unescape_text, parse_year
 
+logger = logging.getLogger(__name__)
 
-def build_select(table: str, *cols: str, **criteria: str) -> str:
+# Default maximum number of results returned by a full-text search (see :meth:`DAO.search_events`).
+DEFAULT_SEARCH_LIMIT = 20
+
+# Matches a word (token) of an event description or topic (see :func:`topic_tokens`).
+TOKEN_RE = re.compile(r'\w+')
+
+
+class SnapshotError(Exception):
+    """
+    A snapshot file could not be used, eg, because it is invalid or out of date.
+    """
+    pass
+
+
+class SearchUnavailableError(Exception):
+    """
+    Events cannot be searched, because the installed SQLite library does not include the FTS5 extension.
+    """
+    pass
+
+
+@lru_cache(maxsize=None)
+def fts5_available() -> bool:
+    """
+    Check whether the installed SQLite library includes the FTS5 extension, which is needed for the full-text index of
+    events (see :meth:`DAO.search_events`). The check is only done once per process.
+
+    :return: True if FTS5 is available, otherwise False.
+    """
+    probe = sqlite3.connect(':memory:')
+    try:
+        probe.execute('CREATE VIRTUAL TABLE fts5_probe USING fts5(text)')
+    except sqlite3.OperationalError:
+        logger.warning('SQLite does not include the FTS5 extension, so events cannot be searched.')
+        return False
+    finally:
+        probe.close()
+    return True
+
+def build_select(table: str, *cols: str, conditions: Sequence[tuple[str, tuple[Any, ...]]] = (),
+                 order_by: Optional[str] = None, **criteria: Any) -> tuple[str, tuple[Any, ...]]:
     """
     Build an SQL SELECT query based on the given parameters.
 
-    NOTE: Neither `table` nor `cols` are escaped or otherwise sanitised, so only pass trusted arguments.
+    The values in `criteria` are not included in the query itself; they are returned separately, to be passed as bound
+    parameters when executing the query. This means the query string is the same for any given combination of criteria
+    names, so that it can be reused from sqlite3's statement cache.
+
+    NOTE: Neither `table` nor `cols` (nor the names of the criteria, the conditions or `order_by`) are escaped or
+    otherwise sanitised, so only pass trusted arguments.
 
     :param table: The name of the table to query.
     :param cols: Names of the columns to return.
+    :param conditions: Any further conditions to apply, other than equality, as (expression, parameters) pairs, eg,
+        `('year_int >= ?', (1900,))`. These are combined with the criteria using AND.
+    :param order_by: The expression to order the results by, if any.
     :param criteria: Keyword arguments specifying the criteria to use, ie, X and Y in "WHERE X = Y".
-    :return: The full SELECT query.
+    :return: A tuple containing the full SELECT query and the parameters to execute it with.
     """
     col_names = ', '.join(cols)
     query = f'SELECT {col_names} FROM {table}'
-    if criteria:
-        criteria_parts = []
-        for k in criteria:
-            criteria_parts.append(f'{k} = "{criteria[k]}"')
+    criteria_parts = [f'{k} = ?' for k in criteria]
+    params = tuple(criteria.values())
+    for expr, cond_params in conditions:
+        criteria_parts.append(expr)
+        params += tuple(cond_params)
+    if criteria_parts:
         criteria_str = ' AND '.join(criteria_parts)
         query += f' WHERE {criteria_str}'
-    return query
+    if order_by is not None:
+        query += f' ORDER BY {order_by}'
+    return query, params
 
 
 def validate_criteria(**kwargs: Any) -> dict[str, Any]:
@@ -64,15 +133,18 @@ def validate_criteria(**kwargs: Any) -> dict[str, Any]:
     return valid
 
 
-def get_event_query(month: Optional[str] = None, date: Optional[int] = None,
-                    event_category: Optional[str] = None) -> str:
+def get_event_query(month: Optional[str] = None, date: Optional[int] = None, event_category: Optional[str] = None,
+                    conditions: Sequence[tuple[str, tuple[Any, ...]]] = (),
+                    order_by: Optional[str] = None) -> tuple[str, tuple[Any, ...]]:
     """
     Create an SQL query to get events matching the given criteria.
 
     :param month: The month of the event.
     :param date: The date (day of the month) of the event.
     :param event_category: The event category ("Births", "Deaths", "Events", "Holidays and observances").
-    :return: The SQL query.
+    :param conditions: Any further conditions to apply (see :func:`build_select`).
+    :param order_by: The expression to order the results by, if any.
+    :return: A tuple containing the SQL query and the parameters to execute it with.
     """
     criteria = {}
     if month is not None:
@@ -82,7 +154,31 @@ def get_event_query(month: Optional[str] = None, date: Optional[int] = None,
     if event_category is not None:
         criteria['event_category'] = event_category
     criteria = validate_criteria(**criteria)
-    return build_select('events', 'month', 'date', 'event_category', 'year', 'description', **criteria)
+    return build_select('events', 'month', 'date', 'event_category', 'year', 'description', conditions=conditions,
+                        order_by=order_by, **criteria)
+
+
+def fts_query(text: str) -> str:
+    """
+    Convert free text (eg, entered by a user) to an FTS5 query matching events whose descriptions contain all of its
+    words. Each word is quoted, so punctuation and FTS5 operators in the text are not interpreted.
+
+    :param text: The text to search for.
+    :return: The FTS5 query (which is empty if the text contains no words).
+    """
+    return ' '.join(f'"{word}"' for word in TOKEN_RE.findall(text))
+
+
+def topic_tokens(topic: str) -> tuple[str, ...]:
+    """
+    Split a topic (eg, "science" or "jazz music") into the tokens which the descriptions of matching events must
+    contain. Tokens are whole words, matched regardless of case.
+
+    :param topic: The topic.
+    :return: The distinct tokens of the topic, in sorted order (so topics which match the same events have the same
+        tokens). Empty if the topic contains no words.
+    """
+    return tuple(sorted(set(TOKEN_RE.findall(topic.casefold()))))
 
 
 class DAO:
@@ -100,7 +196,8 @@ class DAO:
             rev_id INTEGER NOT NULL,
             event_category TEXT NOT NULL COLLATE NOCASE,
             year TEXT NOT NULL COLLATE NOCASE,
-            description TEXT NOT NULL
+            description TEXT NOT NULL,
+            year_int INTEGER
         )
     """
 
@@ -115,9 +212,73 @@ class DAO:
         
     """
 
+    # Covering index for looking up events by date and category, so that those lookups (which is almost all of them) can
+    # be answered from the index without a full table scan.
+    OTD_EVENT_INDEX = """
+        CREATE INDEX IF NOT EXISTS events_by_date_category
+        ON events(month, date, event_category, year, description)
+    """
+
+    # Indexes for looking up events by (signed) year, on a given date or across all dates.
+    OTD_EVENT_YEAR_INDEXES = (
+        """
+        CREATE INDEX IF NOT EXISTS events_by_date_year
+        ON events(month, date, year_int)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS events_by_year
+        ON events(year_int)
+        """
+    )
+
+    ADD_YEAR_INT_COLUMN = """
+        ALTER TABLE events ADD COLUMN year_int INTEGER
+    """
+
+    SET_YEAR_INTS = """
+        UPDATE events SET year_int = parse_year(year)
+    """
+
     INSERT_OTD_EVENT = """
-        INSERT INTO events(month, date, rev_id, event_category, year, description)
-        VALUES (?, ?, ?, ?, ?, ?)
+        INSERT INTO events(month, date, rev_id, event_category, year, description, year_int)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """
+
+    # Full-text index of event descriptions. The descriptions themselves are only stored in the events table.
+    OTD_EVENT_FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS events_fts
+        USING fts5(description, content='events', content_rowid='id', tokenize='porter unicode61')
+    """
+
+    CHECK_EVENT_FTS = """
+        SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'events_fts'
+    """
+
+    REBUILD_EVENT_FTS = """
+        INSERT INTO events_fts(events_fts) VALUES ('rebuild')
+    """
+
+    GET_MAX_EVENT_ID = """
+        SELECT COALESCE(MAX(id), 0) FROM events
+    """
+
+    INSERT_OTD_EVENTS_FTS = """
+        INSERT INTO events_fts(rowid, description) SELECT id, description FROM events WHERE id > ?
+    """
+
+    DELETE_OTD_EVENTS_FTS = """
+        INSERT INTO events_fts(events_fts, rowid, description)
+        SELECT 'delete', id, description FROM events WHERE month = ? AND date = ?
+    """
+
+    DELETE_OTD_EVENTS = """
+        DELETE FROM events WHERE month = ? AND date = ?
+    """
+
+    SEARCH_EVENTS = """
+        SELECT events.month, events.date, events.event_category, events.year, events.description
+        FROM events_fts JOIN events ON events.id = events_fts.rowid
+        WHERE events_fts MATCH ?
     """
 
     INSERT_OTD_REVISION = """
@@ -128,12 +289,37 @@ class DAO:
         SELECT rev_id FROM revisions WHERE month = ? AND date = ?
     """
 
+    GET_EVENT_COUNTS = """
+        SELECT month, date, event_category, COUNT(*) FROM events GROUP BY month, date, event_category
+    """
+
+    GET_EVENT_AT_OFFSET = """
+        SELECT month, date, event_category, year, description FROM events
+        WHERE month = ? AND date = ? AND event_category = ?
+        LIMIT 1 OFFSET ?
+    """
+
+    GET_ALL_REVISIONS = """
+        SELECT month, date, rev_id FROM revisions ORDER BY month, date
+    """
+
+    GET_EVENTS_SUMMARY = """
+        SELECT COUNT(*), MAX(id) FROM events
+    """
+
+    GET_ALL_EVENTS_ORDERED = """
+        SELECT month, date, event_category, year, description FROM events ORDER BY id
+    """
+
     def __init__(self, db_fpath: Optional[str] = None):
         if db_fpath is None:
             db_fpath = self.get_default_db_fpath()
         self.db_fpath = db_fpath
         self.db = sqlite3.connect(db_fpath)
         self.create_tables()
+        # Number of events for each (month, date, category), used for random sampling. Loaded lazily and reset whenever
+        # events are inserted.
+        self._event_counts: Optional[dict[tuple[str, int, str], int]] = None
 
     def get_default_db_fpath(self, make_dirs: bool = True):
         """
@@ -149,9 +335,37 @@ class DAO:
             os.makedirs(db_dir)
         return os.path.join(db_dir, 'onthisday.db')
 
+    def get_default_snapshot_fpath(self) -> str:
+        """
+        Get the default path to the snapshot file (see :meth:`InMemory.write_snapshot`) for this database, which is
+        alongside the database file.
+
+        :return: The path to the snapshot file (the file itself is not guaranteed to exist).
+        """
+        return os.path.splitext(self.db_fpath)[0] + '.snapshot'
+
     def create_tables(self):
+        """
+        Create the database tables and indexes, if they don't already exist. Indexes are created on existing databases,
+        too, so this also serves to migrate databases created by older versions. The full-text index is only created
+        (and kept up to date) if SQLite includes FTS5 (see :func:`fts5_available`).
+        """
         self.db.execute(self.OTD_EVENT_SCHEMA)
         self.db.execute(self.OTD_REVISIONS_SCHEMA)
+        if 'year_int' not in [row[1] for row in self.db.execute('PRAGMA table_info(events)')]:
+            logger.info('Adding signed years to events table.')
+            self.db.execute(self.ADD_YEAR_INT_COLUMN)
+            self.db.create_function('parse_year', 1, parse_year, deterministic=True)
+            self.db.execute(self.SET_YEAR_INTS)
+        self.db.execute(self.OTD_EVENT_INDEX)
+        for index in self.OTD_EVENT_YEAR_INDEXES:
+            self.db.execute(index)
+        self.has_fts = fts5_available()
+        if self.has_fts and (self.db.execute(self.CHECK_EVENT_FTS).fetchone() is None):
+            logger.info('Building full-text index of events.')
+            self.db.execute(self.OTD_EVENT_FTS_SCHEMA)
+            self.db.execute(self.REBUILD_EVENT_FTS)
+        self.db.commit()
 
     def insert_events(self, month: str, date: int, rev_id: int, event: dict[str, list[tuple[str, str]]]) -> int:
         """
@@ -160,15 +374,40 @@ class DAO:
         :param month: The month of the event.
         :param date: The date (day of month) of the event.
         :param rev_id: The revision ID of the Wikipedia page where we found the event.
-        :param event: A dict containing the event information. NB: The dict is modified in the process.
+        :param event: A dict containing the event information.
+        :return: The number of events inserted.
+        """
+        self._event_counts = None
+        max_id = self.db.execute(self.GET_MAX_EVENT_ID).fetchone()[0]
+        cursor = self.db.executemany(
+            self.INSERT_OTD_EVENT,
+            ((month, date, rev_id, evt_cat, year, desc, parse_year(year))
+             for evt_cat in event for year, desc in event[evt_cat])
+        )
+        n = cursor.rowcount
+        if self.has_fts:
+            self.db.execute(self.INSERT_OTD_EVENTS_FTS, (max_id,))
+        return n
+
+    def replace_events(self, month: str, date: int, rev_id: int, event: dict[str, list[tuple[str, str]]]) -> int:
+        """
+        Replace all events stored for the given date with the given events (from a new revision of the relevant
+        Wikipedia page), and record the new revision ID. This is all done in a single transaction, which is committed
+        when this method returns (or rolled back if an error occurs).
+
+        :param month: The month of the event.
+        :param date: The date (day of month) of the event.
+        :param rev_id: The revision ID of the Wikipedia page where we found the event.
+        :param event: A dict containing the event information.
         :return: The number of events inserted.
         """
-        counter = 0
-        for evt_cat in event:
-            for year, desc in event[evt_cat]:
-                self.db.execute(self.INSERT_OTD_EVENT, (month, date, rev_id, evt_cat, year, desc))
-                counter += 1
-        return counter
+        with self.db:
+            if self.has_fts:
+                self.db.execute(self.DELETE_OTD_EVENTS_FTS, (month, date))
+            self.db.execute(self.DELETE_OTD_EVENTS, (month, date))
+            n = self.insert_events(month, date, rev_id, event)
+            self.insert_revision(month, date, rev_id)
+        return n
 
     def insert_revision(self, month: str, date: int, rev_id: int):
         """
@@ -191,11 +430,28 @@ class DAO:
             result = result[0]
         return result
 
+    def get_event_counts(self) -> dict[tuple[str, int, str], int]:
+        """
+        Get the number of events stored for each combination of month, date and category. The counts are read from the
+        database the first time this method is called (and again after any events are inserted) and cached thereafter.
+
+        :return: A dict mapping (month, date, category) tuples to the number of events for that month, date and
+            category. Combinations with no events are not included.
+        """
+        if self._event_counts is None:
+            self._event_counts = {(m, d, c): n for m, d, c, n in self.db.execute(self.GET_EVENT_COUNTS)}
+        return self._event_counts
+
     def get_random_events(self, month: Optional[str] = None, date: Optional[int] = None,
-                          event_category: Optional[str] = None, count: int = 1) -> list[tuple[str, str]]:
+                          event_category: Optional[str] = None, count: int = 1,
+                          rng: Optional[random.Random] = None) -> list[tuple[str, str]]:
         """
         Return `n` random events for the given date, based on the given criteria.
 
+        Rather than sorting all matching events randomly, this picks random positions using the cached event counts
+        (see :meth:`get_event_counts`) and looks up the event at each position using the index, so the time taken does
+        not depend on the size of the database.
+
         NOTE: This function is more flexible, but slower, than the equivalent method of the :class:`InMemory` class. For
         generating calendars, use that method instead.
 
@@ -204,6 +460,8 @@ class DAO:
         :param event_category: The event category ("Births", "Deaths", "Events", "Holidays and observances"). If None,
             a random category will be chosen.
         :param count: The number of events to return.
+        :param rng: The random number generator to use (eg, a seeded :class:`Random` object, for reproducible results).
+            If None, the module-level generator is used.
         :return: A list, of length `n`, of events (as tuples comprised of year + description).
         """
         try:
@@ -212,9 +470,42 @@ class DAO:
             raise ValueError(f'Count must be an integer greater than 0 (not {count}).')
         if count < 1:
             raise ValueError(f'Count must be an integer greater than 0 (not {count}).')
-        base_query = get_event_query(month, date, event_category)
-        full_query = f'{base_query} ORDER BY RANDOM() LIMIT {int(count)}'
-        return self.db.execute(full_query).fetchall()
+        criteria = {}
+        if month is not None:
+            criteria['month'] = month
+        if date is not None:
+            criteria['date'] = date
+        if event_category is not None:
+            criteria['event_category'] = event_category
+        criteria = validate_criteria(**criteria)
+
+        counts = self.get_event_counts()
+        if len(criteria) == 3:
+            # Fast path for a fully specified date and category (eg, when generating calendars)
+            key = (criteria['month'], criteria['date'], criteria['event_category'])
+            groups = [key] if key in counts else []
+        else:
+            groups = [
+                (m, d, c) for m, d, c in counts
+                if (criteria.get('month', m) == m)
+                and (criteria.get('date', d) == d)
+                and (criteria.get('event_category', c) == c)
+            ]
+        if not groups:
+            return []
+
+        # Choose random positions in the (conceptual) concatenation of all matching groups, then find the group and the
+        # offset within that group that corresponds to each position.
+        bounds = list(accumulate(counts[g] for g in groups))
+        results = []
+        for pos in (rng or random).sample(range(bounds[-1]), min(count, bounds[-1])):
+            i = bisect_right(bounds, pos)
+            offset = pos - (bounds[i - 1] if i else 0)
+            row = self.db.execute(self.GET_EVENT_AT_OFFSET, groups[i] + (offset,)).fetchone()
+            if row is not None:
+                # Row could be missing if events were deleted by another connection since the counts were loaded.
+                results.append(row)
+        return results
 
     def get_all_events(self, month: Optional[str] = None, date: Optional[int] = None,
                        event_category: Optional[str] = None) -> list[tuple[str, str]]:
@@ -226,30 +517,586 @@ class DAO:
         :param event_category: The event category ("Births", "Deaths", "Events", "Holidays and observances").
         :return: A list, of length `n`, of events (as tuples comprised of year + description).
         """
-        return self.db.execute(get_event_query(month, date, event_category)).fetchall()
+        return self.db.execute(*get_event_query(month, date, event_category)).fetchall()
+
+    def get_events_by_year(self, start: Optional[int] = None, end: Optional[int] = None, month: Optional[str] = None,
+                           date: Optional[int] = None,
+                           event_category: Optional[str] = None) -> list[tuple[str, int, str, str, str]]:
+        """
+        Return all events in a range of years (and matching the other given criteria), in order of year. Only events
+        with a recognised year (see :func:`parse_year`) are returned. The range is looked up using an index, so this
+        does not scan the whole table.
+
+        :param start: The first year of the range (inclusive), with years BC being negative. If None, the range is
+            unbounded below.
+        :param end: The last year of the range (inclusive). If None, the range is unbounded above.
+        :param month: The month of the event.
+        :param date: The date (day of the month) of the event.
+        :param event_category: The event category ("Births", "Deaths", "Events", "Holidays and observances").
+        :return: A list of events (as tuples comprised of month, date, category, year and description).
+        """
+        conditions = [('year_int IS NOT NULL', ())]
+        if start is not None:
+            conditions.append(('year_int >= ?', (int(start),)))
+        if end is not None:
+            conditions.append(('year_int <= ?', (int(end),)))
+        query = get_event_query(month, date, event_category, conditions=conditions, order_by='year_int, id')
+        return self.db.execute(*query).fetchall()
+
+    def search_events(self, query: str, month: Optional[str] = None, date: Optional[int] = None,
+                      event_category: Optional[str] = None,
+                      limit: int = DEFAULT_SEARCH_LIMIT) -> list[tuple[str, int, str, str, str]]:
+        """
+        Search the descriptions of events for the given words, using the full-text index. Words are matched
+        regardless of case and ending (eg, "paint" matches "painted" and "Painting").
+
+        :param query: The words to search for. Only events whose descriptions contain all of the words are returned.
+        :param month: The month of the event.
+        :param date: The date (day of the month) of the event.
+        :param event_category: The event category ("Births", "Deaths", "Events", "Holidays and observances").
+        :param limit: The maximum number of events to return.
+        :return: A list of events (as tuples comprised of month, date, category, year and description), best matches
+            first.
+        :raises SearchUnavailableError: If SQLite does not include FTS5, so there is no full-text index.
+        """
+        if not self.has_fts:
+            raise SearchUnavailableError('Search requires SQLite with the FTS5 extension.')
+        match = fts_query(query)
+        if not match:
+            return []
+        criteria = {}
+        if month is not None:
+            criteria['month'] = month
+        if date is not None:
+            criteria['date'] = date
+        if event_category is not None:
+            criteria['event_category'] = event_category
+        criteria = validate_criteria(**criteria)
+        sql = self.SEARCH_EVENTS + ''.join(f' AND events.{k} = ?' for k in criteria) + ' ORDER BY rank LIMIT ?'
+        return self.db.execute(sql, (match, *criteria.values(), int(limit))).fetchall()
+
+    def iter_all_events(self) -> Generator[tuple[str, int, str, str, str], None, None]:
+        """
+        Iterate over every event in the database, in a single scan of the events table (in insertion order). Rows are
+        yielded as they are read, so the full table is never held in memory at once.
+
+        :return: A generator of events (as tuples comprised of month, date, category, year and description).
+        """
+        yield from self.db.execute(self.GET_ALL_EVENTS_ORDERED)
+
+    def get_version(self) -> str:
+        """
+        Get a string identifying the current version of the data in the database. The version is derived from the
+        revision IDs stored for each date, along with the number of events and the highest event ID (so that events
+        that have been rebuilt without a change of revision, eg, using :func:`reparse_all_to_db`, also change the
+        version).
+
+        :return: The version, as a hex digest.
+        """
+        h = hashlib.sha256()
+        for m, d, rev_id in self.db.execute(self.GET_ALL_REVISIONS):
+            h.update(f'{m}:{d}:{rev_id};'.encode())
+        count, max_id = self.db.execute(self.GET_EVENTS_SUMMARY).fetchone()
+        h.update(f'{count}:{max_id}'.encode())
+        return h.hexdigest()
+
+    def get_last_modified(self) -> Optional[datetime]:
+        """
+        Get the time at which the database was last modified (ie, the modification time of the database file).
+
+        :return: The time (in UTC), or None if the database is not stored in a file.
+        """
+        try:
+            return datetime.fromtimestamp(os.path.getmtime(self.db_fpath), timezone.utc)
+        except OSError:
+            return None
 
     def commit(self):
         self.db.commit()
 
+    def __reduce__(self):
+        # The connection can't be pickled, so when unpickled (eg, in another process) reconnect to the same database.
+        return self.__class__, (self.db_fpath,)
+
 
 class InMemory:
     """
     Holds all events in-memory for quick retrieval.
 
+    The events are loaded using a single scan of the events table. The number of rows read and the time taken to load
+    them are logged and stored in the `row_count` and `load_time` attributes, respectively.
+
+    Each event is stored pre-rendered (formatted for display and escaped for use in iCalendar data), so that it does
+    not need to be rendered again every time it is used in a calendar. The plain description is recovered from the
+    pre-rendered event when needed (except for the few descriptions which escaping does not preserve exactly, see
+    :func:`unescape_text`, which are stored as they are).
+
+    To keep memory usage (and garbage collection overhead) low, events are not stored as Python objects. Instead, they
+    are sorted by date and category, and the pre-rendered events are stored in a single UTF-8 encoded :class:`bytes`
+    object, with the offset of each event stored in an :class:`array.array`. Years are stored as integers in another
+    array. Another array stores, for each (date, category) pair, the position of the first event for that date and
+    category, so that the events for any date and category can be found by looking up two consecutive entries. The
+    arrays are built as the events are read, without holding all the rows as Python objects at any point.
+
+    Most of the memory used is the text of the events themselves, which is not compressed, so this uses about half
+    (including the topic index described below), or a third (excluding it), of the memory used by a dict of lists of
+    year and description tuples. Use `otd.py --memtest` to compare the two.
+
+    Events can be filtered by topic (see :meth:`get_group_positions`) using an inverted index, built when the events
+    are loaded, which maps each token (see :func:`topic_tokens`) of the events' descriptions to the positions of the
+    events containing it. As events are sorted by date and category, so are the positions, and the events for a topic
+    and any date and category can be found in the same way as the unfiltered events. The tokens are stored sorted, in a
+    single :class:`bytes` object, and the positions in a single array.
+
+    These arrays can be written to a snapshot file (see :meth:`write_snapshot`), which can be opened using
+    :meth:`from_snapshot` much faster than loading the events from the database. The snapshot is memory-mapped rather
+    than read, so processes that open the same snapshot share the same memory (the operating system's page cache).
+
     :param db: The :class:`DAO` object for loading events from the database.
     """
 
+    # Value stored in the year array for events with no year (eg, holidays).
+    NO_YEAR = -2 ** 31
+
+    SNAPSHOT_MAGIC = b'OTDSNAP3'
+    # Magic, byte order, number of groups, number of events, length of odd years and descriptions data, length of
+    # rendered data, number of tokens, length of token data, number of token positions and database version
+    SNAPSHOT_HEADER = struct.Struct('<8s8sIIIIIII64s')
+
+    # Maximum number of topics for which matching events are cached (see :meth:`get_topic_positions`).
+    TOPIC_CACHE_SIZE = 256
+
+    DATES = list(iter_dates())
+    CATEGORIES = list(EMPTY_EVENT_DICT)
+    # Maps each (month, date) pair to the index of the date in the year, and each category to its index.
+    DATE_INDEX = {md: i for i, md in enumerate(DATES)}
+    CATEGORY_INDEX = {c: i for i, c in enumerate(CATEGORIES)}
+
     def __init__(self, db: DAO):
         self.db = db
-        self.events = {}
-        for m in MONTH_DAYS:
-            self.events[m] = {}
-            for d in range(1, MONTH_DAYS[m]+1):
-                self.events[m][d] = {}
-                for c in EMPTY_EVENT_DICT:
-                    self.events[m][d][c] = db.get_all_events(m, d, c)
+        start = time.perf_counter()
+        self.version = db.get_version()
+        self.last_modified = db.get_last_modified()
+        self.snapshot_fpath = None
+        self.row_count = 0
+        # Events are read in the order they are stored in the database, then sorted into groups (see below). Until then,
+        # each event is identified by its index in the order it was read, and everything stored about it is kept in
+        # flat arrays indexed in that order, so that no Python objects are kept for each event.
+        read_groups = array('H')
+        read_years = array('i')
+        read_rendered = bytearray()
+        read_rendered_offsets = array('I', [0])
+        self.odd_years: dict[int, str] = {}
+        read_odd_descriptions: dict[int, str] = {}
+        # The events containing each token (see topic_tokens)
+        token_events: dict[str, array] = {}
+        find_tokens = TOKEN_RE.findall
+        for row in db.iter_all_events():
+            self.row_count += 1
+            m, d, c, y, desc = row
+            try:
+                group = self.get_group(m, d, c)
+            except KeyError:
+                # Rows that don't correspond to a valid date and category would never be returned by a query for a
+                # valid date and category, so ignore them.
+                logger.warning(f'Ignoring event with invalid date or category: {row}')
+                continue
+            i = len(read_groups)
+            read_groups.append(group)
+            read_years.append(self._encode_year(i, y))
+            read_rendered += escape_text(format_event(y, desc)).encode()
+            read_rendered_offsets.append(len(read_rendered))
+            if ('\r' in desc) or ('\\N' in desc):
+                read_odd_descriptions[i] = desc
+            for token in set(find_tokens(desc.casefold())):
+                events = token_events.get(token)
+                if events is None:
+                    token_events[token] = array('I', [i])
+                else:
+                    events.append(i)
+
+        # Sort the events by group (a counting sort, which keeps the events of each group in the order they were read).
+        # The position of each event is given by `positions`, and the event at each position by `order`.
+        n_groups = len(self.DATES) * len(self.CATEGORIES)
+        group_counts = array('I', bytes(4 * n_groups))
+        for group in read_groups:
+            group_counts[group] += 1
+        # Position of the first event in each group (plus a final entry marking the end of the last group)
+        self.group_offsets = array('I', accumulate(group_counts, initial=0))
+        next_pos = array('I', self.group_offsets)
+        positions = array('I', bytes(4 * len(read_groups)))
+        order = array('I', bytes(4 * len(read_groups)))
+        for i, group in enumerate(read_groups):
+            pos = next_pos[group]
+            positions[i] = pos
+            order[pos] = i
+            next_pos[group] = pos + 1
+        del read_groups, group_counts, next_pos
+
+        self.years = array('i', (read_years[i] for i in order))
+        del read_years
+        # Years which can't be stored as integers (because they aren't in canonical integer form), and descriptions
+        # which can't be recovered from the pre-rendered events, by position
+        read_odd_years = self.odd_years
+        self.odd_years = {}
+        self.odd_descriptions: dict[int, str] = {}
+        rendered = bytearray()
+        self.rendered_offsets = array('I', [0])
+        read_view = memoryview(read_rendered)
+        for pos, i in enumerate(order):
+            rendered += read_view[read_rendered_offsets[i]:read_rendered_offsets[i + 1]]
+            self.rendered_offsets.append(len(rendered))
+            if i in read_odd_years:
+                self.odd_years[pos] = read_odd_years[i]
+            if i in read_odd_descriptions:
+                self.odd_descriptions[pos] = read_odd_descriptions[i]
+        read_view.release()
+        del read_rendered, read_rendered_offsets
+        self.rendered_data = bytes(rendered)
+        del rendered
+
+        # Tokens are sorted (in the same order as their UTF-8 encodings), so they can be looked up by binary search (see
+        # _find_token).
+        tokens = sorted(token_events)
+        encoded_tokens = [t.encode() for t in tokens]
+        self.token_data = b''.join(encoded_tokens)
+        self.token_offsets = array('I', accumulate((len(t) for t in encoded_tokens), initial=0))
+        del encoded_tokens
+        # Position of the first entry for each token in the positions array (plus a final entry marking the end)
+        self.token_position_offsets = array('I', accumulate((len(token_events[t]) for t in tokens), initial=0))
+        self.token_positions = array('I')
+        for token in tokens:
+            self.token_positions.extend(sorted(map(positions.__getitem__, token_events.pop(token))))
+        self._init_topic_cache()
+
+        self.load_time = time.perf_counter() - start
+        logger.info(f'Loaded {self.row_count} events in {self.load_time:.3f} seconds.')
+
+    @classmethod
+    def from_snapshot(cls, fpath: str, db: Optional[DAO] = None) -> 'InMemory':
+        """
+        Open a snapshot file written by :meth:`write_snapshot`. The file is memory-mapped, and the events are read
+        directly from the mapped memory rather than copied.
+
+        :param fpath: The path to the snapshot file.
+        :param db: A :class:`DAO` object. If provided, the snapshot is checked against the current version of the data
+            in the database, and the :class:`DAO` object is stored in the `db` attribute. The time the data was last
+            modified is taken from the database if provided, or from the snapshot file otherwise.
+        :return: The :class:`InMemory` object.
+        :raises SnapshotError: If the snapshot is invalid, or is out of date with respect to `db`.
+        """
+        start = time.perf_counter()
+        # The file is kept open while the object exists, so that other processes can open the same file through it,
+        # even if it is replaced in the meantime (see _unpickle_snapshot).
+        f = open(fpath, 'rb')
+        mm = None
+        try:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                header = cls.SNAPSHOT_HEADER.unpack_from(mm)
+            except (ValueError, struct.error):
+                raise SnapshotError(f'Snapshot file {fpath} is too short.')
+            magic, byteorder, n_groups, n_events, odd_len, rendered_len, n_tokens, token_data_len, n_positions, \
+                version = header
+            if magic != cls.SNAPSHOT_MAGIC:
+                if magic.startswith(cls.SNAPSHOT_MAGIC[:-1]):
+                    raise SnapshotError(f'Snapshot file {fpath} was written in an older or newer format.')
+                raise SnapshotError(f'{fpath} is not a snapshot file.')
+            if byteorder.rstrip(b'\0').decode() != sys.byteorder:
+                raise SnapshotError(f'Snapshot file {fpath} was written on a machine with a different byte order.')
+            if n_groups != len(cls.DATES) * len(cls.CATEGORIES):
+                raise SnapshotError(f'Snapshot file {fpath} has an unexpected number of groups ({n_groups}).')
+            # The size of the file implied by the header (the arrays of 4-byte integers, followed by the other data)
+            n_ints = (n_groups + 1) + n_events + (n_events + 1) + 2 * (n_tokens + 1) + n_positions
+            size = cls.SNAPSHOT_HEADER.size + 4 * n_ints + odd_len + rendered_len + token_data_len
+            if len(mm) != size:
+                raise SnapshotError(f'Snapshot file {fpath} is truncated or corrupt ({len(mm)} bytes, not {size}).')
+            version = version.decode()
+            if (db is not None) and (db.get_version() != version):
+                raise SnapshotError(f'Snapshot file {fpath} is out of date.')
+            odd_pos = cls.SNAPSHOT_HEADER.size + 4 * n_ints
+            try:
+                odd = json.loads(str(mm[odd_pos:odd_pos + odd_len], 'utf-8'))
+                odd_years = {int(k): v for k, v in odd['years'].items()}
+                odd_descriptions = {int(k): v for k, v in odd['descriptions'].items()}
+            except (ValueError, KeyError, AttributeError) as e:
+                raise SnapshotError(f'Snapshot file {fpath} is corrupt: {e}')
+        except BaseException:
+            # Nothing refers to the mapped memory yet, so it can be unmapped.
+            if mm is not None:
+                mm.close()
+            f.close()
+            raise
+
+        self = cls.__new__(cls)
+        self.db = db
+        self.version = version
+        self.snapshot_fpath = fpath
+        if db is None:
+            self.last_modified = datetime.fromtimestamp(os.path.getmtime(fpath), timezone.utc)
+        else:
+            self.last_modified = db.get_last_modified()
+        self.row_count = n_events
+        self._file = f
+        self._mmap = mm
+        view = memoryview(mm)
+        pos = cls.SNAPSHOT_HEADER.size
+        self.group_offsets = view[pos:pos + 4 * (n_groups + 1)].cast('I')
+        pos += 4 * (n_groups + 1)
+        self.years = view[pos:pos + 4 * n_events].cast('i')
+        pos += 4 * n_events
+        self.rendered_offsets = view[pos:pos + 4 * (n_events + 1)].cast('I')
+        pos += 4 * (n_events + 1)
+        self.token_offsets = view[pos:pos + 4 * (n_tokens + 1)].cast('I')
+        pos += 4 * (n_tokens + 1)
+        self.token_position_offsets = view[pos:pos + 4 * (n_tokens + 1)].cast('I')
+        pos += 4 * (n_tokens + 1)
+        self.token_positions = view[pos:pos + 4 * n_positions].cast('I')
+        pos += 4 * n_positions
+        self.odd_years = odd_years
+        self.odd_descriptions = odd_descriptions
+        pos += odd_len
+        self.rendered_data = view[pos:pos + rendered_len]
+        pos += rendered_len
+        self.token_data = view[pos:pos + token_data_len]
+        self._init_topic_cache()
+
+        self.load_time = time.perf_counter() - start
+        logger.info(f'Opened snapshot of {self.row_count} events in {self.load_time:.3f} seconds.')
+        return self
+
+    def write_snapshot(self, fpath: str):
+        """
+        Write the events to a snapshot file, which can later be opened using :meth:`from_snapshot`. The file is written
+        atomically, so processes which already have the old file open are not affected.
+
+        :param fpath: The path to the snapshot file.
+        """
+        odd = json.dumps({'years': self.odd_years, 'descriptions': self.odd_descriptions}).encode()
+        header = self.SNAPSHOT_HEADER.pack(
+            self.SNAPSHOT_MAGIC,
+            sys.byteorder.encode(),
+            len(self.group_offsets) - 1,
+            len(self.years),
+            len(odd),
+            len(self.rendered_data),
+            len(self.token_offsets) - 1,
+            len(self.token_data),
+            len(self.token_positions),
+            self.version.encode()
+        )
+        tmp_fpath = fpath + '.tmp'
+        with open(tmp_fpath, 'wb') as f:
+            f.write(header)
+            for data in (self.group_offsets, self.years, self.rendered_offsets, self.token_offsets,
+                         self.token_position_offsets, self.token_positions, odd, self.rendered_data,
+                         self.token_data):
+                f.write(data)
+        os.replace(tmp_fpath, fpath)
+        logger.info(f'Wrote snapshot of {self.row_count} events to {fpath}.')
+
+    def __reduce_ex__(self, protocol):
+        # An object opened from a snapshot is pickled (eg, to be sent to another process) as a reference to the
+        # snapshot file, rather than a copy of the data.
+        if self.snapshot_fpath is None:
+            return super().__reduce_ex__(protocol)
+        return _unpickle_snapshot, (self.snapshot_fpath, self.version, os.getpid(), self._file.fileno())
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = self.__dict__.copy()
+        # The events matching each topic are found again when needed.
+        del state['_topics'], state['_topics_lock']
+        return state
+
+    def __setstate__(self, state: dict[str, Any]):
+        self.__dict__.update(state)
+        self._init_topic_cache()
+
+    def _init_topic_cache(self):
+        # Cache of the events matching each topic, in order of use (see :meth:`get_topic_positions`). The lock is needed
+        # because the server may look up topics from several threads at once.
+        self._topics: OrderedDict[tuple[str, ...], tuple[Sequence[int], Sequence[int]]] = OrderedDict()
+        self._topics_lock = threading.Lock()
+
+    def get_version(self) -> str:
+        """
+        Get a string identifying the version of the data held in this object (see :meth:`DAO.get_version`).
+
+        :return: The version, as a hex digest.
+        """
+        return self.version
+
+    def get_last_modified(self) -> Optional[datetime]:
+        """
+        Get the time at which the data held in this object was last modified (see :meth:`DAO.get_last_modified`).
+
+        :return: The time (in UTC), or None if not known.
+        """
+        return self.last_modified
+
+    def _encode_year(self, pos: int, year: str) -> int:
+        if not year:
+            return self.NO_YEAR
+        try:
+            year_int = int(year)
+        except ValueError:
+            year_int = None
+        if (year_int is None) or (str(year_int) != year) or (year_int == self.NO_YEAR):
+            self.odd_years[pos] = year
+            return self.NO_YEAR
+        return year_int
+
+    def _decode_year(self, pos: int) -> str:
+        year = self.years[pos]
+        if year == self.NO_YEAR:
+            return self.odd_years.get(pos, '')
+        return str(year)
+
+    def get_group(self, month: str, date: int, event_category: str) -> int:
+        """
+        Get the index of the group of events for the given date and category.
+
+        :param month: The month of the event.
+        :param date: The date (day of the month) of the event.
+        :param event_category: The event category ("Births", "Deaths", "Events", "Holidays and observances").
+        :return: The index of the group.
+        :raises KeyError: If the date or category is not valid.
+        """
+        return self.DATE_INDEX[(month, date)] * len(self.CATEGORIES) + self.CATEGORY_INDEX[event_category]
+
+    def _get_token(self, i: int) -> bytes:
+        return bytes(self.token_data[self.token_offsets[i]:self.token_offsets[i + 1]])
+
+    def _find_token(self, token: str) -> Optional[int]:
+        """
+        Find the index of a token in the sorted list of tokens, by binary search.
+
+        :param token: The token.
+        :return: The index of the token, or None if no event contains it.
+        """
+        target = token.encode()
+        lo = 0
+        hi = len(self.token_offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get_token(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if (lo < len(self.token_offsets) - 1) and (self._get_token(lo) == target):
+            return lo
+        return None
+
+    def get_topic_positions(self, topic: str) -> tuple[Sequence[int], Sequence[int]]:
+        """
+        Find the events matching a topic, ie, whose descriptions contain all of the tokens of the topic (see
+        :func:`topic_tokens`). The results for the most recently used topics (up to :attr:`TOPIC_CACHE_SIZE`) are
+        cached, so that the matching events for each date and category can then be found in constant time.
+
+        :param topic: The topic.
+        :return: A tuple of the positions of the matching events (in order), and, for each group (plus a final entry
+            marking the end of the last group), the index in those positions of the first event in that group.
+        :raises ValueError: If the topic contains no words.
+        """
+        tokens = topic_tokens(topic)
+        if not tokens:
+            raise ValueError(f'Topic must contain at least one word (not "{topic}").')
+        with self._topics_lock:
+            cached = self._topics.get(tokens)
+            if cached is not None:
+                self._topics.move_to_end(tokens)
+                return cached
+
+        lists = []
+        for token in tokens:
+            i = self._find_token(token)
+            if i is None:
+                lists = [array('I')]
+                break
+            lists.append(memoryview(self.token_positions)[
+                         self.token_position_offsets[i]:self.token_position_offsets[i + 1]])
+        # Intersect the lists of positions, checking each position of the shortest against the others.
+        lists.sort(key=len)
+        positions = lists[0]
+        if len(lists) > 1:
+            positions = array('I', [
+                p for p in positions
+                if all((j < len(other)) and (other[j] == p) for other in lists[1:] for j in [bisect_left(other, p)])
+            ])
+        positions = memoryview(positions)
+        offsets = array('I')
+        lo = 0
+        for group_offset in self.group_offsets:
+            lo = bisect_left(positions, group_offset, lo)
+            offsets.append(lo)
+
+        with self._topics_lock:
+            self._topics[tokens] = positions, offsets
+            # Evict the least recently used topics.
+            while len(self._topics) > self.TOPIC_CACHE_SIZE:
+                self._topics.popitem(last=False)
+        return positions, offsets
 
-    def get_random_events(self, month: str, date: int, event_category: str, count: int = 1) -> list[tuple[str, str]]:
+    def get_group_positions(self, group: int, topic: Optional[str] = None) -> Sequence[int]:
+        """
+        Get the positions of the events in a group, optionally only those matching a topic (see
+        :meth:`get_topic_positions`).
+
+        :param group: The index of the group (see :meth:`get_group`).
+        :param topic: The topic, if any.
+        :return: The positions, in order.
+        """
+        if topic is None:
+            return range(self.group_offsets[group], self.group_offsets[group + 1])
+        positions, offsets = self.get_topic_positions(topic)
+        return positions[offsets[group]:offsets[group + 1]]
+
+    def get_event(self, pos: int, month: str, date: int, event_category: str) -> tuple[str, int, str, str, str]:
+        """
+        Get the event at the given position.
+
+        :param pos: The position of the event.
+        :param month: The month of the event.
+        :param date: The date (day of the month) of the event.
+        :param event_category: The event category.
+        :return: The event, as a tuple comprised of month, date, category, year and description.
+        """
+        year = self._decode_year(pos)
+        desc = self.odd_descriptions.get(pos)
+        if desc is None:
+            desc = unescape_text(self.get_rendered_event(pos))
+            if year:
+                # Strip the year prefix added by format_event
+                desc = desc[len(year) + 2:]
+        return month, date, event_category, year, desc
+
+    def get_rendered_event(self, pos: int) -> str:
+        """
+        Get the pre-rendered version of the event at the given position.
+
+        :param pos: The position of the event.
+        :return: The event, formatted for display and escaped for use in iCalendar data.
+        """
+        return str(self.rendered_data[self.rendered_offsets[pos]:self.rendered_offsets[pos + 1]], 'utf-8')
+
+    def get_all_events(self, month: str, date: int, event_category: str) -> list[tuple[str, int, str, str, str]]:
+        """
+        Return all events for the given date and category.
+
+        :param month: The month of the event.
+        :param date: The date (day of the month) of the event.
+        :param event_category: The event category ("Births", "Deaths", "Events", "Holidays and observances").
+        :return: A list of events (as tuples comprised of month, date, category, year and description).
+        """
+        group = self.get_group(month, date, event_category)
+        return [
+            self.get_event(pos, month, date, event_category)
+            for pos in range(self.group_offsets[group], self.group_offsets[group + 1])
+        ]
+
+    def get_random_events(self, month: str, date: int, event_category: str, count: int = 1,
+                          rendered: bool = False, rng: Optional[random.Random] = None,
+                          topic: Optional[str] = None) -> list:
         """
         Return `n` random events for the given date, based on the given criteria.
 
@@ -257,7 +1104,13 @@ class InMemory:
         :param date: The date (day of the month) of the event.
         :param event_category: The event category ("Births", "Deaths", "Events", "Holidays and observances").
         :param count: The number of events to return.
-        :return: A list, of length `n`, of events (as tuples comprised of year + description).
+        :param rendered: If True, return each event pre-rendered as a string (formatted for display and escaped for use
+            in iCalendar data), rather than as a tuple.
+        :param rng: The random number generator to use (eg, a seeded :class:`Random` object, for reproducible results).
+            If None, the module-level generator is used.
+        :param topic: If given, only select events matching this topic (see :meth:`get_topic_positions`).
+        :return: A list, of length `n`, of events (as tuples comprised of year + description, or as strings if
+            `rendered` is True).
         """
         try:
             count = int(count)
@@ -266,7 +1119,140 @@ class InMemory:
         if count < 1:
             raise ValueError(f'Count must be an integer greater than 0 (not {count}).')
 
+        candidates = self.get_group_positions(self.get_group(month, date, event_category), topic)
         try:
-            return sample(self.events[month][date][event_category], count)
+            positions = [candidates[i] for i in (rng or random).sample(range(len(candidates)), count)]
         except ValueError:
             return []
+        if rendered:
+            return [self.get_rendered_event(pos) for pos in positions]
+        else:
+            return [self.get_event(pos, month, date, event_category) for pos in positions]
+
+    def sampler(self, rng: Optional[random.Random] = None) -> 'EventSampler':
+        """
+        Create an :class:`EventSampler` to select events for a calendar, without repeats.
+
+        :param rng: The random number generator for the sampler to use. If None, the module-level generator is used.
+        :return: The :class:`EventSampler` object.
+        """
+        return EventSampler(self, rng)
+
+
+# Snapshots opened in this process when unpickling InMemory objects, by path.
+_unpickled_snapshots: dict[str, InMemory] = {}
+
+
+def _unpickle_snapshot(fpath: str, version: str, pid: Optional[int] = None, fd: Optional[int] = None) -> InMemory:
+    """
+    Open a snapshot file when unpickling an :class:`InMemory` object, reusing the object already opened in this process
+    if it is of the same version.
+
+    If the file has since been replaced with a different version (eg, by `otd.py snapshot`), the file that the pickled
+    object was opened from is opened instead, through the pickling process's file descriptor for it (on systems with a
+    `/proc` filesystem, such as Linux).
+
+    :param fpath: The path to the snapshot file.
+    :param version: The version of the data in the pickled object.
+    :param pid: The ID of the process in which the object was pickled.
+    :param fd: The file descriptor of the snapshot file in that process.
+    :return: The :class:`InMemory` object.
+    :raises SnapshotError: If the snapshot file has since been replaced with a different version, and the original file
+        can't be opened.
+    """
+    mem = _unpickled_snapshots.get(fpath)
+    if (mem is None) or (mem.version != version):
+        mem = InMemory.from_snapshot(fpath)
+        if (mem.version != version) and (pid is not None):
+            fd_path = f'/proc/{pid}/fd/{fd}'
+            if os.path.exists(fd_path):
+                mem = InMemory.from_snapshot(fd_path)
+                mem.snapshot_fpath = fpath
+        if mem.version != version:
+            raise SnapshotError(f'Snapshot file {fpath} has changed.')
+        _unpickled_snapshots[fpath] = mem
+    return mem
+
+
+class EventSampler:
+    """
+    Selects random events from an :class:`InMemory` object, avoiding repeats. For each date and category, events are
+    handed out in the order of a random permutation of that date and category's events, so no event is repeated until
+    all the others have been used, at which point a new permutation is started.
+
+    Each permutation is generated lazily (using a Fisher-Yates shuffle which only records the positions it has swapped),
+    so each event selected takes constant time, and the state kept is proportional to the number of events selected
+    rather than the number of events stored. Use one sampler per calendar.
+
+    The sampler can be used in place of the :class:`InMemory` object when generating a calendar.
+
+    :param db: The :class:`InMemory` object to select events from.
+    :param rng: The random number generator to use. If None, the module-level generator is used.
+    """
+
+    def __init__(self, db: InMemory, rng: Optional[random.Random] = None):
+        self.db = db
+        self.rng = rng or random
+        # For each group (and topic) which has been sampled from: the number of events not yet used in the current
+        # permutation, and the indexes (of events within the group) which have been swapped, mapped to the index they
+        # now hold.
+        self._remaining: dict[tuple[int, Optional[str]], int] = {}
+        self._swaps: dict[tuple[int, Optional[str]], dict[int, int]] = {}
+
+    def _next_index(self, key: tuple[int, Optional[str]], size: int) -> int:
+        """
+        Get the index (within its group) of the next event in the current permutation of a group, starting a new
+        permutation if needed.
+
+        :param key: The index of the group and the topic (if any).
+        :param size: The number of events in the group (must be greater than zero).
+        :return: The index of the event.
+        """
+        remaining = self._remaining.get(key, 0)
+        if remaining == 0:
+            remaining = size
+            self._swaps[key] = {}
+        swaps = self._swaps[key]
+        i = self.rng.randrange(remaining)
+        remaining -= 1
+        pos = swaps.get(i, i)
+        # Swap the chosen event with the last unused event, so that the unused events are always the first `remaining`.
+        swaps[i] = swaps.pop(remaining, remaining)
+        self._remaining[key] = remaining
+        return pos
+
+    def get_random_events(self, month: str, date: int, event_category: str, count: int = 1,
+                          rendered: bool = False, rng: Optional[random.Random] = None,
+                          topic: Optional[str] = None) -> list:
+        """
+        Return `n` random events for the given date, based on the given criteria. The events returned are always
+        distinct, and are not repeated in subsequent calls until all the other events for the given date and category
+        (and topic) have been returned.
+
+        Arguments are as for :meth:`InMemory.get_random_events`, except that `rng` is ignored (the sampler's own random
+        number generator is always used).
+        """
+        try:
+            count = int(count)
+        except ValueError:
+            raise ValueError(f'Count must be an integer greater than 0 (not {count}).')
+        if count < 1:
+            raise ValueError(f'Count must be an integer greater than 0 (not {count}).')
+
+        group = self.db.get_group(month, date, event_category)
+        candidates = self.db.get_group_positions(group, topic)
+        size = len(candidates)
+        if count > size:
+            return []
+        indexes = []
+        while len(indexes) < count:
+            i = self._next_index((group, topic), size)
+            # If a new permutation was started part of the way through, it may begin with events already selected.
+            # These are skipped (and so are not repeated until the permutation after).
+            if i not in indexes:
+                indexes.append(i)
+        positions = [candidates[i] for i in indexes]
+        if rendered:
+            return [self.db.get_rendered_event(pos) for pos in positions]
+        else:
+            return [self.db.get_event(pos, month, date, event_category) for pos in positions]
@@ -0,0 +1,135 @@
+"""
+Export many calendars at once, eg, to pre-generate calendar files for a catalogue of popular configurations.
+
+The calendars to export are listed in a manifest, which is either a JSON file containing a list of objects, or a CSV
+file with a header row. Each entry gives the parameters of one calendar, with the same names and in the same form as
+the arguments to the `/calendar` endpoint of the web app ("births", "deaths", "events", "holidays", "timezone",
+"start", "end", "time", "seed", "window" and "topic"), plus an optional "filename" (which defaults to "calendar_N.ics",
+where N is the index of the entry in the manifest).
+
+The events for each day do not depend on the time or timezone of the calendar, so calendars which differ only in those
+share the same events, which are only selected once. Each such group of calendars is generated (its events selected and
+its calendars written) by a separate task, and the tasks are run in parallel. The events are sent to the worker
+processes with each task, so should be loaded from a snapshot (see :meth:`InMemory.from_snapshot`), in which case only
+a reference to the snapshot file is sent.
+"""
+
+import csv
+import json
+import os
+import random
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import date, datetime
+from typing import Optional, Union
+
+import pytz
+from onthisday.app.download_calendar import convert_args, BadArgumentError
+from onthisday.calendar import get_categories, get_date_range, date_range, make_descriptions, dtstart_format, \
+    vevent_ical, PRODID, VERSION, fold_line
+from onthisday.db import DAO, InMemory
+
+def read_manifest(fpath: str) -> list[dict[str, str]]:
+    """
+    Read a manifest file. Empty values are treated as missing (and omitted).
+
+    :param fpath: The path to the manifest. Files with a ".json" extension are read as JSON; any other file is read as
+        CSV.
+    :return: A list of dicts, each mapping parameter names to values (as strings).
+    """
+    with open(fpath, newline='') as f:
+        if fpath.lower().endswith('.json'):
+            entries = json.load(f)
+        else:
+            entries = list(csv.DictReader(f))
+    return [{k: str(v) for k, v in entry.items() if (k is not None) and (v not in (None, ''))} for entry in entries]
+
+
+def write_calendars(out_dir: str, variants: list[tuple[str, int, int, pytz.tzinfo.BaseTzInfo]], dates: list[date],
+                    descriptions: list[str]):
+    """
+    Write calendars which share the same days and descriptions, but differ in the time and timezone of their vEvents.
+
+    :param out_dir: The directory to write the calendars to.
+    :param variants: A list of tuples, each containing the filename, hour, minute and timezone of a calendar.
+    :param dates: The days of the calendars.
+    :param descriptions: The description of the vEvent for each day (see :func:`make_descriptions`).
+    """
+    header = b''.join((b'BEGIN:VCALENDAR\r\n', fold_line(f'VERSION:{VERSION}'), fold_line(f'PRODID:{PRODID}')))
+    for fname, hour, minute, tz in variants:
+        dtstart_fmt = dtstart_format(tz)
+        with open(os.path.join(out_dir, fname), 'wb') as f:
+            f.write(header)
+            for d, description in zip(dates, descriptions):
+                time = datetime(d.year, d.month, d.day, hour, minute, tzinfo=tz)
+                f.write(vevent_ical(time, dtstart_fmt, description))
+            f.write(b'END:VCALENDAR\r\n')
+
+
+def export_group(db: Union[DAO, InMemory], out_dir: str, variants: list[tuple[str, int, int, pytz.tzinfo.BaseTzInfo]],
+                 start: date, end: date, categories: dict[str, int], seed: Optional[str],
+                 window: Optional[tuple[int, int]], topic: Optional[str]):
+    """
+    Select the events for a group of calendars which differ only in the time and timezone of their vEvents, and write
+    the calendars. Arguments are as for :func:`write_calendars` and :func:`make_descriptions`, with `start` and `end`
+    giving the days of the calendars.
+    """
+    if seed is None:
+        # Worker processes start with a copy of the parent's random number generator, so would otherwise select the
+        # same "random" events as each other.
+        random.seed()
+    dates = list(date_range(start, end))
+    write_calendars(out_dir, variants, dates, make_descriptions(db, dates, categories, seed, window, topic))
+
+
+def export_calendars(db: Union[DAO, InMemory], entries: list[dict[str, str]], out_dir: str,
+                     workers: Optional[int] = None, executor: Optional[Executor] = None) -> int:
+    """
+    Export the calendars described by the entries of a manifest.
+
+    :param db: A :class:`DAO` or :class:`InMemory` object to retrieve historical events from the database.
+    :param entries: The entries of the manifest (see :func:`read_manifest`).
+    :param out_dir: The directory to write the calendars to (created if it does not exist).
+    :param workers: The number of worker processes with which to generate calendars, if `executor` is not given. If
+        None, the number of CPUs is used.
+    :param executor: The executor with which to generate calendars. If None, a :class:`ProcessPoolExecutor` is created
+        (and shut down afterwards).
+    :return: The number of calendars written.
+    :raises ValueError: If an entry of the manifest is invalid.
+    """
+    # Group the calendars by everything that affects the events they contain.
+    groups: dict[tuple, list[tuple[str, int, int, pytz.tzinfo.BaseTzInfo]]] = {}
+    fnames = set()
+    for i, entry in enumerate(entries):
+        fname = entry.get('filename') or f'calendar_{i}.ics'
+        if (os.path.basename(fname) != fname) or (fname in ('.', '..')):
+            raise ValueError(f'Entry {i} of the manifest: Bad filename: {fname}')
+        if fname in fnames:
+            raise ValueError(f'Entry {i} of the manifest: Duplicate filename: {fname}')
+        fnames.add(fname)
+        try:
+            args = convert_args(entry)
+            start, end = get_date_range(args['start'], args['end'], args['window'])
+        except (BadArgumentError, ValueError) as e:
+            raise ValueError(f'Entry {i} of the manifest: {e.args[0]}')
+        if start > end:
+            raise ValueError(f'Entry {i} of the manifest: Start date must be before end date.')
+        categories = tuple(get_categories(args['categories']).items())
+        key = (start, end, categories, args['seed'], args['window'], args['topic'])
+        groups.setdefault(key, []).append((fname, args['hour'], args['minute'], args['tz']))
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(workers)
+    try:
+        futures = [
+            executor.submit(export_group, db, out_dir, variants, start, end, dict(categories), seed, window, topic)
+            for (start, end, categories, seed, window, topic), variants in groups.items()
+        ]
+        for f in futures:
+            f.result()
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return len(fnames)
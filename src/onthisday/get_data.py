@@ -1,12 +1,16 @@
+import html
 import logging
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from copy import deepcopy
-from typing import Union, Generator
+from typing import Union, Generator, Optional, Iterable, Hashable
 
 import wikitextparser
 from mediawiki import MediaWiki
 from onthisday.common_data import MONTH_DAYS, EMPTY_EVENT_DICT, iter_dates
 from onthisday.db import DAO
+from onthisday.wikitext_store import WikitextStore
 
 logger = logging.getLogger(__name__)
 
@@ -24,10 +28,31 @@ class AlreadyScraped(Exception):
     pass
 
 
-EVENT_RE = re.compile(r"^\*\s*(\d+)\s*–\s*(.+)$")
+USER_AGENT = 'onthisday (onthisday@devnool.net)'
+DEFAULT_API_URL = 'https://en.wikipedia.org/w/api.php'
+# Maximum number of titles the MediaWiki API accepts in a single query (for non-bot users).
+REVISION_BATCH_SIZE = 50
+# Number of pages parsed by each task submitted to a process pool (see :func:`iter_parsed`).
+PARSE_CHUNK_SIZE = 8
+
+EVENT_RE = re.compile(r"^\*\s*((?:c\.\s*)?(?:AD\s*)?\d+(?:\s*BCE?)?)\s*–\s*(.+)$")
 H1_RE = re.compile("^==([^=]+)==$")
 H2_RE = re.compile(r"^===([^=]+)===$")
 
+# Markup that can be converted to plain text without a full parse (see :func:`convert_markup`). None of the patterns
+# match across lines, and links next to apostrophes (which may be part of bold or italic markup) are left alone.
+LINK_RE = re.compile(r"\[\[(?:(?<!'\[\[)[^\[\]|:<>{}\n]*\||[^\[\]|:<>{}\n]*\|(?!')([^\[\]<>{}\n]+)|"
+                     r"(?!')([^\[\]|:<>{}\n]+))\]\](?!(?<='\]\])')")
+TAG_RE = re.compile(r"<(?:!--.*?--|ref\b[^>\n]*/|/?(?:ref|small|sup|sub|span|br)\b[^>\n]*)>")
+TEMPLATE_RE = re.compile(r"\{\{[^{}\n]*\}\}")
+# Characters left over from markup that could not be converted.
+UNCONVERTED_RE = re.compile(r"[\[\]{}<>]")
+# Anything that may need to be converted after calling convert_markup.
+SPECIAL_RE = re.compile(r"[\[\]{}<>&]|''")
+QUOTES_RE = re.compile(r"'{2,}")
+# Opening tags of elements whose content may span several lines.
+OPEN_TAG_RE = re.compile(r"<(ref|nowiki|pre|math|gallery)\b[^>]*(?<!/)>")
+
 
 def empty_events_dict() -> dict[str, list[tuple[str, str]]]:
     return deepcopy(EMPTY_EVENT_DICT)
@@ -152,52 +177,526 @@ def parse_text(text: str) -> dict[str, list[tuple[str, str]]]:
     return events
 
 
-def parse_page(title: str, wiki: MediaWiki,
-               last_rev_id: str) -> tuple[int, dict[str, list[tuple[str, str]]]]:
-    page = wiki.page(title, auto_suggest=False)
-    rev_id = page.revision_id
-    if rev_id == last_rev_id:
+def convert_markup(wikitext: str) -> str:
+    """
+    Convert the simple markup commonly found in list items (links, templates, references, comments and some HTML tags)
+    to plain text. Other markup is left as it is, and bold and italic markup and HTML entities are not converted.
+
+    :param wikitext: The wikitext, which may contain several lines (each of which is converted separately).
+    :return: The partly converted wikitext, with the same number of lines.
+    """
+    # Each link is replaced by whichever of its groups matched.
+    text = ''.join(filter(None, LINK_RE.split(wikitext)))
+    if '<' in text:
+        text = TAG_RE.sub('', text)
+    n = 1
+    while n and ('{{' in text):
+        text, n = TEMPLATE_RE.subn('', text)
+    return text
+
+
+def convert_line(wikitext: str, converted: Optional[str] = None) -> Optional[str]:
+    """
+    Convert a line of wikitext to plain text without a full parse, if it only contains simple markup (see
+    :func:`convert_markup`), bold and italic markup and HTML entities.
+
+    :param wikitext: The wikitext.
+    :param converted: The result of calling :func:`convert_markup` on `wikitext`, if already known.
+    :return: The plain text, or None if the line contains other markup.
+    """
+    text = convert_markup(wikitext) if converted is None else converted
+    if UNCONVERTED_RE.search(text):
+        return None
+    if "''" in text:
+        # Only remove bold and italic markup that is properly balanced, and that was not joined to other apostrophes by
+        # removing markup.
+        if ("'<" in wikitext) or ("'{{" in wikitext) or (">'" in wikitext) or ("}}'" in wikitext):
+            return None
+        stack = []
+        for q in QUOTES_RE.findall(text):
+            if len(q) > 3:
+                return None
+            elif stack and (stack[-1] == q):
+                stack.pop()
+            else:
+                stack.append(q)
+        if stack:
+            return None
+        text = QUOTES_RE.sub('', text)
+    if '&' in text:
+        text = html.unescape(text)
+    return text
+
+
+def is_unclosed(wikitext: str) -> bool:
+    """
+    Check whether a line of wikitext opens markup (eg, a template or comment) that is only closed on a later line.
+
+    :param wikitext: The wikitext.
+    :return: Whether the wikitext contains unclosed markup.
+    """
+    for start, end in (('{{', '}}'), ('[[', ']]')):
+        if (start in wikitext) and ((wikitext.count(start) > wikitext.count(end))
+                                    or (wikitext.rfind(start) > wikitext.rfind(end))):
+            return True
+    if '<' in wikitext:
+        if wikitext.count('<!--') > wikitext.count('-->'):
+            return True
+        tags = OPEN_TAG_RE.findall(wikitext)
+        for tag in set(tags):
+            if tags.count(tag) > wikitext.count(f'</{tag}>'):
+                return True
+    return False
+
+
+def iter_plain_lines(wikitext: str) -> Generator[str, None, None]:
+    """
+    Convert wikitext to plain text line by line, giving the same lines as the `plain_text` method of a
+    :class:`wikitextparser.WikiText` object for lines that may be headings or list items. Other lines are not fully
+    converted. Markup that spans several lines is passed to :mod:`wikitextparser` as a whole.
+
+    :param wikitext: The wikitext.
+    :return: A generator of lines of plain text.
+    """
+    raw_lines = wikitext.splitlines()
+    converted_lines = convert_markup('\n'.join(raw_lines)).split('\n')
+    i = 0
+    while i < len(raw_lines):
+        converted = converted_lines[i]
+        i += 1
+        if not SPECIAL_RE.search(converted):
+            yield converted
+            continue
+        raw = raw_lines[i - 1]
+        if (converted[:1] in ('*', '=', '&', "'")) or UNCONVERTED_RE.search(converted):
+            text = convert_line(raw, converted)
+        else:
+            # The line is not a heading or list item, so its exact content does not matter.
+            text = converted
+        if text is None:
+            if is_unclosed(raw):
+                j = i
+                while (j < len(raw_lines)) and is_unclosed('\n'.join(raw_lines[i - 1:j])):
+                    j += 1
+                raw = '\n'.join(raw_lines[i - 1:j])
+                i = j
+            # Split the text in the same way as the plain text of the whole page would be (keeping empty lines).
+            yield from (wikitextparser.parse(raw).plain_text() + '\n').splitlines()
+        else:
+            yield text
+
+
+def iter_wikitext_events(wikitext: str) -> Generator[tuple[str, str, str], None, None]:
+    """
+    Parse events from the wikitext of a page in a single pass, giving the same results as parsing the plain text of
+    the whole page with :func:`parse_text`. Only the lines that may be headings or list items are converted to plain
+    text (see :func:`iter_plain_lines`), and parsing stops at the first heading after the sections we are interested
+    in.
+
+    Items in the "Holidays and observances" section are only yielded once the whole page has been parsed.
+
+    :param wikitext: The wikitext.
+    :return: A generator of tuples, each containing the category (heading) of an event, its year (which is an empty
+        string for holidays) and its description.
+    """
+    categories = EMPTY_EVENT_DICT.keys()
+    h1 = None
+    # Lines at the start of the "Holidays and observances" section, to be passed to parse_holidays.
+    holiday_lines = None
+    holidays = []
+    holiday_events = []
+    for line in iter_plain_lines(wikitext):
+        c = line[:1]
+        if holiday_lines is not None:
+            if c == '*':
+                holiday_lines.append(line)
+            else:
+                holidays = parse_holidays(holiday_lines)
+                holiday_lines = None
+        if c == '*':
+            if match := EVENT_RE.match(line):
+                if not h1:
+                    raise ParsingError(f'Found event but missing heading: {line}')
+                if h1 == 'Holidays and observances':
+                    holiday_events.append(match.groups())
+                else:
+                    yield h1, match.group(1), match.group(2)
+        elif (c == '=') and (match := H1_RE.match(line)):
+            h1 = match.group(1).strip()
+            if h1 not in categories:
+                break
+            if h1 == 'Holidays and observances':
+                holiday_lines = []
+                holiday_events = []
+    if holiday_lines is not None:
+        holidays = parse_holidays(holiday_lines)
+    yield from (('Holidays and observances', y, d) for y, d in holidays + holiday_events)
+
+
+def get_wiki(api_url: str = DEFAULT_API_URL) -> MediaWiki:
+    """
+    Create a client for the MediaWiki API. Creating a client involves a request to the API, so clients should be reused
+    where possible (but not shared between threads).
+
+    :param api_url: The URL of the MediaWiki API to use.
+    :return: The :class:`MediaWiki` object.
+    """
+    return MediaWiki(url=api_url, user_agent=USER_AGENT)
+
+
+def query_revision(title: str, wiki: MediaWiki, content: bool = False) -> dict:
+    """
+    Query the MediaWiki API for the latest revision of a page.
+
+    :param title: The title of the page.
+    :param wiki: The :class:`MediaWiki` object to use to make the request.
+    :param content: Whether to include the content (wikitext) of the revision.
+    :return: A dict describing the revision, as returned by the API. The revision ID is at the "revid" key and, if
+        `content` is True, the wikitext is at ["slots"]["main"]["content"].
+    :raises ParsingError: The page does not exist, or the API returned an unexpected response.
+    """
+    response = wiki.wiki_request({
+        'prop': 'revisions',
+        'rvprop': 'ids|content' if content else 'ids',
+        'rvslots': 'main',
+        'titles': title,
+        'formatversion': 2
+    })
+    try:
+        page = response['query']['pages'][0]
+        if page.get('missing') or page.get('invalid'):
+            raise ParsingError(f'Page {title} does not exist.')
+        return page['revisions'][0]
+    except (KeyError, IndexError):
+        raise ParsingError(f'Unexpected response when querying revisions of {title}: {response}')
+
+
+def query_revision_ids(titles: list[str], wiki: MediaWiki,
+                       batch_size: int = REVISION_BATCH_SIZE) -> dict[str, int]:
+    """
+    Get the latest revision IDs of many pages, querying the MediaWiki API for `batch_size` pages at a time.
+
+    :param titles: The titles of the pages.
+    :param wiki: The :class:`MediaWiki` object to use to make the requests.
+    :param batch_size: The maximum number of titles to include in each request.
+    :return: A dict mapping each title (as given in `titles`) to the latest revision ID of the page. Titles of pages
+        that do not exist are not included.
+    """
+    rev_ids = {}
+    for i in range(0, len(titles), batch_size):
+        response = wiki.wiki_request({
+            'prop': 'revisions',
+            'rvprop': 'ids',
+            'titles': '|'.join(titles[i:i + batch_size]),
+            'formatversion': 2
+        })
+        try:
+            query = response['query']
+            # The API returns normalised titles (eg, with spaces instead of underscores), so map them back.
+            original_titles = {n['to']: n['from'] for n in query.get('normalized', [])}
+            for page in query['pages']:
+                if page.get('missing') or page.get('invalid'):
+                    continue
+                title = original_titles.get(page['title'], page['title'])
+                rev_ids[title] = page['revisions'][0]['revid']
+        except (KeyError, IndexError):
+            raise ParsingError(f'Unexpected response when querying revisions: {response}')
+    return rev_ids
+
+
+def parse_wikitext(wikitext: str) -> dict[str, list[tuple[str, str]]]:
+    """
+    Parse events from the wikitext of a page.
+
+    :param wikitext: The wikitext.
+    :return: A dict containing the events.
+    """
+    events = empty_events_dict()
+    for category, year, desc in iter_wikitext_events(wikitext):
+        events[category].append((year, desc))
+    return events
+
+
+def fetch_wikitext(title: str, wiki: MediaWiki, rev_id: Optional[int] = None,
+                   store: Optional[WikitextStore] = None) -> tuple[int, str]:
+    """
+    Get the wikitext of the latest revision of a page. If a :class:`WikitextStore` is provided, the wikitext is saved to
+    it, and if the latest revision ID is already known and that revision is in the store, it is read from there instead
+    of being fetched.
+
+    :param title: The title of the page.
+    :param wiki: The :class:`MediaWiki` object to use to fetch the page.
+    :param rev_id: The latest revision ID of the page, if known.
+    :param store: The :class:`WikitextStore` in which to look for and save the wikitext.
+    :return: A tuple containing the revision ID and the wikitext.
+    """
+    if (store is not None) and (rev_id is not None):
+        wikitext = store.get(title, rev_id)
+        if wikitext is not None:
+            logger.info(f'Found revision {rev_id} of page {title} in wikitext store.')
+            return rev_id, wikitext
+    revision = query_revision(title, wiki, content=True)
+    rev_id = revision['revid']
+    wikitext = revision['slots']['main']['content']
+    if store is not None:
+        store.put(title, rev_id, wikitext)
+    return rev_id, wikitext
+
+
+def parse_page(title: str, wiki: MediaWiki, last_rev_id: Optional[int], rev_id: Optional[int] = None,
+               store: Optional[WikitextStore] = None) -> tuple[int, dict[str, list[tuple[str, str]]]]:
+    """
+    Fetch and parse a page, unless its latest revision is the one we already have.
+
+    :param title: The title of the page.
+    :param wiki: The :class:`MediaWiki` object to use to fetch the page.
+    :param last_rev_id: The revision ID of the page that is already stored in the database, if any.
+    :param rev_id: The latest revision ID of the page, if already known. If None (and `last_rev_id` is not None), it is
+        fetched before deciding whether to fetch the page content.
+    :param store: An optional :class:`WikitextStore` in which to look for and save the wikitext of the page.
+    :return: A tuple containing the revision ID of the page and a dict containing the events.
+    """
+    if (rev_id is None) and (last_rev_id is not None):
+        rev_id = query_revision(title, wiki)['revid']
+    if (rev_id is not None) and (rev_id == last_rev_id):
         raise AlreadyScraped(f'Revision {rev_id} of page {title} already in DB.')
-    parsed = wikitextparser.parse(page.wikitext)
-    return rev_id, parse_text(parsed.plain_text())
+    rev_id, wikitext = fetch_wikitext(title, wiki, rev_id, store)
+    return rev_id, parse_wikitext(wikitext)
 
 
-def parse_date_to_db(month: str, date: int, db: DAO) -> int:
+def check_parsed(title: str, parsed: dict[str, list[tuple[str, str]]]):
     """
-    Fetch all events for a particular date from Wikipedia and store them in the database.
+    Check that we actually found some events when parsing a page.
+
+    :param title: The title of the page.
+    :param parsed: The dict of events parsed from the page.
+    :raises ParsingError: No events were found.
+    """
+    if parsed == empty_events_dict():
+        msg = f'Got empty dict when parsing {title}.'
+        logger.error(msg)
+        raise ParsingError(msg)
+
+
+def fetch_date(month: str, date: int, last_rev_id: Optional[int], wiki: MediaWiki, rev_id: Optional[int] = None,
+               store: Optional[WikitextStore] = None) -> tuple[int, dict[str, list[tuple[str, str]]]]:
+    """
+    Fetch and parse all events for a particular date from Wikipedia, without storing them in the database.
 
     :param month: The relevant month.
     :param date: The relevant date (day of month).
-    :param db: The :class:`DAO` object in which to store the results.
-    :return: The number of events saved to the DB.
+    :param last_rev_id: The revision ID of the relevant page that is already stored in the database, if any.
+    :param wiki: The :class:`MediaWiki` object to use to fetch the page.
+    :param rev_id: The latest revision ID of the relevant page, if already known.
+    :param store: An optional :class:`WikitextStore` in which to look for and save the wikitext of the page.
+    :return: A tuple containing the revision ID of the page and a dict containing the events.
     :raises AlreadyScraped: The current revision of the relevant Wikipedia page is already stored in the database.
     :raises ParsingError: There was an error in parsing the Wikipedia page.
     """
-    wiki = MediaWiki(user_agent='onthisday (onthisday@devnool.net)')
     title = f'{month}_{date}'
-    last_rev_id = db.get_revision(month, date)
     try:
-        rev_id, parsed = parse_page(title, wiki, last_rev_id)
+        rev_id, parsed = parse_page(title, wiki, last_rev_id, rev_id, store)
     except AlreadyScraped as e:
         logger.info(e.args[0])
         raise e
     except ParsingError as e:
         logger.error(f'Error when parsing {title}: {e.args[0]}')
         raise e
-    if parsed == empty_events_dict():
-        msg = f'Got empty dict when parsing {title}.'
-        logger.error(msg)
-        raise ParsingError(msg)
-    n = db.insert_events(month, date, rev_id, parsed)
-    db.insert_revision(month, date, rev_id)
-    db.commit()
-    logger.info(f'Inserted {n} events for {title}; revision ID {rev_id}.')
+    check_parsed(title, parsed)
+    return rev_id, parsed
+
+
+def parse_date_to_db(month: str, date: int, db: DAO, wiki: Optional[MediaWiki] = None,
+                     store: Optional[WikitextStore] = None) -> int:
+    """
+    Fetch all events for a particular date from Wikipedia and store them in the database.
+
+    :param month: The relevant month.
+    :param date: The relevant date (day of month).
+    :param db: The :class:`DAO` object in which to store the results.
+    :param wiki: The :class:`MediaWiki` object to use to fetch the page. If None, a new one is created.
+    :param store: An optional :class:`WikitextStore` in which to save the wikitext of the page.
+    :return: The number of events saved to the DB.
+    :raises AlreadyScraped: The current revision of the relevant Wikipedia page is already stored in the database.
+    :raises ParsingError: There was an error in parsing the Wikipedia page.
+    """
+    if wiki is None:
+        wiki = get_wiki()
+    rev_id, parsed = fetch_date(month, date, db.get_revision(month, date), wiki, store=store)
+    n = db.replace_events(month, date, rev_id, parsed)
+    logger.info(f'Inserted {n} events for {month}_{date}; revision ID {rev_id}.')
     return n
 
 
-def parse_all_to_db(db: DAO):
-    for m, d in iter_dates():
+def parse_wikitexts(wikitexts: list[str]) -> list[Union[dict[str, list[tuple[str, str]]], ParsingError]]:
+    """
+    Parse events from the wikitext of several pages. This is the task run by each worker process in
+    :func:`iter_parsed`.
+
+    :param wikitexts: The wikitext of each page.
+    :return: A list containing, for each page, either a dict containing the events or the :class:`ParsingError` raised
+        when parsing it.
+    """
+    results = []
+    for wikitext in wikitexts:
+        try:
+            results.append(parse_wikitext(wikitext))
+        except ParsingError as e:
+            results.append(e)
+    return results
+
+
+def iter_parsed(pages: Iterable[tuple[Hashable, str]], workers: int = 1, chunk_size: int = PARSE_CHUNK_SIZE
+                ) -> Generator[tuple[Hashable, Union[dict[str, list[tuple[str, str]]], ParsingError]], None, None]:
+    """
+    Parse the wikitext of many pages, using a pool of worker processes if `workers` is greater than 1. Pages are sent
+    to the workers in chunks of `chunk_size` as they are read from `pages`, which may be a generator (eg, of pages as
+    they are fetched), and results are yielded as soon as each chunk has been parsed, so they are not necessarily in
+    the same order as `pages`. At most two chunks per worker are read ahead of the results that have been consumed.
+
+    :param pages: An iterable of tuples, each containing a key identifying a page (which is only used in the calling
+        process, so need not be picklable) and the wikitext of the page.
+    :param workers: The number of worker processes to use. If 1, pages are parsed in the calling process.
+    :param chunk_size: The number of pages to send to a worker at a time.
+    :return: A generator of tuples, each containing the key of a page and either a dict containing the events or the
+        :class:`ParsingError` raised when parsing it.
+    """
+    if workers < 1:
+        raise ValueError(f'Number of workers must be an integer greater than 0 (not {workers}).')
+    if workers == 1:
+        for key, wikitext in pages:
+            yield key, parse_wikitexts([wikitext])[0]
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        pending = {}
+        keys = []
+        wikitexts = []
+        for key, wikitext in pages:
+            keys.append(key)
+            wikitexts.append(wikitext)
+            if len(keys) == chunk_size:
+                pending[executor.submit(parse_wikitexts, wikitexts)] = keys
+                keys = []
+                wikitexts = []
+            done = [f for f in pending if f.done()]
+            if len(pending) >= 2 * workers:
+                done = wait(pending, return_when=FIRST_COMPLETED).done
+            for future in done:
+                yield from zip(pending.pop(future), future.result())
+        if keys:
+            pending[executor.submit(parse_wikitexts, wikitexts)] = keys
+        for future in as_completed(pending):
+            yield from zip(pending[future], future.result())
+
+
+def write_parsed(db: DAO, parsed_pages: Iterable[tuple[tuple[str, int, int], Union[dict, ParsingError]]]) -> int:
+    """
+    Store parsed pages in the database, as they are parsed (see :func:`iter_parsed`). Pages which could not be parsed
+    are logged and skipped.
+
+    :param db: The :class:`DAO` object in which to store the results.
+    :param parsed_pages: An iterable of tuples, each containing a tuple of the month, date and revision ID of a page,
+        and either a dict containing the events or the :class:`ParsingError` raised when parsing the page.
+    :return: The total number of events saved to the DB.
+    """
+    total = 0
+    for (m, d, rev_id), parsed in parsed_pages:
+        title = f'{m}_{d}'
         try:
-            parse_date_to_db(m, d, db)
-        except AlreadyScraped:
+            if isinstance(parsed, ParsingError):
+                raise parsed
+            check_parsed(title, parsed)
+        except ParsingError as e:
+            logger.error(f'Error when parsing {title}: {e.args[0]}')
             continue
+        n = db.replace_events(m, d, rev_id, parsed)
+        logger.info(f'Inserted {n} events for {title}; revision ID {rev_id}.')
+        total += n
+    return total
+
+
+def parse_all_to_db(db: DAO, workers: int = 1, api_url: str = DEFAULT_API_URL,
+                    store: Optional[WikitextStore] = None, parse_workers: int = 1) -> int:
+    """
+    Fetch all events for every date from Wikipedia and store them in the database.
+
+    The latest revision IDs of all pages are first fetched in batches and compared against those stored in the
+    database, so that only pages which have changed are downloaded. Those pages are fetched by a pool of `workers`
+    threads, each of which reuses its own :class:`MediaWiki` client, and parsed as they arrive (see
+    :func:`iter_parsed`). The results are written to the database by the calling thread as they become available, so
+    `db` is only ever accessed from one thread. Dates whose pages cannot be fetched or parsed are logged and skipped.
+
+    :param db: The :class:`DAO` object in which to store the results.
+    :param workers: The maximum number of pages to fetch concurrently.
+    :param api_url: The URL of the MediaWiki API to fetch pages from.
+    :param store: An optional :class:`WikitextStore` in which to save the wikitext of fetched pages. Changed pages whose
+        latest revision is already in the store are read from there instead of being fetched.
+    :param parse_workers: The number of processes with which to parse pages. If 1, pages are parsed in the calling
+        process.
+    :return: The total number of events saved to the DB.
+    """
+    if workers < 1:
+        raise ValueError(f'Number of workers must be an integer greater than 0 (not {workers}).')
+    local = threading.local()
+    local.wiki = get_wiki(api_url)
+
+    latest_rev_ids = query_revision_ids([f'{m}_{d}' for m, d in iter_dates()], local.wiki)
+    to_fetch = {}
+    for m, d in iter_dates():
+        latest = latest_rev_ids.get(f'{m}_{d}')
+        if latest is None:
+            logger.error(f'Could not get latest revision ID for {m}_{d}.')
+        elif latest == db.get_revision(m, d):
+            logger.info(f'Revision {latest} of page {m}_{d} already in DB.')
+        else:
+            to_fetch[(m, d)] = latest
+    logger.info(f'{len(to_fetch)} pages have changed since they were last fetched.')
+
+    def fetch(month: str, date: int, rev_id: int) -> tuple[int, str]:
+        if not hasattr(local, 'wiki'):
+            local.wiki = get_wiki(api_url)
+        return fetch_wikitext(f'{month}_{date}', local.wiki, rev_id, store)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch, m, d, rev_id): (m, d) for (m, d), rev_id in to_fetch.items()}
+
+        def iter_fetched() -> Generator[tuple[tuple[str, int, int], str], None, None]:
+            for future in as_completed(futures):
+                month, date = futures[future]
+                try:
+                    rev_id, wikitext = future.result()
+                except ParsingError as e:
+                    logger.error(f'Error when fetching {month}_{date}: {e.args[0]}')
+                    continue
+                yield (month, date, rev_id), wikitext
+
+        return write_parsed(db, iter_parsed(iter_fetched(), parse_workers))
+
+
+def reparse_all_to_db(db: DAO, store: WikitextStore, workers: int = 1) -> int:
+    """
+    Rebuild the events for every date from the wikitext in a :class:`WikitextStore`, without fetching anything from
+    Wikipedia. For each date, the revision recorded in the database is used if it is in the store; otherwise, the
+    latest stored revision is used. Dates with no stored wikitext, or whose wikitext cannot be parsed, are logged and
+    skipped.
+
+    :param db: The :class:`DAO` object in which to store the results.
+    :param store: The :class:`WikitextStore` from which to read the wikitext.
+    :param workers: The number of processes with which to parse pages (see :func:`iter_parsed`).
+    :return: The total number of events saved to the DB.
+    """
+    def iter_stored() -> Generator[tuple[tuple[str, int, int], str], None, None]:
+        for m, d in iter_dates():
+            title = f'{m}_{d}'
+            rev_id = db.get_revision(m, d)
+            wikitext = None if rev_id is None else store.get(title, rev_id)
+            if wikitext is None:
+                latest = store.latest(title)
+                if latest is None:
+                    logger.error(f'No stored wikitext for {title}.')
+                    continue
+                rev_id, wikitext = latest
+            yield (m, d, rev_id), wikitext
+
+    return write_parsed(db, iter_parsed(iter_stored(), workers))
+
@@ -0,0 +1,111 @@
+import glob
+import gzip
+import os
+from typing import Optional
+
+import appdirs
+
+
+class WikitextStore:
+    """
+    An on-disk store of the raw wikitext of the pages we have fetched from Wikipedia, so that the pages can be re-parsed
+    (eg, after a change to the parser) without fetching them again. Each page is stored in its own file, named after its
+    title and revision ID. Only the latest stored revision of each page is kept.
+
+    :param dir_path: Path to the directory in which to store the wikitext. If none specified, a sane default (next to
+        the default database directory) is selected.
+    :param compress: Whether to gzip-compress the stored wikitext.
+    """
+
+    EXT = '.wikitext'
+    GZ_EXT = '.gz'
+
+    def __init__(self, dir_path: Optional[str] = None, compress: bool = True):
+        if dir_path is None:
+            dir_path = self.get_default_dir_path()
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        self.dir_path = dir_path
+        self.compress = compress
+
+    def get_default_dir_path(self) -> str:
+        """
+        Get the default path to the directory in which to store wikitext.
+
+        :return: The path to the directory (the directory itself is not guaranteed to exist).
+        """
+        return os.path.join(appdirs.user_data_dir('onthisday'), 'wikitext')
+
+    def _path(self, title: str, rev_id: int, compressed: bool) -> str:
+        fname = f'{title}.{rev_id}{self.EXT}'
+        if compressed:
+            fname += self.GZ_EXT
+        return os.path.join(self.dir_path, fname)
+
+    def _stored_paths(self, title: str) -> dict[int, str]:
+        """
+        Get the paths to all stored revisions of a page.
+
+        :param title: The title of the page.
+        :return: A dict mapping revision IDs to file paths.
+        """
+        paths = {}
+        prefix = f'{title}.'
+        for path in glob.glob(os.path.join(glob.escape(self.dir_path), glob.escape(prefix) + '*')):
+            fname = os.path.basename(path)
+            rev_str = fname[len(prefix):].removesuffix(self.GZ_EXT).removesuffix(self.EXT)
+            if rev_str.isdigit():
+                paths[int(rev_str)] = path
+        return paths
+
+    def put(self, title: str, rev_id: int, wikitext: str):
+        """
+        Store the wikitext of a revision of a page, removing any other stored revisions of that page.
+
+        :param title: The title of the page.
+        :param rev_id: The revision ID.
+        :param wikitext: The wikitext of the page.
+        """
+        path = self._path(title, rev_id, self.compress)
+        tmp_path = path + '.tmp'
+        data = wikitext.encode()
+        if self.compress:
+            data = gzip.compress(data)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        # Write to a temporary file first, so that an interrupted write never leaves a truncated file in the store.
+        os.replace(tmp_path, path)
+        for old_path in self._stored_paths(title).values():
+            if old_path != path:
+                os.remove(old_path)
+
+    def get(self, title: str, rev_id: int) -> Optional[str]:
+        """
+        Get the stored wikitext of a revision of a page.
+
+        :param title: The title of the page.
+        :param rev_id: The revision ID.
+        :return: The wikitext, or None if that revision of the page is not stored.
+        """
+        for compressed in (self.compress, not self.compress):
+            path = self._path(title, rev_id, compressed)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if compressed:
+                    data = gzip.decompress(data)
+                return data.decode()
+        return None
+
+    def latest(self, title: str) -> Optional[tuple[int, str]]:
+        """
+        Get the latest stored revision of a page.
+
+        :param title: The title of the page.
+        :return: A tuple containing the revision ID and the wikitext, or None if no revision of the page is stored.
+        """
+        paths = self._stored_paths(title)
+        if not paths:
+            return None
+        rev_id = max(paths)
+        return rev_id, self.get(title, rev_id)
@@ -1,9 +1,13 @@
+import random
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 
 import pytz
-from onthisday.calendar import make_calendar
-from onthisday.db import DAO
+from onthisday.app.cache import CalendarCache
+from onthisday.calendar import make_calendar, make_descriptions, iter_calendar_ical
+from onthisday.db import DAO, InMemory
+from test_code.test_db import make_test_db, TEST_SNAPSHOT_FPATH
 from test_code.test_utils import is_valid_cal, count_events, check_vevents_start_at
 
 
@@ -28,4 +32,98 @@ class CalendarTestCase(unittest.TestCase):
 
     def test_02_with_tz(self):
         cal = make_calendar(self.DB, tz=pytz.timezone('Europe/London'))
-        self.assertTrue(is_valid_cal(cal.to_ical().decode()))
\ No newline at end of file
+        self.assertTrue(is_valid_cal(cal.to_ical().decode()))
+
+    def test_03_streaming(self):
+        db = InMemory(make_test_db())
+        for tz in (pytz.UTC, pytz.timezone('Europe/London'), pytz.timezone('America/New_York')):
+            for categories in (None, {'Births': 2, 'Deaths': 3, 'Events': 0, 'Holidays and observances': 1}):
+                kwargs = {'start': date(2019, 12, 1), 'end': date(2020, 3, 31), 'tz': tz, 'categories': categories}
+                random.seed(1)
+                expected = make_calendar(db, **kwargs).to_ical()
+                random.seed(1)
+                streamed = b''.join(iter_calendar_ical(db, **kwargs))
+                self.assertEqual(expected, streamed)
+                self.assertTrue(is_valid_cal(streamed.decode()))
+
+    def test_04_seed(self):
+        db = InMemory(make_test_db())
+        kwargs = {'start': date(2020, 1, 1), 'end': date(2020, 12, 31),
+                  'categories': {'Births': 2, 'Deaths': 1, 'Events': 1, 'Holidays and observances': 1}}
+        cal = make_calendar(db, seed='abc', **kwargs).to_ical()
+        self.assertEqual(cal, make_calendar(db, seed='abc', **kwargs).to_ical())
+        self.assertEqual(cal, b''.join(iter_calendar_ical(db, seed='abc', **kwargs)))
+        self.assertNotEqual(cal, make_calendar(db, seed='xyz', **kwargs).to_ical())
+
+    def test_05_window(self):
+        db = InMemory(make_test_db())
+        categories = {'Births': 2, 'Deaths': 1, 'Events': 1, 'Holidays and observances': 1}
+        cal = make_calendar(db, window=(7, 60), categories=categories)
+        self.assertEqual(68, count_events(cal))
+        self.assertEqual(cal.to_ical(), b''.join(iter_calendar_ical(db, window=(7, 60), categories=categories)))
+        # Each day has the same events whichever window it is in.
+        small = b''.join(iter_calendar_ical(db, window=(0, 10), categories=categories))
+        large = b''.join(iter_calendar_ical(db, window=(7, 60), categories=categories))
+        self.assertIn(small.split(b'BEGIN:VEVENT', 1)[1].rsplit(b'END:VCALENDAR', 1)[0], large)
+        # When the window moves, only the newly included days are generated.
+        cache = CalendarCache()
+        b''.join(iter_calendar_ical(db, window=(0, 10), categories=categories, fragment_cache=cache))
+        self.assertEqual((0, 11), (cache.hits, cache.misses))
+        cached = b''.join(iter_calendar_ical(db, window=(0, 20), categories=categories, fragment_cache=cache))
+        self.assertEqual((11, 21), (cache.hits, cache.misses))
+        self.assertEqual(b''.join(iter_calendar_ical(db, window=(0, 20), categories=categories)), cached)
+
+    def test_06_no_repeats(self):
+        db = InMemory(make_test_db())
+        cal = make_calendar(db, start=date(2000, 2, 29), end=date(2012, 2, 29),
+                            categories={'Births': 0, 'Deaths': 1, 'Events': 0, 'Holidays and observances': 0})
+        descriptions = [str(e.get('description')) for e in cal.walk('vevent') if e.get('dtstart').dt.month == 2
+                        and e.get('dtstart').dt.day == 29]
+        self.assertEqual(4, len(descriptions))
+        self.assertEqual(3, len(set(descriptions[:3])))
+
+    def test_07_parallel(self):
+        InMemory(make_test_db()).write_snapshot(TEST_SNAPSHOT_FPATH)
+        db = InMemory.from_snapshot(TEST_SNAPSHOT_FPATH)
+        kwargs = {'start': date(2000, 1, 1), 'end': date(2012, 12, 31), 'seed': 'abc',
+                  'categories': {'Births': 1, 'Deaths': 1, 'Events': 1, 'Holidays and observances': 1}}
+        cal = make_calendar(db, workers=2, **kwargs)
+        self.assertEqual(4749, count_events(cal))
+        dates = [e.get('dtstart').dt.date() for e in cal.walk('vevent')]
+        self.assertListEqual(sorted(dates), dates)
+        # The calendar is the same however it is generated in parallel.
+        with ThreadPoolExecutor(1) as executor:
+            self.assertEqual(cal.to_ical(), make_calendar(db, executor=executor, **kwargs).to_ical())
+        self.assertEqual(cal.to_ical(), b''.join(iter_calendar_ical(db, workers=3, **kwargs)))
+        # ... or without any workers.
+        self.assertEqual(cal.to_ical(), make_calendar(db, **kwargs).to_ical())
+        self.assertEqual(cal.to_ical(), b''.join(iter_calendar_ical(db, **kwargs)))
+        # Events are still not repeated across years.
+        descriptions = [str(e.get('description')) for e in cal.walk('vevent') if e.get('dtstart').dt.month == 2
+                        and e.get('dtstart').dt.day == 29]
+        self.assertEqual(3, len(set(descriptions[:3])))
+
+    def test_08_topic(self):
+        db = InMemory(make_test_db())
+        categories = {'Births': 1, 'Deaths': 1, 'Events': 1, 'Holidays and observances': 1}
+        kwargs = {'start': date(2020, 1, 1), 'end': date(2020, 3, 1), 'categories': categories, 'seed': 'abc'}
+        cal = make_calendar(db, topic='two', **kwargs)
+        descriptions = {e.get('dtstart').dt.date(): str(e.get('description')) for e in cal.walk('vevent')}
+        self.assertEqual(61, len(descriptions))
+        self.assertIn('Event two.', descriptions[date(2020, 1, 1)])
+        self.assertIn('Birth two', descriptions[date(2020, 1, 1)])
+        self.assertNotIn('one', descriptions[date(2020, 1, 1)])
+        self.assertEqual(r'Deaths\n2000: Death two.\n', descriptions[date(2020, 2, 29)])
+        self.assertEqual('', descriptions[date(2020, 3, 1)])
+        self.assertEqual(cal.to_ical(), b''.join(iter_calendar_ical(db, topic='two', **kwargs)))
+        with ThreadPoolExecutor(1) as executor:
+            self.assertEqual(cal.to_ical().count(b'Death two'),
+                             make_calendar(db, topic='two', executor=executor, **kwargs).to_ical().count(b'Death two'))
+
+    def test_09_topic_needs_in_memory(self):
+        db = make_test_db()
+        start = date(2020, 1, 1)
+        self.assertRaisesRegex(ValueError, 'loaded into memory', make_calendar, db, start, topic='two')
+        self.assertRaisesRegex(ValueError, 'loaded into memory', next, iter_calendar_ical(db, start, topic='two'))
+        self.assertRaisesRegex(ValueError, 'loaded into memory', make_descriptions, db, [start], {'Events': 1}, None,
+                               None, 'two')
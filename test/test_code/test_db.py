@@ -0,0 +1,372 @@
+import os
+import pickle
+import random
+import sqlite3
+import unittest
+from unittest import mock
+
+from icalendar.prop import vText
+from onthisday import db as db_module
+from onthisday.common_data import format_event
+from onthisday.db import DAO, InMemory, SearchUnavailableError, SnapshotError, build_select, fts5_available, \
+    get_event_query
+
+TEST_DATA_DIR = 'test_data'
+RUN_DIR = os.path.join(TEST_DATA_DIR, 'run')
+if not os.path.exists(RUN_DIR):
+    os.makedirs(RUN_DIR)
+TEST_DB_FPATH = os.path.join(RUN_DIR, 'test_db.db')
+TEST_SNAPSHOT_FPATH = os.path.join(RUN_DIR, 'test_db.snapshot')
+
+EVENTS = {
+    ('January', 1): {
+        'Events': [('1801', 'Event one.'), ('1901', 'Event two.')],
+        'Births': [
+            ('1900', 'Birth one.'),
+            ('1901', 'Birth two, with a long description; including "punctuation", a backslash (\\), non-ASCII '
+                     'characters (Ærøskøbing, 東京, 🎉) and enough text to need folding more than once.')
+        ],
+        'Deaths': [],
+        'Holidays and observances': [('', 'Holiday one')]
+    },
+    ('February', 29): {
+        'Events': [('2004', 'Leap event.')],
+        'Births': [],
+        'Deaths': [('1999', 'Death one.'), ('2000', 'Death two.'), ('2001', 'Death three.')],
+        'Holidays and observances': []
+    }
+}
+
+
+def make_test_db(fpath: str = TEST_DB_FPATH) -> DAO:
+    """
+    Create a fresh database at the given path, populated with :data:`EVENTS`.
+    """
+    if os.path.exists(fpath):
+        os.remove(fpath)
+    db = DAO(fpath)
+    for (m, d), events in EVENTS.items():
+        db.insert_events(m, d, 1, events)
+        db.insert_revision(m, d, 1)
+    db.commit()
+    return db
+
+
+class DBTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_test_db()
+
+    def test_01_in_memory_load(self):
+        mem = InMemory(self.db)
+        self.assertEqual(9, mem.row_count)
+        for (m, d), events in EVENTS.items():
+            for c in events:
+                in_mem = mem.get_all_events(m, d, c)
+                self.assertListEqual(self.db.get_all_events(m, d, c), in_mem)
+                self.assertSetEqual(
+                    {vText(format_event(y, desc)).to_ical().decode() for _, _, _, y, desc in in_mem},
+                    set(mem.get_random_events(m, d, c, len(in_mem), rendered=True)) if in_mem else set()
+                )
+        self.assertListEqual([], mem.get_all_events('March', 3, 'Events'))
+        self.assertListEqual([], mem.get_random_events('March', 3, 'Events'))
+        self.assertRaises(KeyError, mem.get_random_events, 'Smarch', 3, 'Events')
+
+    def test_02_lookup_uses_index(self):
+        query, params = get_event_query('January', 1, 'Events')
+        self.assertNotIn('January', query)
+        self.assertTupleEqual(('January', 1, 'Events'), params)
+        plan = ' '.join(row[-1] for row in self.db.db.execute(f'EXPLAIN QUERY PLAN {query}', params))
+        self.assertIn('COVERING INDEX', plan)
+        self.assertListEqual(
+            [('January', 1, 'Events', '1801', 'Event one.'), ('January', 1, 'Events', '1901', 'Event two.')],
+            sorted(self.db.get_all_events('january', 1, 'Events'))
+        )
+
+    def test_03_random_events(self):
+        all_events = set(self.db.get_all_events())
+        deaths = set(self.db.get_all_events('February', 29, 'Deaths'))
+
+        sampled = self.db.get_random_events('February', 29, 'Deaths', 3)
+        self.assertEqual(3, len(sampled))
+        self.assertSetEqual(deaths, set(sampled))
+        self.assertListEqual([], self.db.get_random_events('March', 3, 'Deaths', 3))
+
+        sampled = self.db.get_random_events(count=100)
+        self.assertEqual(len(all_events), len(sampled))
+        self.assertSetEqual(all_events, set(sampled))
+
+        for m, d, c, y, desc in self.db.get_random_events(event_category='Deaths', count=2):
+            self.assertEqual('Deaths', c)
+            self.assertIn((m, d, c, y, desc), deaths)
+
+        self.assertRaises(ValueError, self.db.get_random_events, 'Smarch', 1)
+
+    def test_04_replace_events(self):
+        new_events = {
+            'Events': [('2020', 'New event.')],
+            'Births': [],
+            'Deaths': [('2021', 'New death.')],
+            'Holidays and observances': []
+        }
+        for _ in range(2):
+            self.assertEqual(2, self.db.replace_events('February', 29, 2, new_events))
+            self.assertEqual(2, self.db.get_revision('February', 29))
+            self.assertSetEqual(
+                {('February', 29, 'Events', '2020', 'New event.'), ('February', 29, 'Deaths', '2021', 'New death.')},
+                set(self.db.get_all_events('February', 29))
+            )
+        self.assertEqual(5, len(self.db.get_all_events('January', 1)))
+        self.assertEqual(1, self.db.get_revision('January', 1))
+
+    def test_05_snapshot(self):
+        mem = InMemory(self.db)
+        mem.write_snapshot(TEST_SNAPSHOT_FPATH)
+        snap = InMemory.from_snapshot(TEST_SNAPSHOT_FPATH, self.db)
+        self.assertEqual(mem.version, snap.version)
+        self.assertEqual(mem.row_count, snap.row_count)
+        for m, d in InMemory.DATES:
+            for c in InMemory.CATEGORIES:
+                self.assertListEqual(mem.get_all_events(m, d, c), snap.get_all_events(m, d, c))
+        self.assertEqual(2, len(snap.get_random_events('January', 1, 'Births', 2, rendered=True)))
+
+        self.db.replace_events('January', 1, 2, {'Events': [('2000', 'Changed.')]})
+        self.assertRaises(SnapshotError, InMemory.from_snapshot, TEST_SNAPSHOT_FPATH, self.db)
+        with open(TEST_SNAPSHOT_FPATH, 'wb') as f:
+            f.write(b'Not a snapshot')
+        self.assertRaises(SnapshotError, InMemory.from_snapshot, TEST_SNAPSHOT_FPATH)
+
+    def test_06_sampler(self):
+        mem = InMemory(self.db)
+        deaths = sorted(mem.get_all_events('February', 29, 'Deaths'))
+        sampler = mem.sampler(random.Random(1))
+        for _ in range(5):
+            # Each event is used once before any is repeated.
+            drawn = [sampler.get_random_events('February', 29, 'Deaths')[0] for _ in range(3)]
+            self.assertListEqual(deaths, sorted(drawn))
+        for _ in range(10):
+            # Events selected together are always distinct, even when a new permutation is started part way through.
+            self.assertEqual(2, len(set(sampler.get_random_events('February', 29, 'Deaths', 2))))
+        self.assertListEqual([], sampler.get_random_events('February', 29, 'Deaths', 4))
+        self.assertListEqual([], sampler.get_random_events('January', 1, 'Deaths'))
+        self.assertListEqual(
+            mem.get_random_events('January', 1, 'Holidays and observances', rendered=True),
+            sampler.get_random_events('January', 1, 'Holidays and observances', rendered=True)
+        )
+
+    def test_07_pickle(self):
+        db = pickle.loads(pickle.dumps(self.db))
+        self.assertEqual(self.db.get_version(), db.get_version())
+        mem = InMemory(self.db)
+        self.assertEqual(mem.get_all_events('January', 1, 'Births'),
+                         pickle.loads(pickle.dumps(mem)).get_all_events('January', 1, 'Births'))
+        mem.write_snapshot(TEST_SNAPSHOT_FPATH)
+        snapshot = InMemory.from_snapshot(TEST_SNAPSHOT_FPATH)
+        # An object opened from a snapshot is pickled as a reference to the file.
+        data = pickle.dumps(snapshot)
+        self.assertLess(len(data), 1000)
+        unpickled = pickle.loads(data)
+        self.assertEqual(mem.get_all_events('January', 1, 'Births'), unpickled.get_all_events('January', 1, 'Births'))
+        self.assertIs(unpickled, pickle.loads(data))
+
+    def test_08_years(self):
+        self.db.replace_events('March', 15, 2, {
+            'Events': [('44 BC', 'Caesar dies.'), ('AD 79', 'Vesuvius erupts.'), ('c. 1500', 'Something happens.')],
+            'Births': [('1905', 'Birth.')],
+            'Deaths': [],
+            'Holidays and observances': [('', 'Holiday.')]
+        })
+        self.assertListEqual(
+            [('March', 15, 'Events', '44 BC', 'Caesar dies.'), ('March', 15, 'Events', 'AD 79', 'Vesuvius erupts.'),
+             ('March', 15, 'Events', 'c. 1500', 'Something happens.'), ('March', 15, 'Births', '1905', 'Birth.')],
+            self.db.get_events_by_year(month='March', date=15)
+        )
+        self.assertListEqual(['44 BC', 'AD 79'], [e[3] for e in self.db.get_events_by_year(-100, 100)])
+        self.assertListEqual(['1801', '1900', '1901', '1901'],
+                             [e[3] for e in self.db.get_events_by_year(1800, 1950, 'January', 1)])
+        self.assertListEqual(['1901'], [e[3] for e in self.db.get_events_by_year(1901, 1901, 'January', 1, 'Births')])
+        plan = ' '.join(row[-1] for row in self.db.db.execute(
+            'EXPLAIN QUERY PLAN SELECT * FROM events WHERE month = ? AND date = ? AND year_int BETWEEN ? AND ?',
+            ('January', 1, 1900, 1950)
+        ))
+        self.assertIn('events_by_date_year', plan)
+
+    def test_09_migrate_years(self):
+        self.db.db.close()
+        os.remove(TEST_DB_FPATH)
+        conn = sqlite3.connect(TEST_DB_FPATH)
+        conn.execute("""
+            CREATE TABLE events(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                month TEXT NOT NULL COLLATE NOCASE,
+                date INTEGER NOT NULL,
+                rev_id INTEGER NOT NULL,
+                event_category TEXT NOT NULL COLLATE NOCASE,
+                year TEXT NOT NULL COLLATE NOCASE,
+                description TEXT NOT NULL
+            )
+        """)
+        conn.executemany('INSERT INTO events(month, date, rev_id, event_category, year, description) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         [('May', 1, 1, 'Events', '44 BC', 'Old event.'),
+                          ('May', 1, 1, 'Holidays and observances', '', 'Holiday.')])
+        conn.commit()
+        conn.close()
+        db = DAO(TEST_DB_FPATH)
+        self.assertListEqual([(-44, 'Old event.'), (None, 'Holiday.')],
+                             db.db.execute('SELECT year_int, description FROM events ORDER BY id').fetchall())
+        self.assertEqual(1, len(db.get_events_by_year(-44, -44, 'May', 1)))
+        self.assertListEqual([('May', 1, 'Events', '44 BC', 'Old event.')], db.search_events('old'))
+
+    def test_10_search(self):
+        self.assertListEqual([('January', 1, 'Births', '1900', 'Birth one.')], self.db.search_events('one birth'))
+        self.assertEqual(3, len(self.db.search_events('Death')))
+        self.assertEqual(2, len(self.db.search_events('death', limit=2)))
+        self.assertListEqual([('February', 29, 'Deaths', '2000', 'Death two.')],
+                             self.db.search_events('two', 'February', 29, 'Deaths'))
+        self.assertListEqual([], self.db.search_events('two', event_category='Births', month='February'))
+        # Words are matched regardless of case or ending; punctuation and operators are ignored.
+        self.assertEqual(1, len(self.db.search_events('ÆRØSKØBING, "folded*" (-text:')))
+        self.assertListEqual([], self.db.search_events('*" -'))
+        self.assertRaises(ValueError, self.db.search_events, 'one', 'Smarch')
+        self.db.replace_events('February', 29, 2, {'Events': [('2020', 'Replaced event.')]})
+        self.assertListEqual([], self.db.search_events('leap'))
+        self.assertListEqual([('February', 29, 'Events', '2020', 'Replaced event.')], self.db.search_events('replace'))
+
+    def test_11_topics(self):
+        mem = InMemory(self.db)
+        self.assertListEqual([('January', 1, 'Births', '1900', 'Birth one.')],
+                             mem.get_random_events('January', 1, 'Births', topic='ONE'))
+        self.assertEqual(2, len(mem.get_random_events('January', 1, 'Births', 2, topic='birth')))
+        self.assertListEqual([], mem.get_random_events('January', 1, 'Births', 2, topic='birth two'))
+        self.assertListEqual([], mem.get_random_events('January', 1, 'Births', topic='nothing'))
+        # Whole words are matched, regardless of case.
+        self.assertListEqual([], mem.get_random_events('January', 1, 'Events', topic='even'))
+        self.assertEqual(1, len(mem.get_random_events('January', 1, 'Births', topic='ærøskøbing, 東京')))
+        self.assertRaises(ValueError, mem.get_random_events, 'January', 1, 'Births', topic='!?')
+        positions, offsets = mem.get_topic_positions('death')
+        self.assertEqual(3, len(positions))
+        self.assertEqual(len(InMemory.DATES) * len(InMemory.CATEGORIES) + 1, len(offsets))
+        self.assertIs(positions, mem.get_topic_positions('Death')[0])
+
+        mem.write_snapshot(TEST_SNAPSHOT_FPATH)
+        for other in (InMemory.from_snapshot(TEST_SNAPSHOT_FPATH), pickle.loads(pickle.dumps(mem))):
+            for topic in ('one', 'birth', 'two death', 'event', 'nothing'):
+                for m, d in EVENTS:
+                    for c in InMemory.CATEGORIES:
+                        self.assertListEqual(
+                            sorted(mem.get_random_events(m, d, c, 1, topic=topic, rng=random.Random(1))),
+                            sorted(other.get_random_events(m, d, c, 1, topic=topic, rng=random.Random(1)))
+                        )
+
+        sampler = mem.sampler(random.Random(1))
+        for _ in range(3):
+            drawn = [sampler.get_random_events('February', 29, 'Deaths', topic='death')[0] for _ in range(3)]
+            self.assertListEqual(sorted(self.db.get_all_events('February', 29, 'Deaths')), sorted(drawn))
+        self.assertListEqual([('January', 1, 'Events', '1901', 'Event two.')],
+                             sampler.get_random_events('January', 1, 'Events', topic='two'))
+
+    def test_12_old_snapshot(self):
+        InMemory(self.db).write_snapshot(TEST_SNAPSHOT_FPATH)
+        with open(TEST_SNAPSHOT_FPATH, 'r+b') as f:
+            f.write(b'OTDSNAP1')
+        with self.assertRaisesRegex(SnapshotError, 'format'):
+            InMemory.from_snapshot(TEST_SNAPSHOT_FPATH)
+
+    def test_13_descriptions_round_trip(self):
+        events = {'Events': [('1950', 'Line one\r\nline two\rline three'), ('1951', r'A literal \N and \n; done.')],
+                  'Holidays and observances': [('', 'Holiday\r\n')]}
+        self.db.replace_events('March', 3, 2, events)
+        mem = InMemory(self.db)
+        mem.write_snapshot(TEST_SNAPSHOT_FPATH)
+        for other in (mem, InMemory.from_snapshot(TEST_SNAPSHOT_FPATH), pickle.loads(pickle.dumps(mem))):
+            for c in events:
+                self.assertListEqual(self.db.get_all_events('March', 3, c), other.get_all_events('March', 3, c))
+                self.assertSetEqual(set(self.db.get_all_events('March', 3, c)),
+                                    set(other.get_random_events('March', 3, c, len(events[c]))))
+        # The rendered events are escaped as before.
+        first = mem.group_offsets[mem.get_group('March', 3, 'Events')]
+        self.assertEqual(r'1950: Line one\nline two\nline three', mem.get_rendered_event(first))
+
+    def test_14_truncated_snapshot(self):
+        InMemory(self.db).write_snapshot(TEST_SNAPSHOT_FPATH)
+        with open(TEST_SNAPSHOT_FPATH, 'rb') as f:
+            data = f.read()
+        for size in (InMemory.SNAPSHOT_HEADER.size, len(data) // 3, len(data) // 2, len(data) - 1, len(data) + 1):
+            with open(TEST_SNAPSHOT_FPATH, 'wb') as f:
+                f.write((data + b'\0')[:size])
+            with self.assertRaisesRegex(SnapshotError, 'truncated'):
+                InMemory.from_snapshot(TEST_SNAPSHOT_FPATH)
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'Requires a /proc filesystem.')
+    def test_15_snapshot_errors_close_file(self):
+        InMemory(self.db).write_snapshot(TEST_SNAPSHOT_FPATH)
+        with open(TEST_SNAPSHOT_FPATH, 'rb') as f:
+            data = f.read()
+        n_fds = len(os.listdir('/proc/self/fd'))
+        # The errors (and their tracebacks) are kept, as they would be if logged, for example.
+        errors = []
+        for bad in (data[:-1], b'NOTASNAP' + data[8:], data.replace(self.db.get_version().encode(), b'x' * 64)):
+            with open(TEST_SNAPSHOT_FPATH, 'wb') as f:
+                f.write(bad)
+            try:
+                InMemory.from_snapshot(TEST_SNAPSHOT_FPATH, self.db)
+            except SnapshotError as e:
+                errors.append(e)
+        self.assertEqual(3, len(errors))
+        self.assertEqual(n_fds, len(os.listdir('/proc/self/fd')))
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'Requires a /proc filesystem.')
+    def test_16_replaced_snapshot(self):
+        InMemory(self.db).write_snapshot(TEST_SNAPSHOT_FPATH)
+        mem = InMemory.from_snapshot(TEST_SNAPSHOT_FPATH)
+        pickled = pickle.dumps(mem)
+        # Replace the snapshot with one of a different version of the data, as `otd.py snapshot` would.
+        self.db.replace_events('January', 1, 2, {'Events': [('1802', 'New event.')]})
+        InMemory(self.db).write_snapshot(TEST_SNAPSHOT_FPATH)
+        db_module._unpickled_snapshots.clear()
+        unpickled = pickle.loads(pickled)
+        self.assertEqual(mem.version, unpickled.version)
+        self.assertListEqual(mem.get_all_events('January', 1, 'Events'),
+                             unpickled.get_all_events('January', 1, 'Events'))
+        self.assertNotEqual(mem.version, InMemory.from_snapshot(TEST_SNAPSHOT_FPATH).version)
+
+    def test_17_select_conditions(self):
+        self.assertTupleEqual(
+            ('SELECT year FROM events WHERE year_int IS NOT NULL ORDER BY year_int', ()),
+            build_select('events', 'year', conditions=[('year_int IS NOT NULL', ())], order_by='year_int')
+        )
+        query, params = get_event_query('January', 1,
+                                        conditions=[('year_int >= ?', (1900,)), ('year_int <= ?', (1950,))])
+        self.assertEqual(1, query.count(' WHERE '))
+        self.assertTupleEqual(('January', 1, 1900, 1950), params)
+        self.assertListEqual(['1900', '1901', '1901'], [e[3] for e in self.db.db.execute(query, params)])
+
+    def test_18_no_fts5(self):
+        self.assertTrue(fts5_available())
+        self.assertEqual(1, fts5_available.cache_info().currsize)
+        with mock.patch('onthisday.db.fts5_available', return_value=False):
+            db = make_test_db()
+        self.assertFalse(db.has_fts)
+        self.assertIsNone(db.db.execute(DAO.CHECK_EVENT_FTS).fetchone())
+        db.replace_events('February', 29, 2, {'Events': [('2020', 'Replaced event.')]})
+        self.assertEqual(1, len(db.get_all_events('February', 29)))
+        self.assertRaises(SearchUnavailableError, db.search_events, 'replaced')
+        # The index is built when the database is next opened with FTS5.
+        self.assertListEqual([('February', 29, 'Events', '2020', 'Replaced event.')],
+                             DAO(TEST_DB_FPATH).search_events('replaced'))
+
+    def test_19_topic_cache(self):
+        mem = InMemory(self.db)
+        with mock.patch.object(InMemory, 'TOPIC_CACHE_SIZE', 2):
+            one, _ = mem.get_topic_positions('one')
+            two, _ = mem.get_topic_positions('two')
+            self.assertTrue(one is mem.get_topic_positions('One')[0])
+            # "two" is now the least recently used topic, so is evicted rather than "one".
+            mem.get_topic_positions('death')
+            self.assertTrue(one is mem.get_topic_positions('one')[0])
+            self.assertFalse(two is mem.get_topic_positions('two')[0])
+            self.assertEqual(2, len(mem._topics))
+        unpickled = pickle.loads(pickle.dumps(mem))
+        self.assertEqual(0, len(unpickled._topics))
+        self.assertListEqual(list(one), list(unpickled.get_topic_positions('one')[0]))
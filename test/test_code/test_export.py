@@ -0,0 +1,77 @@
+import json
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import pytz
+from onthisday.calendar import iter_calendar_ical
+from onthisday.db import InMemory
+from onthisday.export import read_manifest, export_calendars
+from test_code.test_db import make_test_db, RUN_DIR, TEST_SNAPSHOT_FPATH
+from test_code.test_utils import is_valid_cal
+
+TEST_EXPORT_DIR = os.path.join(RUN_DIR, 'export')
+TEST_MANIFEST_FPATH = os.path.join(RUN_DIR, 'manifest')
+
+MANIFEST = [
+    {'filename': 'london.ics', 'timezone': 'Europe:London', 'start': '2020-01-01', 'end': '2020-12-31', 'seed': 'a'},
+    {'filename': 'new_york.ics', 'timezone': 'America:New_York', 'start': '2020-01-01', 'end': '2020-12-31',
+     'seed': 'a', 'time': '18:30'},
+    {'timezone': 'Asia:Tokyo', 'start': '2020-01-01', 'end': '2020-12-31', 'births': 2, 'deaths': 3},
+    {'timezone': 'UTC', 'start': '2020-01-01', 'end': '2020-12-31', 'births': 2, 'deaths': 3}
+]
+
+
+class ExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = InMemory(make_test_db())
+
+    def test_01_read_manifest(self):
+        with open(TEST_MANIFEST_FPATH + '.json', 'w') as f:
+            json.dump(MANIFEST, f)
+        entries = read_manifest(TEST_MANIFEST_FPATH + '.json')
+        self.assertEqual('2', entries[2]['births'])
+        with open(TEST_MANIFEST_FPATH + '.csv', 'w') as f:
+            f.write('filename,timezone,births,seed\n')
+            f.write('a.ics,Europe:London,2,\n')
+        self.assertListEqual([{'filename': 'a.ics', 'timezone': 'Europe:London', 'births': '2'}],
+                             read_manifest(TEST_MANIFEST_FPATH + '.csv'))
+
+    def test_02_export(self):
+        entries = [{k: str(v) for k, v in entry.items()} for entry in MANIFEST]
+        with ThreadPoolExecutor(2) as executor:
+            self.assertEqual(4, export_calendars(self.db, entries, TEST_EXPORT_DIR, executor=executor))
+        fpaths = [os.path.join(TEST_EXPORT_DIR, fname)
+                  for fname in ('london.ics', 'new_york.ics', 'calendar_2.ics', 'calendar_3.ics')]
+        cals = []
+        for fpath in fpaths:
+            with open(fpath, 'rb') as f:
+                cals.append(f.read())
+            self.assertTrue(is_valid_cal(cals[-1].decode()))
+        # Seeded calendars are the same as those served by the web app.
+        self.assertEqual(b''.join(iter_calendar_ical(self.db, date(2020, 1, 1), date(2020, 12, 31),
+                                                     tz=pytz.timezone('Europe/London'), seed='a')), cals[0])
+        # Calendars which differ only in time and timezone have the same events.
+        for a, b in ((cals[0], cals[1]), (cals[2], cals[3])):
+            self.assertEqual([l for l in a.split(b'\r\n') if not l.startswith(b'DTSTART')],
+                             [l for l in b.split(b'\r\n') if not l.startswith(b'DTSTART')])
+
+    def test_03_bad_manifest(self):
+        for entries in ([{'timezone': 'BAD_TIMEZONE'}], [{'filename': '../a.ics'}],
+                        [{}, {'filename': 'calendar_0.ics'}], [{'start': '2020-01-01', 'end': '2019-01-01'}]):
+            with self.assertRaises(ValueError):
+                export_calendars(self.db, entries, TEST_EXPORT_DIR, workers=1)
+
+    def test_04_export_in_processes(self):
+        InMemory(make_test_db()).write_snapshot(TEST_SNAPSHOT_FPATH)
+        db = InMemory.from_snapshot(TEST_SNAPSHOT_FPATH)
+        entries = [{k: str(v) for k, v in entry.items()} for entry in MANIFEST]
+        entries.append({'filename': 'tokyo.ics', 'timezone': 'Asia:Tokyo', 'start': '2020-01-01', 'end': '2020-12-31',
+                        'seed': 'b'})
+        self.assertEqual(5, export_calendars(db, entries, TEST_EXPORT_DIR, workers=2))
+        for fname, tz, seed in (('london.ics', 'Europe/London', 'a'), ('tokyo.ics', 'Asia/Tokyo', 'b')):
+            with open(os.path.join(TEST_EXPORT_DIR, fname), 'rb') as f:
+                self.assertEqual(b''.join(iter_calendar_ical(db, date(2020, 1, 1), date(2020, 12, 31),
+                                                             tz=pytz.timezone(tz), seed=seed)), f.read())
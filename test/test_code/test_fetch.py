@@ -1,14 +1,20 @@
 import os
+import shutil
 import unittest
 
+from onthisday.common_data import iter_dates
 from onthisday.db import DAO
-from onthisday.get_data import parse_date_to_db, AlreadyScraped, ParsingError
+from onthisday.get_data import parse_date_to_db, parse_all_to_db, reparse_all_to_db, iter_parsed, AlreadyScraped, \
+    ParsingError
+from onthisday.wikitext_store import WikitextStore
+from test_code.test_utils import StubWikiServer, CANNED_WIKITEXT
 
 TEST_DATA_DIR = 'test_data'
 RUN_DIR = os.path.join(TEST_DATA_DIR, 'run')
 if not os.path.exists(RUN_DIR):
     os.makedirs(RUN_DIR)
 TEST_DB_FPATH = os.path.join(RUN_DIR, 'test.db')
+TEST_WIKITEXT_DIR = os.path.join(RUN_DIR, 'wikitext')
 
 
 class FetchDataTest(unittest.TestCase):
@@ -40,4 +46,73 @@ class FetchDataTest(unittest.TestCase):
             self.assertRaises(ParsingError, parse_date_to_db, m, d, self.db)
 
 
+class StubFetchDataTest(unittest.TestCase):
 
+    PAGES = {f'{m} {d}': (100, CANNED_WIKITEXT) for m, d in iter_dates()}
+
+    def setUp(self):
+        if os.path.exists(TEST_DB_FPATH):
+            os.remove(TEST_DB_FPATH)
+        self.db = DAO(TEST_DB_FPATH)
+
+    def test_01_fetch_all_concurrently(self):
+        with StubWikiServer(self.PAGES) as stub:
+            self.assertEqual(366 * 5, parse_all_to_db(self.db, workers=8, api_url=stub.api_url))
+            # One client per worker thread, plus one for checking revision IDs
+            self.assertLessEqual(len([p for p in stub.requests if p.get('meta') == 'siteinfo']), 9)
+            self.assertEqual(0, parse_all_to_db(self.db, workers=8, api_url=stub.api_url))
+        self.assertEqual(100, self.db.get_revision('February', 29))
+        self.assertListEqual(
+            [('February', 29, 'Events', '1066', 'William I is crowned.')],
+            self.db.get_all_events('February', 29, 'Events')[:1]
+        )
+
+    def test_02_only_fetch_changed(self):
+        pages = self.PAGES.copy()
+        with StubWikiServer(pages) as stub:
+            parse_all_to_db(self.db, workers=4, api_url=stub.api_url)
+            stub.requests.clear()
+            pages['June 15'] = (101, CANNED_WIKITEXT.replace('Someone dies.', 'Someone else dies.'))
+            self.assertEqual(5, parse_all_to_db(self.db, workers=4, api_url=stub.api_url))
+        content_requests = [p for p in stub.requests if 'content' in p.get('rvprop', '')]
+        id_requests = [p for p in stub.requests if p.get('rvprop') == 'ids']
+        self.assertEqual(1, len(content_requests))
+        self.assertEqual('June_15', content_requests[0]['titles'])
+        self.assertEqual(8, len(id_requests))
+        self.assertEqual(101, self.db.get_revision('June', 15))
+        self.assertEqual(5, len(self.db.get_all_events('June', 15)))
+
+    def test_03_reparse_from_store(self):
+        if os.path.exists(TEST_WIKITEXT_DIR):
+            shutil.rmtree(TEST_WIKITEXT_DIR)
+        store = WikitextStore(TEST_WIKITEXT_DIR)
+        with StubWikiServer(self.PAGES) as stub:
+            parse_all_to_db(self.db, workers=4, api_url=stub.api_url, store=store)
+        self.assertEqual(CANNED_WIKITEXT, store.get('March_3', 100))
+        self.assertTupleEqual((100, CANNED_WIKITEXT), store.latest('March_3'))
+
+        # Server is no longer running, so reparsing must work offline
+        self.assertEqual(366 * 5, reparse_all_to_db(self.db, store))
+        self.assertEqual(366 * 5, len(self.db.get_all_events()))
+
+        store.put('March_3', 101, 'New wikitext')
+        self.assertIsNone(store.get('March_3', 100))
+        self.assertTupleEqual((101, 'New wikitext'), store.latest('March_3'))
+
+    def test_04_parse_in_processes(self):
+        if os.path.exists(TEST_WIKITEXT_DIR):
+            shutil.rmtree(TEST_WIKITEXT_DIR)
+        store = WikitextStore(TEST_WIKITEXT_DIR)
+        with StubWikiServer(self.PAGES) as stub:
+            self.assertEqual(366 * 5, parse_all_to_db(self.db, workers=4, api_url=stub.api_url, store=store,
+                                                      parse_workers=2))
+        events = self.db.get_all_events()
+        self.assertEqual(366 * 5, len(events))
+        self.assertEqual(366 * 5, reparse_all_to_db(self.db, store, workers=2))
+        self.assertListEqual(sorted(events), sorted(self.db.get_all_events()))
+
+        pages = [(i, CANNED_WIKITEXT) for i in range(20)] + [(20, '* 1900 – No heading.')]
+        parsed = dict(iter_parsed(pages, workers=2, chunk_size=3))
+        self.assertListEqual(list(range(21)), sorted(parsed))
+        self.assertEqual(('1066', 'William I is crowned.'), parsed[19]['Events'][0])
+        self.assertIsInstance(parsed[20], ParsingError)
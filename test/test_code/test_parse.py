@@ -1,6 +1,9 @@
 import unittest
 
-from onthisday.get_data import parse_holidays
+import wikitextparser
+from onthisday.common_data import parse_year
+from onthisday.get_data import parse_holidays, parse_text, parse_wikitext, ParsingError
+from test_code.test_utils import CANNED_WIKITEXT
 
 LISTS = (
     (
@@ -24,8 +27,71 @@ LISTS = (
     ),
 )
 
+WIKITEXT_PAGES = (
+    CANNED_WIKITEXT,
+    """{{Short description|Day of the year}}
+{{Calendar|float=right}}
+'''January 1''' is the first day of the year.<ref>{{cite web|url=http://example.com|title=''Days''}}</ref>
+<!--
+* 1999 – Not an event.
+-->
+==Events==
+===Pre-1600===
+* [[45 BC]] – The [[Julian calendar]] takes effect.
+* [[153]] – [[Roman consul]]s begin their year in office.<ref name="a" />
+* [[1001]] – ''[[Stephen I of Hungary|Stephen I]]'' is crowned '''King'''.<ref>{{cite|t=A {{nowrap|B}}}}</ref>
+* [[1068]] – [[Romanos IV Diogenes]] marries [[Eudokia Makrembolitissa]] and becomes Emperor.
+===1601–1900===
+* [[1700]] – Russia begins using the [[Anno Domini|AD]] era instead of the [[Anno Mundi]] era.
+* [[1788]] – First edition of ''[[The Times]]'', previously ''[[The Daily Universal Register]]'', is published.
+* 1801 – The [[Kingdom of Great Britain|Kingdom<br />of Great Britain]] and Ireland&nbsp;merge.
+* [[1804]] – French rule ends in [[Haiti]].<ref>Plain reference,
+split over two lines.</ref>
+* [[1808]] – The importation of slaves into the United States is banned.{{efn|See the
+[[Act Prohibiting Importation of Slaves]].}}
+==Births==
+* [[1449]] – [[Lorenzo de' Medici]], Italian politician (d. 1492)
+* [[1879]] – [[E. M. Forster]], English author<span style="color:red">*</span> (d. 1970)
+* [[1919]] – [[J. D. Salinger]], American author of ''[[The Catcher in the Rye]]'' (d. 2010)
+*[[1956]] – [[Christine Lagarde]], French lawyer and politician, <small>[[IMF]]</small>
+==Deaths==
+* [[1515]] – [[Louis XII of France]] (b. 1462)
+* [[1994]] – [[Arthur Porritt, Baron Porritt|Arthur Porritt]], New Zealand physician{{'}}s son (b. 1900)
+* [[2000]] – '''[[Someone]]''', [[England]]'s ''oldest'' person
+==Holidays and observances==
+* [[Christian feast day]]:
+** [[Basil of Caesarea]] ([[Eastern Orthodox Church|Greek Orthodox]])
+** [[Fulgentius]]<ref>{{cite|x}}</ref>
+*** ''[[Circumcision of Christ]]''
+* [[New Year's Day]]
+* 1900 – An event in the holidays section.
+==References==
+{{reflist}}
+==External links==
+* [[2000]] – Not an event.
+""",
+)
+
+
 class ParsingTestCase(unittest.TestCase):
 
     def test_01_parse_holidays(self):
         for in_list, out_list in LISTS:
-            self.assertListEqual(parse_holidays(in_list), out_list)
\ No newline at end of file
+            self.assertListEqual(parse_holidays(in_list), out_list)
+
+    def test_02_parse_wikitext(self):
+        for wikitext in WIKITEXT_PAGES:
+            expected = parse_text(wikitextparser.parse(wikitext).plain_text())
+            self.assertDictEqual(expected, parse_wikitext(wikitext))
+        self.assertRaises(ParsingError, parse_wikitext, 'Intro.\n* [[1900]] – Before any heading.\n==Events==')
+
+    def test_03_years(self):
+        parsed = parse_wikitext('==Events==\n* [[AD 79]] – Vesuvius erupts.\n* [[44 BC]] – Caesar dies.\n'
+                                '* c. 1500 – Something happens.\n* [[1066]] – William I is crowned.')
+        self.assertListEqual(
+            [('AD 79', 'Vesuvius erupts.'), ('44 BC', 'Caesar dies.'), ('c. 1500', 'Something happens.'),
+             ('1066', 'William I is crowned.')],
+            parsed['Events']
+        )
+        self.assertListEqual([79, -44, 1500, 1066, None, None],
+                             [parse_year(y) for y in ('AD 79', '44 BC', 'c. 1500', '1066', '', 'Sometime')])
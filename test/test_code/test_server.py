@@ -1,10 +1,26 @@
+import gzip
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+from unittest import mock
 
 import pytz
 import requests
 from icalendar import Calendar
-from test_code.test_utils import check_vevents_start_at, count_events
+from onthisday.app.async_calendar import CalendarApp, run
+from onthisday.app.cache import CalendarCache
+from onthisday.app.download_calendar import app
+from onthisday.app.prefork import PreforkServer, INITIAL_RESPAWN_DELAY, MAX_RESPAWN_DELAY, MIN_WORKER_LIFETIME
+from onthisday.db import InMemory
+from test_code.test_db import make_test_db, TEST_DB_FPATH, TEST_SNAPSHOT_FPATH
+from test_code.test_utils import check_vevents_start_at, count_events, asgi_get
 
 
 class ServerTestCase(unittest.TestCase):
@@ -39,3 +55,337 @@ class ServerTestCase(unittest.TestCase):
         self.assertEqual('Error parsing input: The hour of the event must be between 0 and 23 (inclusive).',
                          r.text.strip())
 
+
+class AppTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app.config['db'] = InMemory(make_test_db())
+        self.client = app.test_client()
+
+    def test_01_streaming(self):
+        r = self.client.get('/calendar?start=2020-01-01&end=2020-12-31')
+        self.assertTrue(r.is_streamed)
+        self.assertEqual('text/calendar', r.headers['Content-Type'])
+        self.assertNotIn('Content-Encoding', r.headers)
+        cal = Calendar.from_ical(r.data)
+        self.assertEqual(366, count_events(cal))
+
+    def test_02_gzip(self):
+        r = self.client.get('/calendar?start=2020-01-01&end=2020-12-31', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', r.headers['Content-Encoding'])
+        cal = Calendar.from_ical(gzip.decompress(r.data))
+        self.assertEqual(366, count_events(cal))
+
+    def test_03_bad_range(self):
+        r = self.client.get('/calendar?start=2020-01-01&end=2019-12-31')
+        self.assertTrue(r.text.startswith('Error generating calendar.'))
+
+    def test_04_seed_cache(self):
+        cache = app.config['cache'] = CalendarCache()
+        url = '/calendar?start=2020-01-01&end=2020-12-31&births=2&seed=abc'
+        r1 = self.client.get(url)
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+        self.assertEqual(366, count_events(Calendar.from_ical(r1.data)))
+        r2 = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        self.assertEqual('gzip', r2.headers['Content-Encoding'])
+        self.assertEqual(r1.data, gzip.decompress(r2.data))
+        self.client.get('/calendar?births=2&end=2020-12-31&seed=abc&start=2020-01-01&time=09:00')
+        self.assertEqual((2, 1), (cache.hits, cache.misses))
+        self.client.get('/calendar?start=2020-01-01&end=2020-12-31&births=2&seed=xyz')
+        self.assertEqual((2, 2), (cache.hits, cache.misses))
+        r4 = self.client.get('/calendar?start=2020-01-01&end=2020-12-31&births=2')
+        self.assertTrue(r4.is_streamed)
+        self.assertEqual((2, 2), (cache.hits, cache.misses))
+
+    def test_05_conditional(self):
+        cache = app.config['cache'] = CalendarCache()
+        url = '/calendar?start=2020-01-01&end=2020-12-31&seed=abc'
+        r1 = self.client.get(url)
+        etag, weak = r1.get_etag()
+        self.assertFalse(weak)
+        self.assertIsNotNone(r1.last_modified)
+        r2 = self.client.get(url, headers={'If-None-Match': r1.headers['ETag']})
+        self.assertEqual(304, r2.status_code)
+        self.assertEqual(b'', r2.data)
+        self.assertEqual(r1.headers['ETag'], r2.headers['ETag'])
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+        r3 = self.client.get(url, headers={'If-Modified-Since': r1.headers['Last-Modified']})
+        self.assertEqual(304, r3.status_code)
+        # A different encoding or different arguments are a different calendar.
+        r4 = self.client.get(url, headers={'If-None-Match': r1.headers['ETag'], 'Accept-Encoding': 'gzip'})
+        self.assertEqual(200, r4.status_code)
+        self.assertNotEqual(etag, r4.get_etag()[0])
+        r5 = self.client.get(url + '&time=10:00', headers={'If-None-Match': r1.headers['ETag']})
+        self.assertEqual(200, r5.status_code)
+        # Calendars without a seed have weak entity tags.
+        r6 = self.client.get('/calendar?start=2020-01-01&end=2020-12-31')
+        self.assertTrue(r6.get_etag()[1])
+        r7 = self.client.get('/calendar?start=2020-01-01&end=2020-12-31', headers={'If-None-Match': r6.headers['ETag']})
+        self.assertEqual(304, r7.status_code)
+
+    def test_06_window(self):
+        cache = app.config['cache'] = CalendarCache()
+        fragment_cache = app.config['fragment_cache'] = CalendarCache()
+        r1 = self.client.get('/calendar?window=7,60')
+        self.assertEqual(68, count_events(Calendar.from_ical(r1.data)))
+        self.assertFalse(r1.get_etag()[1])
+        # The calendar itself and each of its days were cache misses; the next request is a single hit.
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+        self.assertEqual((0, 68), (fragment_cache.hits, fragment_cache.misses))
+        r2 = self.client.get('/calendar?window=7,60')
+        self.assertEqual(r1.data, r2.data)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        r3 = self.client.get('/calendar?window=7,90')
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+        self.assertEqual((68, 98), (fragment_cache.hits, fragment_cache.misses))
+        self.assertTrue(r3.data.startswith(r1.data.rsplit(b'END:VCALENDAR', 1)[0]))
+        # The days of long windows don't evict whole calendars.
+        cache = app.config['cache'] = CalendarCache(64 * 1024)
+        app.config['fragment_cache'] = CalendarCache(64 * 1024)
+        self.client.get('/calendar?start=2020-01-01&end=2020-01-31&seed=abc')
+        self.client.get('/calendar?window=365,365')
+        self.client.get('/calendar?start=2020-01-01&end=2020-01-31&seed=abc')
+        self.assertEqual(1, cache.hits)
+        for bad in ('7', 'a,b', '-1,5', '7,60&start=2020-01-01'):
+            r = self.client.get(f'/calendar?window={bad}')
+            self.assertTrue(r.text.startswith('Error parsing input:'))
+
+    def test_07_parallel(self):
+        app.config['calendar_workers'] = 2
+        try:
+            r = self.client.get('/calendar?start=2020-01-01&end=2022-12-31')
+            self.assertEqual(1096, count_events(Calendar.from_ical(r.data)))
+        finally:
+            app.config['calendar_workers'] = None
+
+    def test_09_topic(self):
+        cache = app.config['cache'] = CalendarCache()
+        r1 = self.client.get('/calendar?start=2020-02-29&end=2020-02-29&topic=Death+two')
+        cal = Calendar.from_ical(r1.data)
+        self.assertListEqual(['Deaths\n2000: Death two.\n'], [str(e.get('description')) for e in cal.walk('vevent')])
+        r2 = self.client.get('/calendar?start=2020-02-29&end=2020-02-29&topic=two+DEATH&seed=abc')
+        r3 = self.client.get('/calendar?start=2020-02-29&end=2020-02-29&topic=two,death&seed=abc')
+        self.assertEqual(r2.data, r3.data)
+        self.assertEqual(r2.headers['ETag'], r3.headers['ETag'])
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        for bad in ('', '!?', 'x' * 257):
+            r = self.client.get(f'/calendar?topic={bad}')
+            self.assertTrue(r.text.startswith('Error parsing input:'))
+
+    def test_08_search(self):
+        r = self.client.get('/search?q=death&category=deaths&limit=2')
+        self.assertEqual('application/json', r.headers['Content-Type'])
+        self.assertEqual(2, len(r.json))
+        self.assertListEqual(
+            [{'month': 'February', 'date': 29, 'category': 'Deaths', 'year': '2000', 'description': 'Death two.'}],
+            self.client.get('/search?q=Two&month=February&date=29').json
+        )
+        self.assertListEqual([], self.client.get('/search?q=nothing').json)
+        self.assertListEqual([], self.client.get('/search').json)
+        for bad in ('limit=0', 'limit=101', 'limit=x', 'category=bad', 'month=Smarch', 'date=x'):
+            r = self.client.get(f'/search?q=one&{bad}')
+            self.assertEqual(400, r.status_code)
+            self.assertTrue(r.json['error'].startswith('Error parsing input:'))
+
+    def test_10_search_unavailable(self):
+        with mock.patch('onthisday.db.fts5_available', return_value=False), \
+                mock.patch('onthisday.app.download_calendar._search_db', threading.local()):
+            app.config['db'] = InMemory(make_test_db())
+            r = self.client.get('/search?q=death')
+        self.assertEqual(503, r.status_code)
+        self.assertEqual('Search is not available.', r.json['error'])
+
+
+class PreforkServerTestCase(unittest.TestCase):
+
+    ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+
+    def get(self, url: str, timeout: float = 10) -> requests.Response:
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return requests.get(url)
+            except requests.ConnectionError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def test_01_prefork(self):
+        make_test_db()
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        env = dict(os.environ, PYTHONPATH=os.path.join(self.ROOT_DIR, 'src'))
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(self.ROOT_DIR, 'otd.py'), '--dbfile', TEST_DB_FPATH, 'server',
+             '--host', '127.0.0.1', '--port', str(port), '--workers', '2'],
+            env=env
+        )
+        url = f'http://127.0.0.1:{port}/calendar?start=2020-01-01&end=2020-01-31'
+        try:
+            self.assertEqual(31, count_events(Calendar.from_ical(self.get(url).content)))
+            proc.send_signal(signal.SIGHUP)
+            for _ in range(4):
+                self.assertEqual(31, count_events(Calendar.from_ical(self.get(url).content)))
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            self.assertEqual(0, proc.wait(10))
+
+    def test_02_failed_reload(self):
+        make_test_db()
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        env = dict(os.environ, PYTHONPATH=os.path.join(self.ROOT_DIR, 'src'))
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(self.ROOT_DIR, 'otd.py'), '--dbfile', TEST_DB_FPATH, 'server',
+             '--host', '127.0.0.1', '--port', str(port), '--workers', '2', '--snapshot', TEST_SNAPSHOT_FPATH],
+            env=env
+        )
+        url = f'http://127.0.0.1:{port}/calendar?start=2020-01-01&end=2020-01-31'
+        try:
+            self.assertEqual(31, count_events(Calendar.from_ical(self.get(url).content)))
+            # Reloading from a corrupt database fails, but the server carries on with the data it already has.
+            with open(TEST_DB_FPATH, 'r+b') as f:
+                f.write(b'Not a database' * 100)
+            proc.send_signal(signal.SIGHUP)
+            time.sleep(1)
+            self.assertIsNone(proc.poll())
+            for _ in range(4):
+                self.assertEqual(31, count_events(Calendar.from_ical(self.get(url).content)))
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            self.assertEqual(0, proc.wait(10))
+            os.remove(TEST_DB_FPATH)
+
+    def test_04_calendar_workers(self):
+        make_test_db()
+        if os.path.exists(TEST_SNAPSHOT_FPATH):
+            os.remove(TEST_SNAPSHOT_FPATH)
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        env = dict(os.environ, PYTHONPATH=os.path.join(self.ROOT_DIR, 'src'))
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(self.ROOT_DIR, 'otd.py'), '--dbfile', TEST_DB_FPATH, 'server',
+             '--host', '127.0.0.1', '--port', str(port), '--workers', '1', '--calendar-workers', '2',
+             '--snapshot', TEST_SNAPSHOT_FPATH],
+            env=env
+        )
+        url = f'http://127.0.0.1:{port}/calendar?start=2020-01-01&end=2022-12-31&seed=abc'
+        try:
+            self.assertEqual(1096, count_events(Calendar.from_ical(self.get(url).content)))
+            # A snapshot was written, so that the events are not copied to the calendar workers with each calendar.
+            self.assertTrue(os.path.exists(TEST_SNAPSHOT_FPATH))
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            self.assertEqual(0, proc.wait(10))
+
+    def test_03_respawn_delay(self):
+        server = PreforkServer(app, lambda: None, '127.0.0.1', 0, 1)
+        server.socket.close()
+        delays = [server.next_respawn_delay(0.01) for _ in range(12)]
+        self.assertEqual(INITIAL_RESPAWN_DELAY, delays[0])
+        self.assertEqual(2 * INITIAL_RESPAWN_DELAY, delays[1])
+        self.assertEqual(MAX_RESPAWN_DELAY, delays[-1])
+        self.assertEqual(0, server.next_respawn_delay(MIN_WORKER_LIFETIME))
+        self.assertEqual(INITIAL_RESPAWN_DELAY, server.next_respawn_delay(0.01))
+
+
+class AsyncAppTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = CalendarApp(InMemory(make_test_db()), batch_size=1024)
+
+    def test_01_streaming(self):
+        status, headers, chunks = asgi_get(self.app, '/calendar',
+                                           'start=2020-01-01&end=2020-12-31&timezone=Europe:London')
+        self.assertEqual(200, status)
+        self.assertEqual('text/calendar', headers['content-type'])
+        self.assertGreater(len(chunks), 2)
+        cal = Calendar.from_ical(b''.join(chunks))
+        self.assertEqual(366, count_events(cal))
+        self.assertTrue(check_vevents_start_at(cal, 9, 0))
+
+    def test_02_gzip(self):
+        status, headers, chunks = asgi_get(self.app, '/calendar', 'start=2020-01-01&end=2020-12-31',
+                                           {'Accept-Encoding': 'deflate, gzip;q=0.5'})
+        self.assertEqual('gzip', headers['content-encoding'])
+        self.assertEqual(366, count_events(Calendar.from_ical(gzip.decompress(b''.join(chunks)))))
+        status, headers, chunks = asgi_get(self.app, '/calendar', '', {'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('content-encoding', headers)
+        status, headers, chunks = asgi_get(self.app, '/calendar', '', {'Accept-Encoding': '*;q=1, gzip;q=0'})
+        self.assertNotIn('content-encoding', headers)
+        status, headers, chunks = asgi_get(self.app, '/calendar', 'start=2020-01-01&end=2020-01-31',
+                                           {'Accept-Encoding': '*'})
+        self.assertEqual('gzip', headers['content-encoding'])
+        self.assertEqual(31, count_events(Calendar.from_ical(gzip.decompress(b''.join(chunks)))))
+
+    def test_03_errors(self):
+        status, headers, chunks = asgi_get(self.app, '/calendar', 'timezone=BAD_TIMEZONE')
+        self.assertEqual('Error parsing input: Bad timezone: BAD_TIMEZONE', b''.join(chunks).decode())
+        status, headers, chunks = asgi_get(self.app, '/calendar', 'start=2020-01-01&end=2019-12-31')
+        self.assertTrue(b''.join(chunks).startswith(b'Error generating calendar.'))
+        status, headers, chunks = asgi_get(self.app, '/nothing')
+        self.assertEqual(404, status)
+
+    def test_04_no_uvicorn(self):
+        # A None entry in sys.modules makes importing the module fail, as if it were not installed.
+        with mock.patch.dict(sys.modules, {'uvicorn': None}):
+            with self.assertRaisesRegex(RuntimeError, 'requires uvicorn'):
+                run(self.app.db, '127.0.0.1', 0)
+
+    def test_05_conditional(self):
+        # The same calendar has the same validators as in the Flask app.
+        app.config['db'] = self.app.db
+        flask_r = app.test_client().get('/calendar?start=2020-01-01&end=2020-12-31&seed=abc')
+        status, headers, chunks = asgi_get(self.app, '/calendar', 'start=2020-01-01&end=2020-12-31&seed=abc')
+        self.assertEqual(flask_r.headers['ETag'], headers['etag'])
+        self.assertEqual(flask_r.headers['Last-Modified'], headers['last-modified'])
+        self.assertEqual(flask_r.data, b''.join(chunks))
+        status, headers, chunks = asgi_get(self.app, '/calendar', 'start=2020-01-01&end=2020-12-31&seed=abc',
+                                           {'If-None-Match': headers['etag']})
+        self.assertEqual(304, status)
+        self.assertEqual(b'', b''.join(chunks))
+        status, headers, chunks = asgi_get(self.app, '/calendar', 'start=2020-01-01&end=2020-12-31&seed=abc',
+                                           {'If-None-Match': headers['etag'], 'Accept-Encoding': 'gzip'})
+        self.assertEqual(200, status)
+
+    def test_06_cache(self):
+        cache = self.app.cache = CalendarCache()
+        fragment_cache = self.app.fragment_cache = CalendarCache()
+        status, headers, chunks1 = asgi_get(self.app, '/calendar', 'start=2020-01-01&end=2020-12-31&seed=abc')
+        status, headers, chunks2 = asgi_get(self.app, '/calendar', 'start=2020-01-01&end=2020-12-31&seed=abc',
+                                            {'Accept-Encoding': 'gzip'})
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        self.assertEqual(b''.join(chunks1), gzip.decompress(b''.join(chunks2)))
+        asgi_get(self.app, '/calendar', 'window=7,60')
+        asgi_get(self.app, '/calendar', 'window=7,90')
+        self.assertEqual((68, 98), (fragment_cache.hits, fragment_cache.misses))
+
+    def test_07_query(self):
+        # As in the Flask app, the first of repeated arguments is used, and blank values are kept.
+        query = 'start=2020-01-01&end=2020-01-01&births=2&births=0&deaths=0&events=0&holidays=0'
+        status, headers, chunks = asgi_get(self.app, '/calendar', query)
+        description = str(Calendar.from_ical(b''.join(chunks)).walk('vevent')[0].get('description'))
+        self.assertIn('Birth one', description)
+        self.assertIn('Birth two', description)
+        app.config['db'] = self.app.db
+        flask_r = app.test_client().get('/calendar?start=2020-01-01&end=2020-01-31&seed=')
+        status, headers, chunks = asgi_get(self.app, '/calendar', 'start=2020-01-01&end=2020-01-31&seed=')
+        self.assertFalse(headers['etag'].startswith('W/'))
+        self.assertEqual(flask_r.headers['ETag'], headers['etag'])
+
+    def test_08_parallel(self):
+        with ThreadPoolExecutor(1) as executor:
+            submit = executor.submit
+            submitted = []
+            executor.submit = lambda *args: submitted.append(args) or submit(*args)
+            self.app.calendar_executor = executor
+            status, headers, chunks = asgi_get(self.app, '/calendar', 'start=2020-01-01&end=2022-12-31')
+            self.assertEqual(1096, count_events(Calendar.from_ical(b''.join(chunks))))
+            # One task for each month.
+            self.assertEqual(12, len(submitted))
+            asgi_get(self.app, '/calendar', 'start=2020-01-01&end=2020-12-31')
+            self.assertEqual(12, len(submitted))
@@ -1,7 +1,12 @@
 """
 Various helper functions for performing tests.
 """
-from typing import Optional
+import asyncio
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, Callable
+from urllib.parse import urlparse, parse_qs
 
 import pytz
 from icalendar import Calendar, Event
@@ -47,3 +52,127 @@ def check_vevents_start_at(cal: Calendar, hour: int, minute: int, tz: Optional[p
         if (tz is not None) and (tz != start.dt.tzinfo):
             return False
     return True
+
+
+CANNED_WIKITEXT = """Intro text.
+==Events==
+* [[1066]] – [[William the Conqueror|William I]] is crowned.
+* 1900 – Something happens.
+==Births==
+* 1900 – Someone is born.
+==Deaths==
+* 1950 – Someone dies.
+==Holidays and observances==
+* Some holiday
+** Sub-holiday
+==References==
+{{reflist}}
+"""
+
+
+class StubWikiServer:
+    """
+    A local HTTP server that imitates the parts of the MediaWiki API that we use, serving canned wikitext. Use as a
+    context manager; the server runs in a background thread while the context is active.
+
+    :param pages: A dict mapping page titles (with spaces, not underscores) to a tuple of (revision ID, wikitext).
+    """
+
+    def __init__(self, pages: dict[str, tuple[int, str]]):
+        self.pages = pages
+        # The parameters of each request to the server, for inspection by tests.
+        self.requests: list[dict[str, str]] = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def api_url(self) -> str:
+        host, port = self.server.server_address
+        return f'http://{host}:{port}/w/api.php'
+
+    def __enter__(self) -> 'StubWikiServer':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, params: dict[str, str]) -> dict:
+        self.requests.append(params)
+        if params.get('meta') == 'siteinfo':
+            return {'query': {
+                'general': {'generator': 'MediaWiki 1.41.0', 'server': 'http://127.0.0.1', 'base': ''},
+                'extensions': []
+            }}
+        normalized = []
+        pages = []
+        for title in params['titles'].split('|'):
+            norm_title = title.replace('_', ' ')
+            if norm_title != title:
+                normalized.append({'fromencoded': False, 'from': title, 'to': norm_title})
+            if norm_title not in self.pages:
+                pages.append({'ns': 0, 'title': norm_title, 'missing': True})
+                continue
+            rev_id, wikitext = self.pages[norm_title]
+            revision = {'revid': rev_id, 'parentid': rev_id - 1}
+            if 'content' in params['rvprop'].split('|'):
+                revision['slots'] = {'main': {'contentmodel': 'wikitext', 'content': wikitext}}
+            pages.append({'pageid': abs(hash(norm_title)), 'ns': 0, 'title': norm_title, 'revisions': [revision]})
+        query = {'pages': pages}
+        if normalized:
+            query['normalized'] = normalized
+        return {'batchcomplete': True, 'query': query}
+
+    def _make_handler(self) -> type[BaseHTTPRequestHandler]:
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                body = json.dumps(stub.respond(params)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def asgi_get(app: Callable, path: str, query_string: str = '',
+             headers: Optional[dict[str, str]] = None) -> tuple[int, dict[str, str], list[bytes]]:
+    """
+    Make a GET request to an ASGI app, in-process.
+
+    :param app: The ASGI app.
+    :param path: The path to request.
+    :param query_string: The query string (without the leading "?").
+    :param headers: Any request headers.
+    :return: A tuple containing the status code, the response headers and a list of the chunks of the response body.
+    """
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'path': path,
+        'query_string': query_string.encode(),
+        'headers': [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+    }
+    messages = []
+
+    async def receive() -> dict:
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message: dict):
+        messages.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    start = messages[0]
+    resp_headers = {k.decode(): v.decode() for k, v in start['headers']}
+    return start['status'], resp_headers, [m['body'] for m in messages[1:]]